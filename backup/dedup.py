@@ -0,0 +1,279 @@
+import datetime
+import hashlib
+import json
+import threading
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from utils.logger import logger
+from utils.compression import compress_chunks, detect_codec, resolve_codec, extension
+from s3.client import get_client, get_max_concurrency
+from s3 import catalog
+from s3.catalog import CHUNK_PREFIX, LOCK_PREFIX
+from utils import metrics, encryption, throttle
+
+MANIFEST_SUFFIX = ".dedup.json"
+
+MIN_CHUNK_SIZE = 256 * 1024
+AVG_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+GC_MARKER = f"{LOCK_PREFIX}gc.json"
+# Leases and GC markers older than this were left behind by a crashed process
+LOCK_EXPIRY_HOURS = 24
+
+
+def split_chunks(chunks, min_size=MIN_CHUNK_SIZE, avg_size=AVG_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+    """
+    Content-defined chunking of a byte stream, anchored on line ends.
+
+    Dumps are line oriented (one INSERT or COPY row per line), so every newline is a
+    candidate cut point. A line ends a chunk when its CRC32 falls below a threshold
+    proportional to its length, which gives chunks of about `avg_size` whose boundaries
+    depend only on nearby content: an insert early in a table only changes the chunk
+    it lands in, not every chunk after it. Data without newlines is cut at `max_size`.
+    """
+    buffer = bytearray()
+    scan = 0        # where to look for the next newline
+    line_start = 0
+
+    for data in chunks:
+        buffer += data
+        view = memoryview(buffer)
+        start = 0
+        while True:
+            newline = buffer.find(b"\n", scan)
+            if newline == -1:
+                if len(buffer) - start >= max_size:
+                    cut = start + max_size
+                    yield bytes(view[start:cut])
+                    start = line_start = scan = cut
+                    continue
+                scan = len(buffer)
+                break
+
+            end = newline + 1
+            size = end - start
+            line_length = end - line_start
+            threshold = min(line_length * (1 << 32) // avg_size, 1 << 32)
+            if size >= max_size or (size >= min_size and zlib.crc32(view[line_start:end]) < threshold):
+                yield bytes(view[start:end])
+                start = end
+            line_start = scan = end
+
+        view.release()
+        del buffer[:start]
+        scan -= start
+        line_start -= start
+
+    if buffer:
+        yield bytes(buffer)
+
+
+def chunk_key(digest, codec):
+    return f"{CHUNK_PREFIX}{digest[:2]}/{digest}{extension(codec)}"
+
+
+def _chunk_hash(key):
+    return key.rsplit("/", 1)[-1].split(".", 1)[0]
+
+
+def chunk_codec(manifest, entry):
+    """Codec of the stored object of a manifest entry; older manifests only have one for all chunks"""
+    return entry[2] if len(entry) > 2 else manifest["codec"]
+
+
+def _expired(last_modified):
+    return last_modified < datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=LOCK_EXPIRY_HOURS)
+
+
+def _read_gc_marker(config):
+    s3 = get_client(config)
+    try:
+        response = s3.get_object(Bucket=config["s3"]["bucket"], Key=GC_MARKER)
+    except s3.exceptions.NoSuchKey:
+        return None
+    return dict(json.loads(response["Body"].read()), expired=_expired(response["LastModified"]))
+
+
+def _write_gc_marker(config, generation, running):
+    body = json.dumps({"generation": generation, "running": running}).encode()
+    get_client(config).put_object(Bucket=config["s3"]["bucket"], Key=GC_MARKER, Body=body)
+
+
+def _acquire_lease(config, name):
+    """
+    Announce a running dedup backup, returns (lease key, GC generation).
+
+    The lease is written before the GC marker is read and GC writes its marker before it
+    lists leases, so either the backup sees GC running or GC sees the lease.
+    """
+    s3 = get_client(config)
+    bucket = config["s3"]["bucket"]
+    lease = f"{LOCK_PREFIX}backup-{name}-{uuid.uuid4().hex[:8]}.json"
+    s3.put_object(Bucket=bucket, Key=lease, Body=json.dumps({"name": name}).encode())
+    marker = _read_gc_marker(config)
+    if marker and marker["running"] and not marker["expired"]:
+        s3.delete_object(Bucket=bucket, Key=lease)
+        raise Exception("Dedup chunk GC is running; retry the backup when it has finished")
+    return lease, marker["generation"] if marker else None
+
+
+def load_chunk_index(config, generation=None):
+    """
+    Known chunks (hash -> codec) from the local index. It is rebuilt from a listing of the
+    bucket when empty, or when a chunk GC has run since it was last synced, possibly on
+    another host, so no chunk is skipped that GC has deleted.
+    """
+    known = catalog.known_chunks(config)
+    if not known or catalog.chunk_generation(config) != generation:
+        known = rebuild_chunk_index(config)
+        catalog.set_chunk_generation(config, generation)
+    return known
+
+
+def rebuild_chunk_index(config):
+    logger.info("Building local chunk index from S3")
+    rows = [(_chunk_hash(obj["Key"]), obj["Size"], detect_codec(obj["Key"]))
+            for obj in catalog.iter_objects(config, prefix=CHUNK_PREFIX)]
+    catalog.add_chunks(config, rows, replace=True)
+    return {h: codec for h, _, codec in rows}
+
+
+def store_stream(chunks, name, config, codec=None, level=None):
+    """
+    Store a dump stream as deduplicated chunks plus a manifest, returns the manifest key.
+
+    Only chunks missing from the local index are compressed and uploaded; a chunk that is
+    already stored is reused with the codec it was stored with, which the manifest records
+    per chunk. The index is updated once the manifest is safely stored. A lease in the
+    bucket keeps chunk GC from deleting reused chunks until then.
+    """
+    if encryption.enabled(config):
+        # Chunks are shared between backups, a per-backup data key would defeat that
+        raise Exception("Dedup backups cannot be encrypted; disable encryption or dedup")
+    s3 = get_client(config)
+    bucket = config["s3"]["bucket"]
+    codec, level = resolve_codec(codec, level)
+    lease, generation = _acquire_lease(config, name)
+    try:
+        return _store_chunks(s3, bucket, chunks, name, config, codec, level, generation)
+    finally:
+        s3.delete_object(Bucket=bucket, Key=lease)
+
+
+def _store_chunks(s3, bucket, chunks, name, config, codec, level, generation):
+    max_concurrency = get_max_concurrency(config)
+    known = load_chunk_index(config, generation)
+
+    slots = threading.BoundedSemaphore(max_concurrency * 2)
+    upload_limit = throttle.upload_bucket(config)
+    futures = []
+    entries = []
+    new_rows = []
+    total = new_bytes = 0
+
+    def upload(digest, data):
+        try:
+            body = b"".join(compress_chunks([data], codec, level))
+            if upload_limit is not None:
+                stage.add_throttled(upload_limit.consume(len(body)))
+            s3.put_object(Bucket=bucket, Key=chunk_key(digest, codec), Body=body)
+            return len(body)
+        finally:
+            slots.release()
+
+    with metrics.stage("dedup") as stage, ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        for data in split_chunks(chunks):
+            digest = hashlib.sha256(data).hexdigest()
+            total += len(data)
+            if digest in known:
+                entries.append([digest, len(data), known[digest]])
+                continue
+            known[digest] = codec
+            entries.append([digest, len(data), codec])
+            new_rows.append((digest, len(data), codec))
+            slots.acquire()
+            futures.append(pool.submit(upload, digest, data))
+        new_bytes = sum(f.result() for f in futures)
+        stage.bytes_in, stage.bytes_out = total, new_bytes
+
+    manifest = {
+        "name": name,
+        "codec": codec,
+        "size": total,
+        "chunk_count": len(entries),
+        "new_chunks": len(new_rows),
+        "uploaded_bytes": new_bytes,
+        "chunks": entries,
+    }
+    key = f"{name}{MANIFEST_SUFFIX}"
+    body = json.dumps(manifest).encode()
+    s3.put_object(Bucket=bucket, Key=key, Body=body)
+    catalog.add_chunks(config, new_rows)
+    catalog.record_backup(config, key, total, codec=codec)
+
+    logger.info(f"Dedup backup {key}: {len(entries)} chunks, {len(new_rows)} new, "
+                f"{new_bytes} bytes uploaded for {total} bytes of dump")
+    return key
+
+
+def read_manifest(config, key):
+    s3 = get_client(config)
+    body = s3.get_object(Bucket=config["s3"]["bucket"], Key=key)["Body"].read()
+    return json.loads(body)
+
+
+def gc_chunks(config, dry_run=False, grace_hours=24):
+    """
+    Delete chunks that no remaining dedup manifest references.
+
+    Chunks younger than `grace_hours` are left alone: a backup that crashed may have
+    uploaded chunks but no manifest, and is resumed with them. While GC deletes, a marker
+    in the bucket keeps new dedup backups from starting, and GC does not run while any
+    backup holds a lease; once done it bumps the marker's generation, so every host
+    rebuilds its chunk index before trusting it again.
+    """
+    s3 = get_client(config)
+    bucket = config["s3"]["bucket"]
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=grace_hours)
+
+    marker = None if dry_run else _read_gc_marker(config)
+    generation = previous = marker["generation"] if marker else None
+    if not dry_run:
+        _write_gc_marker(config, generation, running=True)
+    orphans = []
+    try:
+        if not dry_run:
+            leases = [obj["Key"] for obj in catalog.iter_objects(config, prefix=f"{LOCK_PREFIX}backup-")
+                      if not _expired(obj["LastModified"])]
+            if leases:
+                raise Exception(f"{len(leases)} dedup backup(s) running; retry chunk GC when they have finished")
+
+        referenced = set()
+        for obj in catalog.iter_objects(config):
+            if obj["Key"].endswith(MANIFEST_SUFFIX):
+                manifest = read_manifest(config, obj["Key"])
+                referenced.update((entry[0], chunk_codec(manifest, entry)) for entry in manifest["chunks"])
+
+        orphans = [obj["Key"] for obj in catalog.iter_objects(config, prefix=CHUNK_PREFIX)
+                   if (_chunk_hash(obj["Key"]), detect_codec(obj["Key"])) not in referenced
+                   and obj["LastModified"] < cutoff]
+        logger.info(f"{len(orphans)} unreferenced chunks" + (" (dry run)" if dry_run else ""))
+        if dry_run or not orphans:
+            return orphans
+
+        generation = uuid.uuid4().hex
+        for i in range(0, len(orphans), 1000):
+            batch = orphans[i:i + 1000]
+            s3.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": k} for k in batch], "Quiet": True})
+    finally:
+        if not dry_run:
+            _write_gc_marker(config, generation, running=False)
+    # Other hosts see the new generation and rebuild their index; this one is corrected in place
+    deleted = {key.rsplit("/", 1)[-1] for key in orphans}
+    catalog.remove_chunks(config, [digest for digest, codec in catalog.known_chunks(config).items()
+                                   if f"{digest}{extension(codec)}" in deleted])
+    if catalog.chunk_generation(config) == previous:
+        catalog.set_chunk_generation(config, generation)
+    return orphans
@@ -1,99 +1,278 @@
 # backup/incremental_backup.py
 
 import os
+import re
+import struct
 import subprocess
+import tempfile
+import time
 from datetime import datetime
+from pathlib import Path
 from utils.logger import logger
-from utils.docker_helper import run_command_with_fallback_without_file, find_running_container
+from utils.docker_helper import (find_running_container, command_exists, start_command_with_fallback,
+                                 iter_command_output)
+from utils.compression import compress_chunks, resolve_codec, extension, read_chunks
+from utils import db_pool
+from utils.db_pool import server_capabilities
+from state_manager import StateManager
+from s3 import uploader
+from backup import wal_shipper
+from utils import metrics, throttle
+
+def _binlog_status_sql(config):
+    # SHOW MASTER STATUS was removed in MySQL 8.4; its replacement appeared in 8.2
+    version = server_capabilities(config, "mysql")["version"] or ""
+    numbers = [int(part) for part in re.findall(r"\d+", version)[:2]]
+    if "mariadb" not in version.lower() and numbers >= [8, 2]:
+        return "SHOW BINARY LOG STATUS"
+    return "SHOW MASTER STATUS"
+
+def source_data_option(config):
+    """mysqldump flag that writes the snapshot's binlog coordinates into the dump as a comment"""
+    # --master-data was renamed --source-data in MySQL 8.0.26
+    version = server_capabilities(config, "mysql")["version"] or ""
+    numbers = [int(part) for part in re.findall(r"\d+", version)[:3]]
+    if "mariadb" not in version.lower() and numbers >= [8, 0, 26]:
+        return "--source-data=2"
+    return "--master-data=2"
 
 def get_last_binlog_position(config):
+    rows = db_pool.query(config, "mysql", _binlog_status_sql(config))
+    if not rows:
+        raise Exception("Binary logging is not enabled on the server")
+    binlog_file, position = rows[0][0], rows[0][1]
+    return binlog_file, position  # log_file, log_pos
+
+def binlog_server_id(config):
     my = config["mysql"]
-    cmd = [
-        "mysql",
-        f"-h{my['host']}",
-        f"-P{my['port']}",
-        f"-u{my['user']}",
-        f"-p{my['password']}",
-        "-e", "SHOW BINARY LOG STATUS;"
-    ]
+    return f"{my['host']}:{my['port']}"
 
-    # Find fallback Docker container (optional)
-    container = find_running_container("mysql")
+def list_binary_logs(config):
+    """Binlog file names currently on the server, oldest first"""
+    return [row[0] for row in db_pool.query(config, "mysql", "SHOW BINARY LOGS")]
 
-    # Run mysqldump with fallback
-    result = run_command_with_fallback_without_file(cmd, fallback_container=container)
+def _binlog_command(my, extra_args):
+    return [
+        "mysqlbinlog",
+        "--read-from-remote-server",
+        f"--host={my['host']}",
+        f"--port={my['port']}",
+        f"--user={my['user']}",
+        f"--password={my['password']}",
+    ] + extra_args
 
-    if not result:
-        raise Exception("SHOW MASTER STATUS failed")
+# Event headers in mysqlbinlog output, e.g.
+# "#261001 12:34:56 server id 1  end_log_pos 236 CRC32 0x1a2b3c4d \tQuery\tthread_id=8 ..."
+EVENT_HEADER = re.compile(rb"^#(\d{6}) +(\d{1,2}:\d{2}:\d{2}) server id \d+ .*?\t([A-Za-z_-]+)", re.M)
+# These carry the time a binlog file was opened or closed, not the time of a change
+BOOKKEEPING_EVENTS = (b"Start", b"Rotate", b"Previous-GTIDs", b"Stop")
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
-    lines = result.strip().split('\n')
-    if len(lines) < 2:
-        raise Exception("Unexpected result from SHOW BINARY LOG STATUS")
+def event_time(match):
+    return datetime.strptime((match[1] + b" " + match[2]).decode(), "%y%m%d %H:%M:%S")
 
-    header = lines[0].split('\t')
-    values = lines[1].split('\t')
+def scan_event_times(chunks, times):
+    """Pass mysqlbinlog output through, noting the first and last change event times in `times`"""
+    tail = b""
+    for chunk in chunks:
+        data = tail + chunk
+        end = data.rfind(b"\n") + 1
+        for match in EVENT_HEADER.finditer(data, 0, end):
+            if match[3] in BOOKKEEPING_EVENTS:
+                continue
+            when = event_time(match).strftime(TIME_FORMAT)
+            times.setdefault("first", when)
+            times["last"] = when
+        tail = data[end:]
+        yield chunk
 
-    binlog_file = values[header.index("File")]
-    position = values[header.index("Position")]
-    return binlog_file, position  # log_file, log_pos
+# Raw binlog files (mysqlbinlog --raw): a magic number, then events that each start with
+# timestamp, type code, server id, event size, next position and flags
+BINLOG_MAGIC = b"\xfebin"
+RAW_EVENT_HEADER = struct.Struct("<IBIIIH")
+# Start_v3, Stop, Rotate, Format_description and Previous_gtids: the raw BOOKKEEPING_EVENTS
+RAW_BOOKKEEPING_EVENTS = (1, 3, 4, 15, 35)
+
+def raw_event_times(path):
+    """First change event time and last event time of a raw binlog file, (None, None) if it has no events"""
+    first = last = None
+    with open(path, "rb") as f:
+        if f.read(len(BINLOG_MAGIC)) != BINLOG_MAGIC:
+            raise Exception(f"{path} is not a binlog file")
+        while True:
+            header = f.read(RAW_EVENT_HEADER.size)
+            if len(header) < RAW_EVENT_HEADER.size:
+                break
+            timestamp, kind, _, size, _, _ = RAW_EVENT_HEADER.unpack(header)
+            if size < RAW_EVENT_HEADER.size:
+                raise Exception(f"{path} has a corrupt event header at {f.tell() - RAW_EVENT_HEADER.size}")
+            f.seek(size - RAW_EVENT_HEADER.size, os.SEEK_CUR)
+            # Rotate events the server fakes for a new connection carry no time
+            if not timestamp:
+                continue
+            # mysqlbinlog prints local time, and so does the log index
+            when = datetime.fromtimestamp(timestamp).strftime(TIME_FORMAT)
+            if first is None and kind not in RAW_BOOKKEEPING_EVENTS:
+                first = when
+            last = max(last or when, when)
+    return first or last, last
+
+def save_binlog_position(config, position):
+    """Persist the (file, position) an incremental ended at, once it is safely in S3"""
+    StateManager().save_binlog_position(binlog_server_id(config), *position)
 
-def mysql_incremental_backup(config, date):
-    from pathlib import Path
-    log_file, _ = get_last_binlog_position(config)
-    binlog_file = f"mysql_incremental_backup_{date}.sql"
-    tmp_dir = Path(os.getenv("TMP", os.getenv("TEMP", "/tmp")))
-    # output_path = os.path.join("/tmp", binlog_file)
-    output_path = tmp_dir / binlog_file
+def mysql_incremental_backup(config, date, compress=False, codec=None, level=None, threads=1, stream=False):
+    """
+    Capture the binlog events written since the last incremental.
+
+    Reads from the saved (file, position) up to the server's current position, across
+    any binlogs rotated in between, and streams mysqlbinlog's output to a local file or,
+    with stream=True, straight to S3. Returns (path or key, end position, log index entry),
+    or (None, None, None) when nothing new was written. The caller saves the end position
+    with save_binlog_position() and records the entry in the catalog's log index once the
+    data is uploaded.
+    """
+    end_file, end_pos = get_last_binlog_position(config)
+    end_pos = int(end_pos)
+    # Every event up to the end position was written by now
+    captured_at = datetime.now().strftime(TIME_FORMAT)
+    last = StateManager().load_binlog_position(binlog_server_id(config))
+    available = list_binary_logs(config)
+
+    if last is None:
+        # First run: nothing to continue from, capture the current binlog from its start
+        start_file, start_pos = end_file, 4
+    elif last[0] not in available:
+        start_file, start_pos = available[0], 4
+        logger.warning(f"Binlog {last[0]} has been purged, continuing from {start_file}; events in between are lost")
+    else:
+        start_file, start_pos = last
+
+    if (start_file, start_pos) == (end_file, end_pos):
+        logger.info("No new binlog events since the last incremental backup")
+        return None, None, None
+
+    files = available[available.index(start_file):available.index(end_file) + 1]
     my = config["mysql"]
-    container = find_running_container("mysql")
-    if container:
-        cmd = [
-            "docker", "exec", container,
-            "mysqlbinlog",
-            f"--read-from-remote-server",
-            f"--host={my['host']}",
-            f"--port={my['port']}",
-            f"--user={my['user']}",
-            f"--password={my['password']}",
-            log_file
-        ]
-        # Note: With docker exec, direct output redirection to file_path is not straightforward
-        # So we run the command and capture output
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode != 0:
-            logger.error(f"mysqlbinlog failed: {result.stderr.decode()}")
+    cmd = _binlog_command(my, [f"--start-position={start_pos}", f"--stop-position={end_pos}"] + files)
+    logger.info(f"Reading binlogs {start_file}:{start_pos} -> {end_file}:{end_pos}")
+
+    codec, level = resolve_codec(codec, level)
+    name = f"mysql_incremental_backup_{date}.sql" + (extension(codec) if compress else "")
+
+    # Stream through docker exec as well; nothing is held in memory
+    container = find_running_container("mysql", config)
+    proc = start_command_with_fallback(throttle.prioritized(cmd, config), fallback_container=container)
+    output = throttle.throttled(iter_command_output(proc), throttle.dump_bucket(config, "mysql"))
+    times = {}
+
+    with metrics.stage("stream" if stream else "dump", db="mysql", incremental=True) as stage:
+        raw = metrics.counted(scan_event_times(output, times), stage, "bytes_in")
+        chunks = metrics.counted(compress_chunks(raw, codec, level, threads) if compress else raw, stage, "bytes_out")
+        try:
+            if stream:
+                result = uploader.upload_stream(chunks, name, config)
+            else:
+                result = Path(os.getenv("TMP", os.getenv("TEMP", "/tmp"))) / name
+                with open(result, "wb") as f:
+                    for data in chunks:
+                        f.write(data)
+        except Exception as e:
+            logger.error(f"mysqlbinlog failed: {e}")
             raise Exception("Incremental backup failed")
-        with open(output_path, "wb") as f:
-            f.write(result.stdout)
-    else:
-        cmd = [
-            "mysqlbinlog",
-            "--read-from-remote-server",
-            f"--host={my['host']}",
-            f"--port={my['port']}",
-            f"--user={my['user']}",
-            f"--password={my['password']}",
-            log_file
-        ]
-        with open(output_path, "w") as f:
-            result = subprocess.run(cmd, stdout=f, stderr=subprocess.PIPE)
-            if result.returncode != 0:
-                logger.error(f"mysqlbinlog failed: {result.stderr.decode()}")
-                raise Exception("Incremental backup failed")
-
-    logger.info(f"Incremental MySQL backup saved to {output_path}")
-    return output_path
-
-def postgres_incremental_backup(config):
-    pg = config["postgres"]
-    now = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    wal_dir = pg.get("wal_archive_dir", "/var/lib/postgresql/wal_archive")
-    output = Path(os.getenv("TMP", os.getenv("TEMP", "/tmp"))) / f"pg_inc_backup_{now}.tar.gz"
-
-    if not os.path.isdir(wal_dir):
-        raise Exception(f"WAL archive directory not found: {wal_dir}")
-
-    logger.info(f"Archiving WAL files from {wal_dir}")
-    subprocess.run(["tar", "-czf", str(output), "-C", wal_dir, "."], check=True)
-    logger.info(f"Created incremental archive: {output}")
-    return output
+        finally:
+            output.close()
+
+    logger.info(f"Incremental MySQL backup saved to {result}")
+    entry = {
+        "kind": "binlog",
+        "server": binlog_server_id(config),
+        "target": my.get("target"),
+        "start_time": times.get("first", captured_at),
+        "end_time": captured_at,
+        "start_file": start_file,
+        "start_pos": start_pos,
+        "end_file": end_file,
+        "end_pos": end_pos,
+    }
+    return result, (end_file, end_pos), entry
+
+def _log_binlog_stream_errors(proc):
+    proc.stderr_file.seek(0)
+    stderr = proc.stderr_file.read().decode(errors="replace").strip()
+    proc.stderr_file.close()
+    if stderr:
+        logger.warning(f"mysqlbinlog: {stderr}")
+
+def binlog_daemon(config, output_dir=None, poll_interval=10, codec=None, level=None, threads=1):
+    """
+    Continuously mirror binlogs with `mysqlbinlog --raw --stop-never` and ship each file
+    to S3 once the server has rotated past it (i.e. it is closed). Shipped files are
+    indexed for point-in-time recovery, which replays them through a local mysqlbinlog.
+    """
+    from backup import pitr
+
+    if not command_exists("mysqlbinlog"):
+        raise Exception("Binlog streaming needs a local mysqlbinlog")
+
+    my = config["mysql"]
+    server = binlog_server_id(config)
+    state = StateManager()
+    output_dir = Path(output_dir or Path(os.getenv("TMP", os.getenv("TEMP", "/tmp"))) / "binlog_stream")
+    os.makedirs(output_dir, exist_ok=True)
+    codec, level = resolve_codec(codec, level)
+
+    proc = None
+    try:
+        while True:
+            if proc is None or proc.poll() is not None:
+                if proc is not None:
+                    _log_binlog_stream_errors(proc)
+                    logger.warning(f"mysqlbinlog exited with status {proc.returncode}, restarting")
+                last = state.load_binlog_position(server)
+                start_file = last[0] if last else get_last_binlog_position(config)[0]
+                cmd = _binlog_command(my, ["--raw", "--stop-never", f"--result-file={output_dir}/", start_file])
+                logger.info(f"Streaming binlogs from {start_file} into {output_dir}")
+                # stderr goes to a temp file so a long-running stream can never block on a full pipe
+                stderr_file = tempfile.TemporaryFile()
+                proc = subprocess.Popen(cmd, stderr=stderr_file)
+                proc.stderr_file = stderr_file
+
+            # Every file but the newest has been rotated and is complete
+            segments = sorted(f for f in os.listdir(output_dir) if not f.startswith("."))
+            for segment, next_segment in zip(segments, segments[1:]):
+                path = output_dir / segment
+                start_time, end_time = raw_event_times(path)
+                date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+                key = f"mysql_incremental_backup_{date}_{segment}.bin" + extension(codec)
+                with open(path, "rb") as f:
+                    key = uploader.upload_stream(compress_chunks(read_chunks(f), codec, level, threads), key, config)
+                if start_time:
+                    # The next file starts right after its format description event, so the chain stays unbroken
+                    pitr.record_entry(config, key, {
+                        "kind": "binlog",
+                        "server": server,
+                        "target": my.get("target"),
+                        "start_time": start_time,
+                        "end_time": end_time,
+                        "start_file": segment,
+                        "start_pos": 4,
+                        "end_file": next_segment,
+                        "end_pos": 4,
+                    })
+                state.save_binlog_position(server, next_segment, 4)
+                os.remove(path)
+                logger.info(f"Shipped closed binlog {segment} as {key}")
+
+            time.sleep(poll_interval)
+    finally:
+        if proc is not None:
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+            _log_binlog_stream_errors(proc)
+
+def postgres_incremental_backup(config, date=None, compress=True, codec=None, level=None, threads=1):
+    """Ship only the WAL files archived since the last run; returns the uploaded keys"""
+    # Segments are compressed one per thread; at least four ship at once, more with a higher thread count
+    return wal_shipper.ship_new_segments(config, jobs=max(threads, 4), codec=codec, level=level, compress=compress)
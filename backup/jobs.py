@@ -0,0 +1,76 @@
+"""
+Journaled backup jobs: a local dump is recorded in the state DB stage by stage, so a
+crash or a failed upload resumes from the last finished stage instead of dumping again.
+Used by the CLI and by scheduled runs alike.
+"""
+import os
+import shutil
+from pathlib import Path
+from utils.logger import logger
+from utils.compression import ENCRYPTED_EXTENSION, compress_file, extension, resolve_codec
+
+
+def remove_local(path):
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+            logger.info(f"Deleted local directory: {path}")
+        elif os.path.exists(path):
+            os.remove(path)
+            logger.info(f"Deleted local file: {path}")
+    except Exception as cleanup_err:
+        logger.warning(f"Failed to delete local file: {cleanup_err}")
+
+
+def complete_backup_job(config, job, state):
+    """Take a journaled backup job from its last finished stage through upload; returns the local path"""
+    from backup import incremental_backup, pitr
+    from s3 import uploader
+    from utils import encryption
+
+    path, meta = job["path"], job["meta"]
+    if job["stage"] == "dumped" and meta.get("encrypt"):
+        # Compression and encryption share one pass over the dump
+        codec = resolve_codec(meta.get("codec"))[0] if meta.get("compress") else None
+        path = str(encryption.encrypt_file(Path(path), config, codec, meta.get("level"), meta.get("threads", 1)))
+        state.update_backup_job(job["id"], stage="compressed", path=path)
+    elif job["stage"] == "dumped" and meta.get("compress"):
+        path = str(compress_file(Path(path), meta.get("codec"), meta.get("level"), meta.get("threads", 1)))
+        state.update_backup_job(job["id"], stage="compressed", path=path)
+
+    key = os.path.basename(os.path.normpath(path))
+    state.update_backup_job(job["id"], stage="uploading", key=key)
+    if os.path.isdir(path):
+        uploader.upload_directory(path, config, max_workers=meta.get("jobs", 4))
+    else:
+        key = uploader.upload_file_resumable(path, config, key, state=state)
+    state.update_backup_job(job["id"], stage="uploaded", error=None)
+    logger.info(f"Uploaded backup file {path} to S3")
+
+    if meta.get("binlog_end"):
+        incremental_backup.save_binlog_position(config, tuple(meta["binlog_end"]))
+    pitr.record_entry(config, key + "/" if os.path.isdir(path) else key, meta.get("log_entry"))
+    remove_local(path)
+    return path
+
+
+def resume_backup_job(config, job, state):
+    """Resume a job found in the journal; returns the local path it uploaded, or None if it was abandoned"""
+    path, meta = job["path"], job["meta"]
+    if job["stage"] == "dumping":
+        # The dump itself never finished, nothing worth keeping
+        logger.warning(f"Backup job {job['id']} stopped while dumping, discarding it")
+        state.update_backup_job(job["id"], stage="abandoned")
+        return None
+    if job["stage"] == "dumped" and (meta.get("compress") or meta.get("encrypt")) and not os.path.exists(path):
+        # Compression finished (it removes the original) but the stage was not recorded
+        compressed = (path + (extension(resolve_codec(meta.get("codec"))[0]) if meta.get("compress") else "")
+                      + (ENCRYPTED_EXTENSION if meta.get("encrypt") else ""))
+        if os.path.exists(compressed):
+            job = dict(job, stage="compressed", path=compressed)
+    if not os.path.exists(job["path"]):
+        logger.warning(f"Local files of backup job {job['id']} are gone, discarding it")
+        state.update_backup_job(job["id"], stage="abandoned")
+        return None
+    logger.info(f"Resuming backup job {job['id']} ({job['path']}) after stage {job['stage']}")
+    return complete_backup_job(config, job, state)
@@ -0,0 +1,17 @@
+import json
+import os
+from datetime import datetime
+
+MANIFEST_NAME = "manifest.json"
+
+def write_manifest(directory, manifest):
+    """Write manifest.json into a backup directory and return its path"""
+    manifest.setdefault("created_at", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=4, default=str)
+    return path
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST_NAME)) as f:
+        return json.load(f)
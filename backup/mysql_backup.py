@@ -1,17 +1,40 @@
 import os
-import gzip
-import shutil
+import re
 from utils.logger import logger
 from pathlib import Path
-from utils.docker_helper import find_running_container, run_command_with_fallback
+from utils.docker_helper import (find_running_container, run_command_with_fallback,
+                                 start_command_with_fallback, iter_command_output)
+from utils.compression import (compress_chunks, compress_file, decompress_chunks, detect_codec, open_compressed,
+                               resolve_codec, extension)
+from backup.manifest import write_manifest
+from backup import dedup
+from backup.incremental_backup import get_last_binlog_position, source_data_option
+from s3 import uploader
+from utils import metrics, throttle
+from utils.db_pool import server_capabilities
 
-def backup(config, date, tables=None, schema_only=False, data_only=False, compress=False):
+BINLOG_POSITION = re.compile(rb"_LOG_FILE='([^']+)',\s*\w+_LOG_POS=(\d+)")
+# The coordinates come right after the dump header, so the first block is enough
+POSITION_HEAD = 64 * 1024
+# Views, triggers, routines and events of a per-table backup
+SCHEMA_OBJECTS_NAME = "_schema_objects.sql"
+
+def is_pitr_base(config, tables=None, schema_only=False, data_only=False):
+    """
+    Whether a dump records its binlog coordinates and becomes a point-in-time recovery
+    base: every complete dump of a server that writes binlogs, unless `mysql.pitr: false`.
+    """
+    if tables or schema_only or data_only or config["mysql"].get("pitr") is False:
+        return False
+    try:
+        return server_capabilities(config, "mysql")["log_bin"]
+    except Exception as e:
+        logger.warning(f"Could not check whether MySQL writes binlogs, not recording a recovery base: {e}")
+        return False
+
+def _build_dump_command(config, tables=None, schema_only=False, data_only=False):
     my = config["mysql"]
     db = my["database"]
-    tmp_dir = Path(os.getenv("TMP", os.getenv("TEMP", "/tmp")))
-    backup_filename = f"mysql_backup_{date}.sql"
-    file_path = tmp_dir / backup_filename
-
     cmd = [
         "mysqldump",
         "-h", my["host"],
@@ -27,28 +50,122 @@ def backup(config, date, tables=None, schema_only=False, data_only=False, compre
         cmd.append("--no-data")
     if data_only:
         cmd.append("--no-create-info")
+    if is_pitr_base(config, tables, schema_only, data_only):
+        # Consistent snapshot with its binlog coordinates, so the dump can be a point-in-time recovery base
+        cmd[1:1] = ["--single-transaction", source_data_option(config)]
+    return cmd
+
+def backup(config, date, tables=None, schema_only=False, data_only=False, compress=False,
+           codec=None, level=None, threads=1):
+    my = config["mysql"]
+    tmp_dir = Path(os.getenv("TMP", os.getenv("TEMP", "/tmp")))
+    backup_filename = f"mysql_backup_{date}.sql"
+    file_path = tmp_dir / backup_filename
+
+    cmd = _build_dump_command(config, tables, schema_only, data_only)
 
     # Find fallback Docker container (optional)
-    container = find_running_container("mysql")
+    container = find_running_container("mysql", config)
 
     # Run mysqldump with fallback
-    success = run_command_with_fallback(cmd, file_path, fallback_container=container)
-
-    if not success:
-        raise Exception("mysqldump failed")
+    with metrics.stage("dump", db="mysql") as stage:
+        success = run_command_with_fallback(throttle.prioritized(cmd, config), file_path, fallback_container=container,
+                                            bucket=throttle.dump_bucket(config, "mysql"))
+        if not success:
+            raise Exception("mysqldump failed")
+        stage.bytes_out = os.path.getsize(file_path)
 
     logger.info(f"Backup successful: {file_path}")
 
     if compress:
-        compressed_path = file_path.with_suffix(file_path.suffix + ".gz")
-        with open(file_path, 'rb') as f_in, gzip.open(compressed_path, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-        os.remove(file_path)
+        compressed_path = compress_file(file_path, codec, level, threads)
         logger.info(f"Compressed to: {compressed_path}")
         return compressed_path
 
     return file_path
 
+def dump_binlog_position(file_path):
+    """Binlog (file, position) that a mysqldump taken with --source-data/--master-data recorded, or None"""
+    with open(file_path, "rb") as f:
+        head = b"".join(decompress_chunks([f.read(POSITION_HEAD)], detect_codec(str(file_path))))
+    return _parse_binlog_position(head)
+
+def _parse_binlog_position(head):
+    match = BINLOG_POSITION.search(head)
+    if not match:
+        return None
+    return match[1].decode(), int(match[2])
+
+def _capture_binlog_position(chunks, found):
+    """Pass dump output through, storing the binlog coordinates from its header in found["position"]"""
+    head = b""
+    for chunk in chunks:
+        if len(head) < POSITION_HEAD:
+            head += chunk[:POSITION_HEAD - len(head)]
+            if len(head) >= POSITION_HEAD:
+                found["position"] = _parse_binlog_position(head)
+        yield chunk
+    if "position" not in found:
+        found["position"] = _parse_binlog_position(head)
+
+def _record_base(config, key, found):
+    """Index a streamed or dedup full backup as a point-in-time recovery base"""
+    from backup import pitr
+
+    if found.get("position"):
+        pitr.record_entry(config, key, pitr.base_entry(config, key, found["position"]))
+    else:
+        logger.warning(f"{key} has no binlog coordinates and cannot be a point-in-time recovery base")
+
+def _start_dump(config, tables=None, schema_only=False, data_only=False):
+    """Start mysqldump and return a generator over its stdout"""
+    cmd = _build_dump_command(config, tables, schema_only, data_only)
+    container = find_running_container("mysql", config)
+    proc = start_command_with_fallback(throttle.prioritized(cmd, config), fallback_container=container)
+    return throttle.throttled(iter_command_output(proc), throttle.dump_bucket(config, "mysql"))
+
+def backup_stream(config, date, tables=None, schema_only=False, data_only=False, compress=False,
+                  codec=None, level=None, threads=1):
+    """Pipe mysqldump output (optionally compressed in flight) straight into S3, returns the object key"""
+    codec, level = resolve_codec(codec, level)
+    key = f"mysql_backup_{date}.sql" + (extension(codec) if compress else "")
+    output = _start_dump(config, tables, schema_only, data_only)
+    base = is_pitr_base(config, tables, schema_only, data_only)
+    found = {}
+
+    # Dump, compression and upload overlap, so they are timed as one stage
+    with metrics.stage("stream", db="mysql") as stage:
+        raw = metrics.counted(_capture_binlog_position(output, found) if base else output, stage, "bytes_in")
+        chunks = compress_chunks(raw, codec, level, threads) if compress else raw
+        try:
+            key = uploader.upload_stream(metrics.counted(chunks, stage, "bytes_out"), key, config)
+        except Exception as e:
+            raise Exception(f"mysqldump stream failed: {e}")
+        finally:
+            # Makes sure the dump process is reaped even if the upload gave up early
+            output.close()
+
+    logger.info(f"Streamed backup successful: {key}")
+    if base:
+        _record_base(config, key, found)
+    return key
+
+def backup_dedup(config, date, tables=None, schema_only=False, data_only=False, codec=None, level=None):
+    """Store the mysqldump stream as deduplicated chunks, returns the manifest key"""
+    output = _start_dump(config, tables, schema_only, data_only)
+    base = is_pitr_base(config, tables, schema_only, data_only)
+    found = {}
+    try:
+        key = dedup.store_stream(_capture_binlog_position(output, found) if base else output,
+                                 f"mysql_backup_{date}.sql", config, codec, level)
+    except Exception as e:
+        raise Exception(f"mysqldump dedup backup failed: {e}")
+    finally:
+        output.close()
+    if base:
+        _record_base(config, key, found)
+    return key
+
 def backup_incremental(config):
     my = config["mysql"]
     log_file, _ = get_last_binlog_position(config)
@@ -65,7 +182,7 @@ def backup_incremental(config):
         log_file
     ]
 
-    container = find_running_container("mysql")
+    container = find_running_container("mysql", config)
 
     # Run mysqldump with fallback
     success = run_command_with_fallback(cmd, output_path, fallback_container=container)
@@ -77,32 +194,238 @@ def backup_incremental(config):
 
     return output_path
 
-def get_last_binlog_position(config):
-    my = config["mysql"]
-    file_path = "/tmp/show_master_status.txt"
-    cmd = [
-        "mysql",
-        f"-h{my['host']}",
-        f"-P{my['port']}",
-        f"-u{my['user']}",
-        f"-p{my['password']}",
-        "-e", "SHOW MASTER STATUS;"
-    ]
+def _sql_literal(converter, value):
+    if value is None:
+        return b"NULL"
+    return converter.quote(converter.escape(converter.to_mysql(value)))
 
-    container = find_running_container("mysql")
-    success = run_command_with_fallback(cmd, file_path, fallback_container=container)
+def _connect(my):
+    import mysql.connector
+    return mysql.connector.connect(
+        host=my["host"],
+        port=int(my["port"]),
+        user=my["user"],
+        password=my["password"],
+        database=my["database"],
+        use_pure=True
+    )
 
-    if not success:
-        raise Exception("SHOW MASTER STATUS failed")
+def _open_snapshot_connections(my, jobs):
+    """
+    Open `jobs` connections that all see the same consistent snapshot.
+
+    A global read lock is held while every worker starts its transaction, so no
+    write can land between the first and the last snapshot.
+    """
+    coordinator = _connect(my)
+    connections = []
+    binlog = None
+    try:
+        cursor = coordinator.cursor()
+        cursor.execute("FLUSH TABLES WITH READ LOCK")
+        for _ in range(jobs):
+            conn = _connect(my)
+            worker_cursor = conn.cursor()
+            worker_cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            worker_cursor.execute("SET SESSION time_zone = '+00:00'")
+            worker_cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+            worker_cursor.close()
+            connections.append(conn)
+        # Binlog coordinates of the snapshot, useful for point-in-time recovery
+        for statement in ("SHOW BINARY LOG STATUS", "SHOW MASTER STATUS"):
+            try:
+                cursor.execute(statement)
+                row = cursor.fetchone()
+                if row:
+                    binlog = {"file": row[0], "position": row[1]}
+                break
+            except Exception:
+                continue
+        cursor.execute("UNLOCK TABLES")
+        cursor.close()
+    except Exception:
+        for conn in connections:
+            conn.close()
+        raise
+    finally:
+        coordinator.close()
+    return connections, binlog
+
+def _text(value):
+    # SHOW and information_schema queries may return bytes columns
+    return value.decode() if isinstance(value, (bytes, bytearray)) else value
+
+def _insertable_columns(cursor, table):
+    """Columns of a table that take values on insert: generated columns are computed by the server"""
+    cursor.execute("SELECT COLUMN_NAME, EXTRA FROM information_schema.COLUMNS "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION", (table,))
+    columns = [(_text(name), _text(extra).upper()) for name, extra in cursor.fetchall()]
+    return [name for name, extra in columns if "VIRTUAL GENERATED" not in extra and "STORED GENERATED" not in extra]
+
+def _dump_table(conn, table, file_path, schema_only, data_only, codec=None, level=None, batch_bytes=1024 * 1024,
+                bucket=None, stage=None):
+    from mysql.connector.conversion import MySQLConverter
+
+    converter = MySQLConverter("utf8mb4")
+    rows = 0
+    cursor = conn.cursor()
+    with (open_compressed(file_path, codec, level) if codec else open(file_path, "wb")) as f:
+        f.write(b"SET NAMES utf8mb4;\nSET time_zone = '+00:00';\nSET FOREIGN_KEY_CHECKS = 0;\n")
+        if not data_only:
+            cursor.execute(f"SHOW CREATE TABLE `{table}`")
+            create_sql = cursor.fetchone()[1]
+            f.write(f"DROP TABLE IF EXISTS `{table}`;\n{create_sql};\n".encode())
+        if not schema_only:
+            column_list = ",".join(f"`{c}`" for c in _insertable_columns(cursor, table))
+            cursor.execute(f"SELECT {column_list} FROM `{table}`")
+            prefix = f"INSERT INTO `{table}` ({column_list}) VALUES ".encode()
+            values = []
+            size = 0
+            for row in cursor:
+                value = b"(" + b",".join(_sql_literal(converter, v) for v in row) + b")"
+                values.append(value)
+                size += len(value)
+                rows += 1
+                if size >= batch_bytes:
+                    if bucket is not None:
+                        # Not fetching more rows until the rate allows slows the server-side scan
+                        stage.add_throttled(bucket.consume(size))
+                    f.write(prefix + b",".join(values) + b";\n")
+                    values, size = [], 0
+            if values:
+                f.write(prefix + b",".join(values) + b";\n")
+        f.write(b"SET FOREIGN_KEY_CHECKS = 1;\n")
+    cursor.close()
+    return rows
+
+def _ordered_views(database, definitions):
+    """View names ordered so that every view comes after the views its definition selects from"""
+    ordered, pending = [], dict(definitions)
+    while pending:
+        ready = [name for name, sql in pending.items()
+                 if not any(f"`{database}`.`{other}`" in sql for other in pending if other != name)]
+        # A dependency cycle cannot be created in MySQL; this only guards against a misparse
+        for name in ready or list(pending):
+            ordered.append(name)
+            del pending[name]
+    return ordered
+
+def _dump_schema_objects(conn, database, file_path, codec=None, level=None):
+    """
+    Write the views, triggers, stored routines and events of the database, which the
+    per-table files do not carry, as one script; returns how many of each it holds.
+    Restored after all tables, since each of them refers to tables.
+    """
+    cursor = conn.cursor()
+    counts = {}
+    with (open_compressed(file_path, codec, level) if codec else open(file_path, "wb")) as f:
+        f.write(b"SET NAMES utf8mb4;\nSET time_zone = '+00:00';\n")
+
+        cursor.execute("SHOW FULL TABLES WHERE Table_type = 'VIEW'")
+        views = {}
+        for row in cursor.fetchall():
+            name = _text(row[0])
+            cursor.execute(f"SHOW CREATE VIEW `{name}`")
+            views[name] = _text(cursor.fetchone()[1])
+        for name in _ordered_views(database, views):
+            f.write(f"DROP VIEW IF EXISTS `{name}`;\n{views[name]};\n".encode())
+        counts["views"] = len(views)
+
+        # Bodies contain semicolons, so these go in with mysqldump's `;;` delimiter and
+        # under the sql_mode they were created with
+        f.write(b"SET @saved_sql_mode = @@SESSION.sql_mode;\nDELIMITER ;;\n")
+        # (kind, listing, name column in the listing, definition column of SHOW CREATE)
+        kinds = (
+            ("TRIGGER", "SHOW TRIGGERS", 0, 2),
+            ("PROCEDURE", "SHOW PROCEDURE STATUS WHERE Db = DATABASE()", 1, 2),
+            ("FUNCTION", "SHOW FUNCTION STATUS WHERE Db = DATABASE()", 1, 2),
+            ("EVENT", "SHOW EVENTS", 1, 3),
+        )
+        for kind, listing, name_column, sql_column in kinds:
+            cursor.execute(listing)
+            names = [_text(row[name_column]) for row in cursor.fetchall()]
+            for name in names:
+                cursor.execute(f"SHOW CREATE {kind} `{name}`")
+                row = cursor.fetchone()
+                # SHOW CREATE returns the sql_mode right after the name
+                f.write(f"SET SESSION sql_mode = '{_text(row[1])}';;\n"
+                        f"DROP {kind} IF EXISTS `{name}`;;\n{_text(row[sql_column])};;\n".encode())
+            counts[kind.lower() + "s"] = len(names)
+        f.write(b"DELIMITER ;\nSET SESSION sql_mode = @saved_sql_mode;\n")
+    cursor.close()
+    return counts
+
+def backup_parallel(config, date, jobs, tables=None, schema_only=False, data_only=False, compress=False,
+                    codec=None, level=None):
+    """
+    Dump every table to its own file from one consistent snapshot using `jobs` workers,
+    plus, for a complete backup, the views, triggers, routines and events; returns the directory.
+    """
+    import queue
+    from concurrent.futures import ThreadPoolExecutor
+
+    my = config["mysql"]
+    tmp_dir = Path(os.getenv("TMP", os.getenv("TEMP", "/tmp")))
+    dump_dir = tmp_dir / f"mysql_backup_{date}"
+    codec, level = resolve_codec(codec, level) if compress else (None, None)
+    os.makedirs(dump_dir, exist_ok=True)
+
+    bucket = throttle.dump_bucket(config, "mysql")
+    connections, binlog = _open_snapshot_connections(my, jobs)
+    idle = queue.Queue()
+    for conn in connections:
+        idle.put(conn)
 
     try:
-        with open(file_path) as f:
-            lines = f.read().strip().split('\n')
-            if len(lines) < 2:
-                raise Exception("Unexpected result from SHOW MASTER STATUS")
+        cursor = connections[0].cursor()
+        cursor.execute("SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'")
+        all_tables = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        if tables:
+            missing = set(tables) - set(all_tables)
+            if missing:
+                raise Exception(f"Tables not found: {', '.join(sorted(missing))}")
+            all_tables = [t for t in all_tables if t in tables]
+
+        def worker(table):
+            conn = idle.get()
+            try:
+                file_name = f"{table}.sql" + (extension(codec) if codec else "")
+                file_path = dump_dir / file_name
+                rows = _dump_table(conn, table, file_path, schema_only, data_only, codec, level,
+                                   bucket=bucket, stage=stage)
+                logger.info(f"Dumped table {table} ({rows} rows)")
+                return {"name": table, "file": file_name, "rows": rows, "bytes": os.path.getsize(file_path)}
+            finally:
+                idle.put(conn)
 
-            parts = lines[1].split('\t')
-            return parts[0], parts[1]  # log_file, log_pos
+        with metrics.stage("dump", db="mysql", jobs=jobs) as stage, ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(worker, all_tables))
+            stage.bytes_out = sum(r["bytes"] for r in results)
+
+        schema_objects = None
+        if not (tables or data_only):
+            # Read on a snapshot connection too, so they match the tables
+            file_name = SCHEMA_OBJECTS_NAME + (extension(codec) if codec else "")
+            counts = _dump_schema_objects(connections[0], my["database"], dump_dir / file_name, codec, level)
+            schema_objects = dict(counts, file=file_name, bytes=os.path.getsize(dump_dir / file_name))
+            logger.info("Dumped schema objects: " + ", ".join(f"{n} {kind}" for kind, n in counts.items()))
     finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
\ No newline at end of file
+        for conn in connections:
+            conn.close()
+
+    write_manifest(dump_dir, {
+        "db": "mysql",
+        "database": my["database"],
+        "format": "per-table",
+        "date": date,
+        "jobs": jobs,
+        "compressed": compress,
+        "codec": codec,
+        "binlog": binlog,
+        "tables": results,
+        "schema_objects": schema_objects,
+    })
+
+    logger.info(f"Parallel backup successful: {dump_dir}")
+    return dump_dir
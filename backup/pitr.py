@@ -0,0 +1,206 @@
+import os
+import re
+import tempfile
+from datetime import datetime
+from utils.logger import logger
+from utils.compression import ENCRYPTED_EXTENSION, CODECS, decompress_chunks, detect_codec
+from utils.docker_helper import command_exists, start_command_with_fallback, iter_command_output
+from s3 import catalog, downloader
+from backup import restore
+from backup.manifest import read_manifest
+from backup.mysql_backup import dump_binlog_position
+from backup.incremental_backup import EVENT_HEADER, BOOKKEEPING_EVENTS, TIME_FORMAT, event_time, binlog_server_id
+
+AT_LINE = re.compile(rb"# at (\d+)\s*$")
+ROTATE = re.compile(rb"\tRotate to (\S+)\s+pos: (\d+)")
+# Ends the transaction an early stop may have cut in half; mysqlbinlog's delimiter is still active
+STOP_FOOTER = b"ROLLBACK /*!*/;\nDELIMITER ;\n"
+OUTPUT_BLOCK = 1024 * 1024
+
+
+def full_backup_entry(config, path):
+    """Log index entry of a local MySQL full backup, or None when it recorded no snapshot binlog position"""
+    if os.path.isdir(path):
+        binlog = read_manifest(path).get("binlog")
+        position = (binlog["file"], int(binlog["position"])) if binlog else None
+    else:
+        position = dump_binlog_position(path)
+    if not position:
+        return None
+    return base_entry(config, path, position)
+
+
+def base_entry(config, name, position):
+    """Log index entry of a MySQL full backup (local path or key) taken at binlog (file, position)"""
+    timestamp = catalog.parse_backup_key(os.path.basename(os.path.normpath(str(name))))[2]
+    return {
+        "kind": "full",
+        "server": binlog_server_id(config),
+        "target": config["mysql"].get("target"),
+        "start_time": timestamp,
+        "end_time": timestamp,
+        "start_file": position[0],
+        "start_pos": position[1],
+        "end_file": position[0],
+        "end_pos": position[1],
+    }
+
+
+def record_entry(config, key, entry):
+    # Like the catalog, the index must not fail a backup that is already safely uploaded
+    if not entry:
+        return
+    try:
+        catalog.record_log_entry(config, key, entry)
+    except Exception as e:
+        logger.warning(f"Could not index {key} for point-in-time recovery: {e}")
+
+
+def _start(entry):
+    return entry["start_file"], entry["start_pos"]
+
+
+def _end(entry):
+    return entry["end_file"], entry["end_pos"]
+
+
+def _chain(base, segments, to):
+    """Binlog segments continuing from base up to `to`, and the time the index covers them until"""
+    position = _end(base)
+    covered_until = base["end_time"]
+    chain = []
+    while covered_until < to:
+        candidates = [s for s in segments if _start(s) <= position < _end(s)]
+        if not candidates:
+            return None, covered_until
+        # A capture retried after a failed upload may overlap an earlier one; take the longest
+        segment = max(candidates, key=_end)
+        if segment["start_time"] > to:
+            # Nothing changed between the base (or the last segment) and `to`
+            break
+        chain.append(segment)
+        covered_until = segment["end_time"]
+        position = _end(segment)
+    return chain, covered_until
+
+
+def plan(config, to, target=None):
+    """
+    The minimal chain that recovers the MySQL server to `to` (a datetime, local time):
+    the newest indexed full backup taken at or before it and the binlog incrementals that
+    continue from its position until one captured at or after `to`.
+    """
+    to = to.strftime(TIME_FORMAT)
+    entries = catalog.log_entries(config, binlog_server_id(config))
+    fulls = sorted((e for e in entries if e["kind"] == "full" and e["target"] == target and e["end_time"] <= to),
+                   key=lambda e: e["end_time"], reverse=True)
+    if not fulls:
+        raise Exception(f"No indexed full backup of {target or 'mysql'} taken at or before {to}")
+    segments = [e for e in entries if e["kind"] == "binlog"]
+
+    latest_cover = None
+    for base in fulls:
+        chain, covered_until = _chain(base, segments, to)
+        if chain is not None:
+            return {"base": base, "logs": chain, "stop_time": to}
+        latest_cover = latest_cover or covered_until
+    raise Exception(f"Binlog incrementals after the newest full backup only reach {latest_cover}, not {to}")
+
+
+def _lines(chunks):
+    tail = b""
+    for chunk in chunks:
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if tail:
+        yield tail
+
+
+def slice_binlog_sql(chunks, first_file, start=None, stop_time=None):
+    """
+    Cut mysqlbinlog SQL output down to the events at or after binlog position `start`
+    (a (file, position) pair) and no later than `stop_time` (a datetime). Format
+    description events always pass: the row events after them cannot be applied without.
+    """
+    current_file = first_file
+    skipping = False
+    pending = None
+    output = []
+    size = 0
+    for line in _lines(chunks):
+        if pending is not None:
+            at_line, at_pos = pending
+            pending = None
+            header = EVENT_HEADER.match(line)
+            if header:
+                kind = header[3]
+                if stop_time and kind not in BOOKKEEPING_EVENTS and event_time(header) > stop_time:
+                    output.append(STOP_FOOTER)
+                    break
+                skipping = start is not None and kind != b"Start" and (current_file, at_pos) < start
+                rotate = ROTATE.search(line)
+                if rotate:
+                    current_file = rotate[1].decode()
+            if not skipping:
+                output.append(at_line)
+                output.append(line)
+                size += len(at_line) + len(line)
+        else:
+            at = AT_LINE.match(line)
+            if at:
+                pending = (line, int(at[1]))
+                continue
+            if not skipping:
+                output.append(line)
+                size += len(line)
+        if size >= OUTPUT_BLOCK:
+            yield b"".join(output)
+            output = []
+            size = 0
+    if output:
+        yield b"".join(output)
+
+
+def is_raw_binlog(key):
+    """Whether a binlog incremental holds raw binlog (shipped by the binlog daemon) rather than SQL"""
+    name = key[:-len(ENCRYPTED_EXTENSION)] if key.endswith(ENCRYPTED_EXTENSION) else key
+    codec = detect_codec(name)
+    if codec:
+        name = name[:-len(CODECS[codec])]
+    return name.endswith(".bin")
+
+
+def _decode_raw_binlog(config, key):
+    """mysqlbinlog SQL output of a raw binlog incremental"""
+    if not command_exists("mysqlbinlog"):
+        raise Exception(f"Replaying {key} needs a local mysqlbinlog")
+    # mysqlbinlog only reads binlog files, not stdin
+    with tempfile.NamedTemporaryFile(suffix=".bin") as f:
+        for chunk in decompress_chunks(downloader.iter_backup(config, key), detect_codec(key)):
+            f.write(chunk)
+        f.flush()
+        yield from iter_command_output(start_command_with_fallback(["mysqlbinlog", f.name]))
+
+
+def replay(config, recovery_plan):
+    """Restore the plan's base backup, then apply its binlog incrementals up to the stop time"""
+    base = recovery_plan["base"]
+    logs = recovery_plan["logs"]
+    stop_time = datetime.strptime(recovery_plan["stop_time"], TIME_FORMAT)
+    restore.restore(config, base["key"])
+
+    for number, segment in enumerate(logs, 1):
+        key = segment["key"]
+        if is_raw_binlog(key):
+            chunks = _decode_raw_binlog(config, key)
+        else:
+            chunks = decompress_chunks(downloader.iter_backup(config, key), detect_codec(key))
+        first, last = number == 1, number == len(logs)
+        if first or last:
+            chunks = slice_binlog_sql(chunks, segment["start_file"], _end(base) if first else None,
+                                      stop_time if last else None)
+        logger.info(f"Applying binlog incremental {number} of {len(logs)}: {key}")
+        restore.pipe_into_client(config, "mysql", chunks)
+    logger.info(f"Point-in-time recovery to {recovery_plan['stop_time']} completed")
@@ -1,18 +1,18 @@
 import subprocess
 import os
-import gzip
-import shutil
 from pathlib import Path
 from utils.logger import logger
-from utils.docker_helper import find_running_container, run_command_with_fallback
+from utils.docker_helper import (find_running_container, run_command_with_fallback, command_exists,
+                                 run_command_with_fallback_without_file,
+                                 start_command_with_fallback, iter_command_output)
+from utils.compression import compress_chunks, compress_file, resolve_codec, extension, CODECS
+from backup.manifest import write_manifest
+from backup import dedup
+from s3 import uploader
+from utils import metrics, throttle
 
-def backup(config, date, tables=None, schema_only=False, data_only=False, compress=False):
-    pg = config["postgres"]
+def _build_dump_command(pg, tables=None, schema_only=False, data_only=False):
     db = pg["database"]
-    tmp_dir = Path(os.getenv("TMP", os.getenv("TEMP", "/tmp")))
-    backup_filename = f"postgres_backup_{date}.sql"
-    file_path = tmp_dir / backup_filename
-
     cmd = [
         "pg_dump",
         "-h", pg["host"],
@@ -28,28 +28,160 @@ def backup(config, date, tables=None, schema_only=False, data_only=False, compre
         cmd.append("--schema-only")
     if data_only:
         cmd.append("--data-only")
+    return cmd
 
+def _dump_env(pg):
     # Set PGPASSWORD for authentication
     env = os.environ.copy()
     env["PGPASSWORD"] = pg["password"]
+    return env
+
+def backup(config, date, tables=None, schema_only=False, data_only=False, compress=False,
+           codec=None, level=None, threads=1):
+    pg = config["postgres"]
+    tmp_dir = Path(os.getenv("TMP", os.getenv("TEMP", "/tmp")))
+    backup_filename = f"postgres_backup_{date}.sql"
+    file_path = tmp_dir / backup_filename
+
+    cmd = _build_dump_command(pg, tables, schema_only, data_only)
+    env = _dump_env(pg)
 
     # Detect running postgres Docker container
-    container = find_running_container("postgres")
+    container = find_running_container("postgres", config)
 
     # Run pg_dump with fallback logic
-    success = run_command_with_fallback(cmd, file_path, env=env, fallback_container=container)
-
-    if not success:
-        raise Exception("pg_dump failed")
+    with metrics.stage("dump", db="postgres") as stage:
+        success = run_command_with_fallback(throttle.prioritized(cmd, config), file_path, env=env,
+                                            fallback_container=container, bucket=throttle.dump_bucket(config, "postgres"))
+        if not success:
+            raise Exception("pg_dump failed")
+        stage.bytes_out = os.path.getsize(file_path)
 
     logger.info(f"Backup successful: {file_path}")
 
     if compress:
-        compressed_path = file_path.with_suffix(file_path.suffix + ".gz")
-        with open(file_path, 'rb') as f_in, gzip.open(compressed_path, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-        os.remove(file_path)
+        compressed_path = compress_file(file_path, codec, level, threads)
         logger.info(f"Compressed to: {compressed_path}")
         return compressed_path
 
     return file_path
+
+def _start_dump(config, tables=None, schema_only=False, data_only=False):
+    """Start pg_dump and return a generator over its stdout"""
+    pg = config["postgres"]
+    cmd = _build_dump_command(pg, tables, schema_only, data_only)
+    container = find_running_container("postgres", config)
+    proc = start_command_with_fallback(throttle.prioritized(cmd, config), env=_dump_env(pg), fallback_container=container)
+    return throttle.throttled(iter_command_output(proc), throttle.dump_bucket(config, "postgres"))
+
+def backup_stream(config, date, tables=None, schema_only=False, data_only=False, compress=False,
+                  codec=None, level=None, threads=1):
+    """Pipe pg_dump output (optionally compressed in flight) straight into S3, returns the object key"""
+    codec, level = resolve_codec(codec, level)
+    key = f"postgres_backup_{date}.sql" + (extension(codec) if compress else "")
+    output = _start_dump(config, tables, schema_only, data_only)
+
+    # Dump, compression and upload overlap, so they are timed as one stage
+    with metrics.stage("stream", db="postgres") as stage:
+        raw = metrics.counted(output, stage, "bytes_in")
+        chunks = compress_chunks(raw, codec, level, threads) if compress else raw
+        try:
+            key = uploader.upload_stream(metrics.counted(chunks, stage, "bytes_out"), key, config)
+        except Exception as e:
+            raise Exception(f"pg_dump stream failed: {e}")
+        finally:
+            # Makes sure the dump process is reaped even if the upload gave up early
+            output.close()
+
+    logger.info(f"Streamed backup successful: {key}")
+    return key
+
+def backup_dedup(config, date, tables=None, schema_only=False, data_only=False, codec=None, level=None):
+    """Store the pg_dump stream as deduplicated chunks, returns the manifest key"""
+    output = _start_dump(config, tables, schema_only, data_only)
+    try:
+        return dedup.store_stream(output, f"postgres_backup_{date}.sql", config, codec, level)
+    except Exception as e:
+        raise Exception(f"pg_dump dedup backup failed: {e}")
+    finally:
+        output.close()
+
+def _list_table_files(dump_dir):
+    """Map each TABLE DATA entry of a directory-format dump to its data file"""
+    if not command_exists("pg_restore"):
+        return []
+    output = run_command_with_fallback_without_file(["pg_restore", "-l", str(dump_dir)])
+    if not output:
+        return []
+
+    files = set(os.listdir(dump_dir))
+    tables = []
+    for line in output.splitlines():
+        # e.g. "3345; 0 16390 TABLE DATA public employees postgres"
+        if line.startswith(";") or " TABLE DATA " not in line:
+            continue
+        dump_id = line.split(";", 1)[0].strip()
+        parts = line.split(" TABLE DATA ", 1)[1].split()
+        candidates = [f"{dump_id}.dat"] + [f"{dump_id}.dat{ext}" for ext in CODECS.values()]
+        data_file = next((f for f in candidates if f in files), None)
+        if data_file and len(parts) >= 2:
+            tables.append({"name": f"{parts[0]}.{parts[1]}", "file": data_file,
+                           "bytes": os.path.getsize(os.path.join(dump_dir, data_file))})
+    return tables
+
+def backup_parallel(config, date, jobs, tables=None, schema_only=False, data_only=False, compress=False,
+                    codec=None, level=None):
+    """Dump with pg_dump's directory format using `jobs` worker connections, returns the directory"""
+    pg = config["postgres"]
+    tmp_dir = Path(os.getenv("TMP", os.getenv("TEMP", "/tmp")))
+    dir_name = f"postgres_backup_{date}"
+    dump_dir = tmp_dir / dir_name
+
+    cmd = _build_dump_command(pg, tables, schema_only, data_only)
+    cmd += ["-F", "d", "-j", str(jobs)]
+    if compress:
+        codec, level = resolve_codec(codec, level)
+        # pg_dump compresses each table file itself; zstd and lz4 need PostgreSQL 16+
+        cmd += ["-Z", str(level) if codec == "gzip" else f"{codec}:{level}"]
+    else:
+        codec = None
+        cmd += ["-Z", "0"]
+
+    env = _dump_env(pg)
+    container = find_running_container("postgres", config)
+    if throttle.dump_bucket(config, "postgres"):
+        logger.warning("pg_dump writes directory-format dumps itself; only nice and ionice apply to them")
+
+    with metrics.stage("dump", db="postgres", jobs=jobs) as stage:
+        if container:
+            # The directory is written inside the container, then copied out
+            remote_dir = f"/tmp/{dir_name}"
+            result = run_command_with_fallback_without_file(
+                ["env", f"PGPASSWORD={pg['password']}"] + throttle.prioritized(cmd + ["-f", remote_dir], config),
+                fallback_container=container)
+            if result is None:
+                raise Exception("pg_dump failed")
+            subprocess.run(["docker", "cp", f"{container}:{remote_dir}", str(dump_dir)], check=True)
+            subprocess.run(["docker", "exec", container, "rm", "-rf", remote_dir])
+        else:
+            result = subprocess.run(throttle.prioritized(cmd + ["-f", str(dump_dir)], config), stderr=subprocess.PIPE,
+                                    text=True, env=env)
+            if result.returncode != 0:
+                logger.error(f"Command failed: {result.stderr}")
+                raise Exception("pg_dump failed")
+        stage.bytes_out = sum(os.path.getsize(os.path.join(dump_dir, f)) for f in os.listdir(dump_dir))
+
+    write_manifest(dump_dir, {
+        "db": "postgres",
+        "database": pg["database"],
+        "format": "directory",
+        "date": date,
+        "jobs": jobs,
+        "compressed": compress,
+        "codec": codec,
+        "tables": _list_table_files(dump_dir),
+        "files": sorted(os.listdir(dump_dir)),
+    })
+
+    logger.info(f"Parallel backup successful: {dump_dir}")
+    return dump_dir
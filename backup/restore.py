@@ -0,0 +1,227 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from utils.logger import logger
+from utils.compression import ENCRYPTED_EXTENSION, decompress_chunks, detect_codec
+from utils.docker_helper import (find_running_container, run_command_with_fallback_without_file,
+                                 start_input_command_with_fallback, feed_command)
+from utils import metrics
+from s3 import catalog, downloader, uploader
+from s3.client import get_client, get_max_concurrency
+from backup.manifest import MANIFEST_NAME
+from backup import dedup
+
+
+def _locate(config, key):
+    """The key as stored in S3: a file key, or a directory prefix ending in '/'"""
+    s3 = get_client(config)
+    bucket = config["s3"]["bucket"]
+    if not key.endswith("/"):
+        listing = s3.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1)
+        if any(obj["Key"] == key for obj in listing.get("Contents", [])):
+            return key
+    prefix = key.rstrip("/") + "/"
+    if s3.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=1).get("KeyCount"):
+        return prefix
+    raise Exception(f"Backup {key} not found in S3 bucket {config['s3']['bucket']}")
+
+
+def resolve_backup(config, key=None, db=None, target=None):
+    """
+    The key of the backup to restore: `key` itself once S3 confirms it exists, otherwise
+    the newest full backup of db (and target) in the catalog.
+    """
+    if key:
+        if catalog.parse_backup_key(key)[0] is None:
+            raise Exception(f"{key} is not a backup key")
+        return _locate(config, key)
+    if not db:
+        raise Exception("Give a backup key or the database to restore the latest backup of")
+    backups = [b for b in uploader.list_backups(config, db_filter=db, backup_type="full", target=target)
+               if b["target"] == target]
+    if not backups:
+        raise Exception(f"No full backup of {target or db} found")
+    return backups[0]["key"]
+
+
+def _client_command(db, conf):
+    if db == "mysql":
+        return ["mysql", "-h", conf["host"], "-P", str(conf["port"]), "-u", conf["user"],
+                f"-p{conf['password']}", conf["database"]]
+    return ["psql", "-h", conf["host"], "-p", str(conf["port"]), "-U", conf["user"], "-d", conf["database"],
+            "-q", "-v", "ON_ERROR_STOP=1"]
+
+
+def _with_password(db, conf, cmd, container):
+    """(cmd, env) for a PostgreSQL client; inside a container the password goes on the command line via env"""
+    if db != "postgres":
+        return cmd, None
+    if container:
+        return ["env", f"PGPASSWORD={conf['password']}"] + cmd, None
+    env = os.environ.copy()
+    env["PGPASSWORD"] = conf["password"]
+    return cmd, env
+
+
+def pipe_into_client(config, db, chunks):
+    """Feed SQL chunks to the mysql/psql client of the configured database"""
+    conf = config[db]
+    container = find_running_container(db, config)
+    cmd, env = _with_password(db, conf, _client_command(db, conf), container)
+    proc = start_input_command_with_fallback(cmd, env=env, fallback_container=container)
+    feed_command(proc, chunks)
+
+
+def restore_file(config, db, key, concurrency=None):
+    """Download a single-file SQL backup and decompress it straight into the client"""
+    with metrics.stage("restore", db=db) as stage:
+        downloaded = metrics.counted(downloader.iter_backup(config, key, concurrency), stage, "bytes_in")
+        pipe_into_client(config, db, decompress_chunks(downloaded, detect_codec(key)))
+
+
+def restore_dedup(config, db, key, concurrency=None):
+    """Reassemble a dedup backup from its chunks, fetched in parallel, straight into the client"""
+    manifest = dedup.read_manifest(config, key)
+    s3 = get_client(config)
+    bucket = config["s3"]["bucket"]
+
+    def fetch(entry):
+        codec = dedup.chunk_codec(manifest, entry)
+        body = s3.get_object(Bucket=bucket, Key=dedup.chunk_key(entry[0], codec))["Body"].read()
+        return b"".join(decompress_chunks([body], codec))
+
+    with metrics.stage("restore", db=db) as stage:
+        chunks = downloader.ordered_fetch(fetch, manifest["chunks"], concurrency or get_max_concurrency(config))
+        pipe_into_client(config, db, metrics.counted(chunks, stage, "bytes_out"))
+
+
+def _select(manifest, tables):
+    """Manifest entries of the requested tables, matched by name or, for schema.table, by bare name"""
+    entries = manifest.get("tables") or []
+    if not tables:
+        return entries
+    names = lambda entry: {entry["name"], entry["name"].rsplit(".", 1)[-1]}
+    missing = [t for t in tables if not any(t in names(entry) for entry in entries)]
+    if missing:
+        raise Exception(f"Tables not in this backup: {', '.join(missing)}")
+    return [entry for entry in entries if names(entry) & set(tables)]
+
+
+def restore_mysql_tables(config, prefix, manifest, tables=None, jobs=4):
+    """
+    Restore the per-table files of a parallel MySQL backup, `jobs` tables at a time, then
+    its views, triggers, routines and events, which refer to the tables. A restore of
+    selected tables leaves those out.
+    """
+    entries = _select(manifest, tables)
+    # Each table streams with its share of the download connections
+    per_table = max(1, get_max_concurrency(config) // jobs)
+
+    def restore_file_of(entry, concurrency):
+        key = prefix + entry["file"] + (ENCRYPTED_EXTENSION if manifest.get("encrypted") else "")
+        codec = manifest.get("codec") or detect_codec(entry["file"])
+        pipe_into_client(config, "mysql", decompress_chunks(downloader.iter_backup(config, key, concurrency), codec))
+
+    def restore_table(entry):
+        restore_file_of(entry, per_table)
+        logger.info(f"Restored table {entry['name']}")
+
+    schema_objects = None if tables else manifest.get("schema_objects")
+    with metrics.stage("restore", db="mysql", jobs=jobs) as stage:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(restore_table, entries))
+        if schema_objects:
+            restore_file_of(schema_objects, None)
+            logger.info("Restored views, triggers, routines and events")
+        elif tables and manifest.get("schema_objects"):
+            logger.info("Views, triggers, routines and events are only restored with all tables")
+        stage.bytes_in = sum(entry.get("bytes", 0) for entry in entries + [schema_objects or {}])
+
+
+def restore_postgres_directory(config, prefix, manifest, tables=None, jobs=4, clean=False):
+    """
+    Restore a directory-format pg_dump with `pg_restore -j`.
+
+    pg_restore needs the directory on disk, so it is downloaded first; with tables
+    selected only the table of contents and those tables' data files are fetched.
+    """
+    pg = config["postgres"]
+    names = None
+    if tables and manifest.get("tables"):
+        names = {"toc.dat"} | {entry["file"] for entry in _select(manifest, tables)}
+
+    dir_name = prefix.rstrip("/")
+    work_dir = tempfile.mkdtemp(prefix="restore_", dir=os.getenv("TMP", os.getenv("TEMP", "/tmp")))
+    dump_dir = os.path.join(work_dir, dir_name)
+    cmd = ["pg_restore", "-h", pg["host"], "-p", str(pg["port"]), "-U", pg["user"], "-d", pg["database"],
+           "-j", str(jobs)]
+    if clean:
+        cmd += ["--clean", "--if-exists"]
+    for table in tables or []:
+        # pg_restore matches bare table names; the manifest lists schema.table
+        cmd += ["-t", table.rsplit(".", 1)[-1]]
+
+    try:
+        with metrics.stage("restore", db="postgres", jobs=jobs) as stage:
+            files = downloader.download_prefix(config, prefix, dump_dir, names, max_workers=jobs * 2)
+            stage.bytes_in = sum(os.path.getsize(os.path.join(dump_dir, f)) for f in files)
+
+            container = find_running_container("postgres", config)
+            if container:
+                # The directory is copied into the container and restored from there
+                remote_dir = f"/tmp/{dir_name}"
+                subprocess.run(["docker", "cp", dump_dir, f"{container}:{remote_dir}"], check=True)
+                try:
+                    result = run_command_with_fallback_without_file(
+                        ["env", f"PGPASSWORD={pg['password']}"] + cmd + [remote_dir], fallback_container=container)
+                finally:
+                    subprocess.run(["docker", "exec", container, "rm", "-rf", remote_dir])
+                if result is None:
+                    raise Exception("pg_restore failed")
+            else:
+                cmd, env = _with_password("postgres", pg, cmd, None)
+                result = subprocess.run(cmd + [dump_dir], stderr=subprocess.PIPE, text=True, env=env)
+                if result.returncode != 0:
+                    logger.error(f"Command failed: {result.stderr}")
+                    raise Exception("pg_restore failed")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def restore(config, key=None, db=None, target=None, tables=None, jobs=4, clean=False):
+    """
+    Restore a backup into the database configured for its type; returns the key restored.
+
+    Single-file and dedup backups stream from S3 through decompression into mysql/psql
+    without touching disk. Tables can be picked from per-table (MySQL) and directory
+    (PostgreSQL) backups only.
+    """
+    key = resolve_backup(config, key, db, target)
+    key_db, backup_type, _ = catalog.parse_backup_key(key)
+    if db and key_db != db:
+        raise Exception(f"{key} is a {key_db} backup, not {db}")
+    if key_db == "postgres" and backup_type == "incremental":
+        raise Exception("PostgreSQL incrementals are WAL archives; they are replayed by recovery, not restored")
+    logger.info(f"Restoring {key} into {key_db} database {config[key_db]['database']}")
+
+    if key.endswith("/"):
+        body = get_client(config).get_object(Bucket=config["s3"]["bucket"], Key=key + MANIFEST_NAME)["Body"].read()
+        manifest = json.loads(body)
+        if manifest.get("format") == "per-table":
+            restore_mysql_tables(config, key, manifest, tables, jobs)
+        elif manifest.get("format") == "directory":
+            restore_postgres_directory(config, key, manifest, tables, jobs, clean)
+        else:
+            raise Exception(f"Unknown backup format {manifest.get('format')!r} in {key}")
+    elif tables:
+        raise Exception("Tables can only be selected from per-table or directory-format backups")
+    elif key.endswith(dedup.MANIFEST_SUFFIX):
+        restore_dedup(config, key_db, key)
+    else:
+        restore_file(config, key_db, key)
+
+    logger.info(f"Restore of {key} completed")
+    return key
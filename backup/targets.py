@@ -0,0 +1,112 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils.logger import logger
+
+DEFAULT_PARALLELISM = 4
+DEFAULT_PER_HOST_LIMIT = 1
+
+# Target names end up in backup keys (mysql_backup_<date>@<name>.sql.gz)
+TARGET_NAME_PATTERN = re.compile(r"^[A-Za-z0-9-]+$")
+DB_TYPES = ("mysql", "postgres")
+
+
+def load_targets(config):
+    """
+    Named targets from the `targets` list in config, keyed by name.
+
+    Each entry has a name, a type (mysql or postgres), the usual connection settings
+    and optionally `options` overriding backup flags (codec, jobs, tables, ...).
+    """
+    targets = {}
+    for entry in config.get("targets") or []:
+        name = entry.get("name")
+        if not name or not TARGET_NAME_PATTERN.match(name):
+            raise Exception(f"Invalid target name {name!r}: use letters, digits and '-'")
+        if entry.get("type") not in DB_TYPES:
+            raise Exception(f"Target {name} needs a type of {' or '.join(DB_TYPES)}")
+        if name in targets:
+            raise Exception(f"Duplicate target name: {name}")
+        targets[name] = entry
+    return targets
+
+
+def select_targets(config, names=None):
+    """The named targets in order, or all of them when no names are given"""
+    targets = load_targets(config)
+    if not names:
+        return list(targets.values())
+    missing = [name for name in names if name not in targets]
+    if missing:
+        raise Exception(f"Unknown target(s): {', '.join(missing)}")
+    return [targets[name] for name in names]
+
+
+def target_config(config, target):
+    """
+    A copy of config whose mysql/postgres block is the target's connection.
+
+    Settings under the top-level block (wal_archive_dir, pool_size, ...) serve as
+    defaults, so the existing backup functions run unchanged against the target.
+    """
+    db = target["type"]
+    settings = dict(config.get(db) or {})
+    settings.update({k: v for k, v in target.items() if k not in ("name", "type", "options")})
+    settings["target"] = target["name"]
+    conf = dict(config)
+    conf[db] = settings
+    return conf
+
+
+def host_of(config, target):
+    settings = target_config(config, target)[target["type"]]
+    return f"{settings.get('host', 'localhost')}:{settings.get('port', '')}"
+
+
+def run_targets(config, targets, run, parallelism=None, per_host_limit=None):
+    """
+    Run `run(target_config, target)` for every target concurrently and return one result
+    per target, in the order given.
+
+    At most `parallelism` targets run at once and at most `per_host_limit` of them against
+    the same host. `run` returns the list of uploaded files or raises.
+    """
+    fanout = config.get("fanout", {})
+    parallelism = parallelism or fanout.get("parallelism", DEFAULT_PARALLELISM)
+    per_host_limit = per_host_limit or fanout.get("per_host_limit", DEFAULT_PER_HOST_LIMIT)
+
+    def execute(target):
+        started = time.monotonic()
+        result = {"target": target["name"], "type": target["type"], "host": host_of(config, target),
+                  "success": True, "files": [], "error": None}
+        try:
+            result["files"] = run(target_config(config, target), target) or []
+        except Exception as e:
+            logger.error(f"Backup of target {target['name']} failed: {e}")
+            result["success"] = False
+            result["error"] = str(e)
+        result["duration"] = time.monotonic() - started
+        return result
+
+    pending = list(targets)
+    running = {}    # future -> host
+    results = {}
+    logger.info(f"Backing up {len(pending)} targets, {parallelism} at a time, {per_host_limit} per host")
+    with ThreadPoolExecutor(max_workers=parallelism) as pool:
+        while pending or running:
+            # Start whatever fits; a busy host does not hold up targets on other hosts
+            for target in list(pending):
+                if len(running) >= parallelism:
+                    break
+                host = host_of(config, target)
+                if sum(1 for h in running.values() if h == host) >= per_host_limit:
+                    continue
+                pending.remove(target)
+                running[pool.submit(execute, target)] = host
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                result = future.result()
+                results[result["target"]] = result
+
+    return [results[target["name"]] for target in targets]
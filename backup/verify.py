@@ -0,0 +1,175 @@
+import hashlib
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.logger import logger
+from utils.compression import decompress_chunks
+from s3 import catalog, digests
+from s3.client import MB, get_client, get_max_concurrency
+from backup import dedup
+
+
+def _contents(config, key):
+    """
+    What there is to check in a backup: (object key, digest record) pairs, with None for
+    objects stored without a digest, and the (digest, codec) of every dedup chunk.
+    """
+    if key.endswith(dedup.MANIFEST_SUFFIX):
+        manifest = dedup.read_manifest(config, key)
+        return [], sorted({(entry[0], dedup.chunk_codec(manifest, entry)) for entry in manifest["chunks"]})
+    if key.endswith("/"):
+        keys = [obj["Key"] for obj in catalog.iter_objects(config, prefix=key)]
+        if not keys:
+            raise Exception(f"Backup {key} not found")
+    else:
+        keys = [key]
+    return [(object_key, digests.read_sidecar(config, object_key)) for object_key in keys], []
+
+
+def _check_block(config, object_key, record, index):
+    """Hash one block with a ranged GET, streaming; returns (bytes read, error or None)"""
+    start = index * record["block_size"]
+    end = min(start + record["block_size"], record["size"])
+    hasher = hashlib.sha256()
+    read = 0
+    if end > start:
+        body = get_client(config).get_object(Bucket=config["s3"]["bucket"], Key=object_key,
+                                             Range=f"bytes={start}-{end - 1}")["Body"]
+        for chunk in body.iter_chunks(MB):
+            hasher.update(chunk)
+            read += len(chunk)
+    if read != end - start or hasher.hexdigest() != record["blocks"][index]:
+        return read, f"{object_key}: block {index} (bytes {start}-{end - 1}) does not match its digest"
+    return read, None
+
+
+def _check_chunk(config, digest, codec):
+    body = get_client(config).get_object(Bucket=config["s3"]["bucket"], Key=dedup.chunk_key(digest, codec))["Body"]
+    data = b"".join(decompress_chunks([body.read()], codec))
+    if hashlib.sha256(data).hexdigest() != digest:
+        return len(data), f"Dedup chunk {digest} does not match its digest"
+    return len(data), None
+
+
+def _check_record(config, object_key, record):
+    """Checks that need no download: the record is consistent and S3 holds an object of its size"""
+    if digests.top_digest(record["blocks"]) != record["sha256"]:
+        return f"{object_key}: digest sidecar is inconsistent"
+    head = get_client(config).head_object(Bucket=config["s3"]["bucket"], Key=object_key)
+    if head["ContentLength"] != record["size"]:
+        return f"{object_key}: {head['ContentLength']} bytes in S3, {record['size']} when uploaded"
+    # Only a single put carries the object's SHA-256, and its one block is the whole object
+    stored = head.get("Metadata", {}).get("sha256")
+    if stored and (len(record["blocks"]) != 1 or stored != record["blocks"][0]):
+        return f"{object_key}: metadata digest differs from the sidecar"
+    return None
+
+
+def _checks(config, key):
+    """(check function, args) for every block and chunk of a backup, plus the problems found without downloading"""
+    objects, chunks = _contents(config, key)
+    checks = [(_check_chunk, (config, digest, codec)) for digest, codec in chunks]
+    errors, unverified = [], []
+    for object_key, record in objects:
+        if record is None:
+            unverified.append(object_key)
+        else:
+            error = _check_record(config, object_key, record)
+            if error:
+                errors.append(error)
+                continue
+            checks.extend((_check_block, (config, object_key, record, index)) for index in range(len(record["blocks"])))
+    return checks, errors, unverified
+
+
+def _run(check):
+    try:
+        return check[0](*check[1])
+    except Exception as e:
+        return 0, f"{check[1][1]}: {e}"
+
+
+def _result(key, errors, unverified, checked, read, started):
+    if errors:
+        status = "failed"
+    elif not checked:
+        status = "unverified" if unverified else "unchecked"
+    else:
+        status = "ok"
+    return {"key": key, "status": status, "errors": errors, "unverified": unverified, "checked": checked,
+            "bytes": read, "seconds": time.monotonic() - started}
+
+
+def verify_backup(config, key, concurrency=None):
+    """
+    Check every block of a backup against the digests recorded when it was uploaded,
+    with parallel ranged GETs hashed as they stream in; nothing is written to disk.
+    """
+    started = time.monotonic()
+    try:
+        checks, errors, unverified = _checks(config, key)
+    except Exception as e:
+        checks, errors, unverified = [], [str(e)], []
+    read = 0
+    with ThreadPoolExecutor(max_workers=concurrency or get_max_concurrency(config)) as pool:
+        for size, error in pool.map(_run, checks):
+            read += size
+            if error:
+                errors.append(error)
+    result = _result(key, errors, unverified, len(checks), read, started)
+    logger.info(f"Verified {key}: {result['status']} ({len(checks)} blocks, {read} bytes)")
+    return result
+
+
+def verify_sample(config, keys, budget, concurrency=None, seed=None):
+    """
+    Check randomly picked blocks of many backups until `budget` seconds have passed;
+    returns one result per backup, for the blocks that were checked.
+    """
+    started = time.monotonic()
+    deadline = started + budget
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    plans = {}
+    results = {key: {"errors": [], "unverified": [], "checked": 0, "bytes": 0} for key in keys}
+
+    def plan(key):
+        # Sidecars are read the first time a backup is picked
+        if key not in plans:
+            try:
+                planned = _checks(config, key)
+            except Exception as e:
+                planned = ([], [str(e)], [])
+            with lock:
+                if key not in plans:
+                    plans[key] = planned
+                    results[key]["errors"].extend(planned[1])
+                    results[key]["unverified"].extend(planned[2])
+        return plans[key][0]
+
+    def worker():
+        while time.monotonic() < deadline:
+            with lock:
+                key = rng.choice(keys)
+            checks = plan(key)
+            if not checks:
+                if len(plans) == len(keys) and not any(p[0] for p in plans.values()):
+                    # Nothing in any of the backups can be checked
+                    return
+                continue
+            with lock:
+                check = rng.choice(checks)
+            size, error = _run(check)
+            with lock:
+                results[key]["checked"] += 1
+                results[key]["bytes"] += size
+                if error and error not in results[key]["errors"]:
+                    results[key]["errors"].append(error)
+
+    workers = concurrency or get_max_concurrency(config)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(worker) for _ in range(workers)]:
+            future.result()
+    return [_result(key, r["errors"], r["unverified"], r["checked"], r["bytes"], started)
+            for key, r in results.items()]
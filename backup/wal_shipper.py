@@ -0,0 +1,122 @@
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.logger import logger
+from utils.compression import compress_chunks, resolve_codec, extension, read_chunks
+from s3 import uploader, catalog
+from s3.catalog import WAL_PREFIX
+
+# 24 hex digits: timeline (8) + log (8) + segment (8), so names sort in LSN order
+SEGMENT_PATTERN = re.compile(r"^[0-9A-F]{24}$")
+HISTORY_PATTERN = re.compile(r"^[0-9A-F]{8}\.history$")
+BACKUP_LABEL_PATTERN = re.compile(r"^[0-9A-F]{24}\.[0-9A-F]{8}\.backup$")
+# PostgreSQL's default; clusters built with another --wal-segsize set postgres.wal_segment_size_mb
+DEFAULT_WAL_SEGMENT_MB = 16
+# A segment of another size (e.g. compressed by archive_command) untouched this long is complete
+SETTLE_SECONDS = 60
+
+# path -> (size, mtime) of segments still short of the segment size at the last poll
+_unsettled = {}
+
+
+def is_wal_file(name):
+    return bool(SEGMENT_PATTERN.match(name) or HISTORY_PATTERN.match(name) or BACKUP_LABEL_PATTERN.match(name))
+
+
+def segment_key(name, codec, target=None):
+    """
+    wal/<timeline>/<segment>, so a prefix listing returns one timeline in LSN order.
+    Named targets get their own wal/<target>/ tree.
+    """
+    prefix = f"{WAL_PREFIX}{target}/" if target else WAL_PREFIX
+    return f"{prefix}{name[:8]}/{name}{extension(codec) if codec else ''}"
+
+
+def _file_state(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+def is_complete(path, segment_size):
+    """
+    Whether archive_command has finished writing a WAL file. A segment is complete at the
+    segment size, or when its size and mtime did not change since the previous poll or
+    for SETTLE_SECONDS; history and backup label files are tiny and always are.
+    """
+    if not SEGMENT_PATTERN.match(os.path.basename(path)):
+        return True
+    state = _file_state(path)
+    if state[0] == segment_size:
+        _unsettled.pop(path, None)
+        return True
+    if _unsettled.get(path) == state or time.time() - state[1] >= SETTLE_SECONDS:
+        _unsettled.pop(path, None)
+        return True
+    _unsettled[path] = state
+    return False
+
+
+def pending_segments(wal_dir, shipped, segment_size):
+    """Complete WAL files in the archive that have not been shipped yet, oldest LSN first"""
+    names = sorted(name for name in os.listdir(wal_dir) if is_wal_file(name) and name not in shipped)
+    return [name for name in names if is_complete(os.path.join(wal_dir, name), segment_size)]
+
+
+def ship_new_segments(config, jobs=4, codec=None, level=None, compress=True):
+    """
+    Upload WAL files archived since the last run, each as its own object.
+
+    Segments are compressed and uploaded on `jobs` threads; each one is recorded in the
+    local catalog as soon as it lands, so an interrupted run resumes where it stopped.
+    Returns the uploaded keys.
+    """
+    wal_dir = config["postgres"].get("wal_archive_dir", "/var/lib/postgresql/wal_archive")
+    target = config["postgres"].get("target")
+    # Segment names repeat across clusters, so a target's segments are tracked as <target>/<name>
+    tracked_prefix = f"{target}/" if target else ""
+    if not os.path.isdir(wal_dir):
+        raise Exception(f"WAL archive directory not found: {wal_dir}")
+
+    codec, level = resolve_codec(codec, level) if compress else (None, None)
+    segment_size = int(config["postgres"].get("wal_segment_size_mb", DEFAULT_WAL_SEGMENT_MB)) * 1024 * 1024
+    shipped = {name[len(tracked_prefix):] for name in catalog.shipped_wal_segments(config)
+               if name.startswith(tracked_prefix)}
+    pending = pending_segments(wal_dir, shipped, segment_size)
+    if not pending:
+        logger.info("No new WAL segments to ship")
+        return []
+
+    logger.info(f"Shipping {len(pending)} new WAL files from {wal_dir}")
+
+    def ship(name):
+        path = os.path.join(wal_dir, name)
+        key = segment_key(name, codec, target)
+        before = _file_state(path)
+        with open(path, "rb") as f:
+            chunks = read_chunks(f)
+            key = uploader.upload_stream(compress_chunks(chunks, codec, level) if codec else chunks, key, config,
+                                         record=False)
+        if _file_state(path) != before:
+            # Still being written after all; not recorded, so the next run uploads it again over this key
+            logger.warning(f"WAL file {name} changed while it was uploaded, shipping it again later")
+            return None
+        catalog.record_wal_segment(config, tracked_prefix + name, key, before[0], before[1])
+        return key
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        keys = [key for key in pool.map(ship, pending) if key]
+
+    logger.info(f"Shipped {len(keys)} WAL files ({pending[0]} .. {pending[-1]})")
+    return keys
+
+
+def watch(config, interval=10, jobs=4, codec=None, level=None):
+    """Ship WAL files as they appear in the archive directory"""
+    logger.info(f"Watching WAL archive every {interval}s")
+    while True:
+        try:
+            ship_new_segments(config, jobs, codec, level)
+        except Exception as e:
+            logger.error(f"WAL shipping failed, retrying in {interval}s: {e}")
+        time.sleep(interval)
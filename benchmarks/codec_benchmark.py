@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Compare compression codecs on a sample dump.
+
+    python benchmarks/codec_benchmark.py --file /tmp/mysql_backup.sql
+    python benchmarks/codec_benchmark.py --size-mb 256 --threads 1,4
+
+Without --file a synthetic SQL dump is generated in memory.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.compression import CODECS, DEFAULT_LEVELS, compress_chunks  # noqa: E402
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def synthetic_dump(size_mb, seed=42):
+    rng = random.Random(seed)
+    words = ["alpha", "beta", "gamma", "delta", "order", "customer", "pending", "shipped", "refund"]
+    lines = []
+    total = 0
+    row_id = 0
+    while total < size_mb * 1024 * 1024:
+        values = []
+        for _ in range(200):
+            row_id += 1
+            values.append(f"({row_id},'{rng.choice(words)} {rng.choice(words)}',{rng.randint(0, 10 ** 6)},"
+                          f"'2026-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',{rng.random():.6f})")
+        line = "INSERT INTO `orders` VALUES " + ",".join(values) + ";\n"
+        lines.append(line.encode())
+        total += len(line)
+    return b"".join(lines)
+
+
+def run(data, codec, level, threads):
+    chunks = (data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE))
+    start = time.perf_counter()
+    compressed = sum(len(c) for c in compress_chunks(chunks, codec, level, threads))
+    elapsed = time.perf_counter() - start
+    return {
+        "codec": codec,
+        "level": level,
+        "threads": threads,
+        "seconds": elapsed,
+        "mb_per_s": len(data) / 1024 / 1024 / elapsed,
+        "ratio": len(data) / compressed if compressed else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", help="Sample dump to compress (default: synthetic)")
+    parser.add_argument("--size-mb", type=int, default=64, help="Size of the synthetic dump")
+    parser.add_argument("--codecs", default=",".join(CODECS), help="Comma-separated codecs")
+    parser.add_argument("--levels", default=None, help="Comma-separated levels (default: each codec's default)")
+    parser.add_argument("--threads", default="1,4", help="Comma-separated thread counts")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "rb") as f:
+            data = f.read()
+    else:
+        data = synthetic_dump(args.size_mb)
+
+    print(f"Input: {len(data) / 1024 / 1024:.1f} MB")
+    print(f"{'codec':<6} {'level':>5} {'threads':>7} {'MB/s':>9} {'ratio':>7} {'seconds':>8}")
+    for codec in args.codecs.split(","):
+        levels = [int(l) for l in args.levels.split(",")] if args.levels else [DEFAULT_LEVELS[codec]]
+        for level in levels:
+            for threads in (int(t) for t in args.threads.split(",")):
+                try:
+                    r = run(data, codec, level, threads)
+                except Exception as e:
+                    print(f"{codec:<6} skipped: {e}")
+                    break
+                print(f"{r['codec']:<6} {r['level']:>5} {r['threads']:>7} {r['mb_per_s']:>9.1f} "
+                      f"{r['ratio']:>7.2f} {r['seconds']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Benchmark the dump -> compress -> upload pipeline against local stand-ins.
+
+    python benchmarks/pipeline_benchmark.py --size-mb 256 --compressibility 0.7 --rate-mb 200
+    python benchmarks/pipeline_benchmark.py --save-baseline benchmarks/baseline.json
+    python benchmarks/pipeline_benchmark.py --baseline benchmarks/baseline.json
+    python benchmarks/pipeline_benchmark.py --compare-encryption --max-overhead 0.10
+
+Fake mysqldump/pg_dump executables put first on PATH emit a synthetic dump at a
+controlled rate. S3 is moto's in-process mock (pip install moto) unless --endpoint-url
+points at a local server such as MinIO. Every case runs in its own process, so peak RSS
+is per case. With --baseline the run exits with status 1 when a case got slower, or
+used more memory or temp disk, by more than --tolerance. With --compare-encryption
+every case also runs with client-side encryption, and the run fails when that adds
+more than --max-overhead to a case's end-to-end time.
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+CHUNK_SIZE = 1024 * 1024
+BLOCK_SIZE = 64 * 1024
+MB = 1024 * 1024
+CASES = ("mysql", "postgres", "upload")
+BUCKET = "benchmark"
+
+FAKE_TOOL = """#!{python}
+import sys
+sys.path.insert(0, {bench_dir!r})
+from pipeline_benchmark import fake_dump_main
+fake_dump_main()
+"""
+
+
+def synthetic_stream(size_mb, compressibility=0.7, seed=42):
+    """
+    Yield `size_mb` of dump-like data in 1 MB chunks.
+
+    Each 64 KB block is `compressibility` parts SQL text and the rest random bytes, so
+    0 gives incompressible data and 1 a text-only dump.
+    """
+    from codec_benchmark import synthetic_dump
+
+    rng = random.Random(seed)
+    text = synthetic_dump(1, seed)
+    text_bytes = int(BLOCK_SIZE * min(max(compressibility, 0.0), 1.0))
+    offset = 0
+    remaining = size_mb * MB
+    while remaining > 0:
+        chunk = bytearray()
+        while len(chunk) < CHUNK_SIZE:
+            if offset + text_bytes > len(text):
+                offset = 0
+            chunk += text[offset:offset + text_bytes]
+            offset += text_bytes
+            chunk += rng.randbytes(BLOCK_SIZE - text_bytes)
+        chunk = bytes(chunk[:min(CHUNK_SIZE, remaining)])
+        remaining -= len(chunk)
+        yield chunk
+
+
+def fake_dump_main():
+    """Entry point of the fake mysqldump/pg_dump: stream the synthetic dump to stdout at BENCH_RATE_MB"""
+    size_mb = int(os.environ["BENCH_SIZE_MB"])
+    compressibility = float(os.environ["BENCH_COMPRESSIBILITY"])
+    rate = float(os.environ.get("BENCH_RATE_MB", 0)) * MB
+    out = sys.stdout.buffer
+    started = time.monotonic()
+    sent = 0
+    for chunk in synthetic_stream(size_mb, compressibility, int(os.environ.get("BENCH_SEED", 42))):
+        out.write(chunk)
+        sent += len(chunk)
+        if rate:
+            ahead = sent / rate - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+    out.flush()
+
+
+def _max_rss_mb(who):
+    rss = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss / MB if sys.platform == "darwin" else rss / 1024
+
+
+def _disk_usage(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class DiskMonitor(threading.Thread):
+    """Samples the size of a directory and keeps the peak"""
+
+    def __init__(self, path, interval=0.05):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.is_set():
+            self.peak = max(self.peak, _disk_usage(self.path))
+            self.done.wait(self.interval)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        self.peak = max(self.peak, _disk_usage(self.path))
+        return self.peak
+
+
+def _install_fake_tools(bin_dir):
+    os.makedirs(bin_dir, exist_ok=True)
+    for tool in ("mysqldump", "pg_dump"):
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write(FAKE_TOOL.format(python=sys.executable, bench_dir=BENCH_DIR))
+        os.chmod(path, 0o755)
+
+
+def _config(args):
+    db = {"host": "127.0.0.1", "port": 0, "user": "bench", "password": "bench", "database": "bench"}
+    config = {
+        "mysql": dict(db, port=3306),
+        "postgres": dict(db, port=5432),
+        "s3": {
+            "aws_access_key_id": "bench",
+            "aws_secret_access_key": "bench",
+            "region": "us-east-1",
+            "bucket": BUCKET,
+            "endpoint_url": args.endpoint_url,
+            "part_size_mb": args.part_size_mb,
+            "max_concurrency": args.concurrency,
+        },
+        # Stage metrics are collected, but no textfile is written
+        "metrics": {"textfile": ""},
+    }
+    if args.encrypt:
+        config["encryption"] = {"enabled": True, "key": base64.b64encode(bytes(range(32))).decode(),
+                                "threads": args.encrypt_threads}
+    return config
+
+
+def run_case(case, args):
+    """Run one case in this process and return its measurements"""
+    workspace = tempfile.mkdtemp(prefix=f"bench-{case}-")
+    tmp_dir = os.path.join(workspace, "tmp")
+    os.makedirs(tmp_dir)
+    _install_fake_tools(os.path.join(workspace, "bin"))
+    os.environ.update({
+        "PATH": os.path.join(workspace, "bin") + os.pathsep + os.environ.get("PATH", ""),
+        "TMP": tmp_dir,
+        # No Docker fallback: the fake tools always run locally
+        "DOCKER_HOST": f"unix://{os.path.join(workspace, 'no-docker.sock')}",
+        "BENCH_SIZE_MB": str(args.size_mb),
+        "BENCH_COMPRESSIBILITY": str(args.compressibility),
+        "BENCH_RATE_MB": str(args.rate_mb),
+    })
+    # Logs, catalog and state land in the workspace
+    os.chdir(workspace)
+
+    from utils.logger import disable_console_logging
+    from utils import metrics
+    from backup import mysql_backup, postgres_backup
+    from s3 import uploader
+    from s3.client import get_client
+
+    if not args.verbose:
+        disable_console_logging()
+    config = _config(args)
+    compress = args.codec != "none"
+    codec = args.codec if compress else None
+
+    mock = None
+    if not args.endpoint_url:
+        try:
+            from moto import mock_aws
+        except ImportError:
+            raise SystemExit("moto is needed for the in-process S3 stand-in (pip install moto), "
+                             "or pass --endpoint-url")
+        mock = mock_aws()
+        mock.start()
+    try:
+        s3 = get_client(config)
+        try:
+            s3.create_bucket(Bucket=BUCKET)
+        except Exception:
+            pass
+
+        if case == "upload":
+            # Only the upload is timed, the file is prepared beforehand
+            path = os.path.join(tmp_dir, "upload_benchmark.bin")
+            with open(path, "wb") as f:
+                for chunk in synthetic_stream(args.size_mb, args.compressibility):
+                    f.write(chunk)
+
+        monitor = DiskMonitor(tmp_dir)
+        monitor.start()
+        run = metrics.start_run(f"bench-{case}", case)
+        started = time.monotonic()
+        if case == "mysql":
+            path = mysql_backup.backup(config, "benchmark", compress=compress, codec=codec, level=args.level,
+                                       threads=args.threads)
+        elif case == "postgres":
+            path = postgres_backup.backup(config, "benchmark", compress=compress, codec=codec, level=args.level,
+                                          threads=args.threads)
+        uploader.upload_to_s3(path, config)
+        seconds = time.monotonic() - started
+        summary = metrics.finish_run(config, run, True)
+        peak_temp = monitor.stop()
+    finally:
+        if mock is not None:
+            mock.stop()
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    stages = {}
+    for name, totals in summary["stages"].items():
+        size = totals["bytes_in"] or totals["bytes_out"]
+        stages[name] = {
+            "seconds": round(totals["seconds"], 3),
+            "mb_per_s": round(size / MB / totals["seconds"], 1) if totals["seconds"] else None,
+            "child_cpu_seconds": round(totals["child_cpu_seconds"], 3),
+        }
+    return {
+        "case": case,
+        "seconds": round(seconds, 3),
+        "mb_per_s": round(args.size_mb / seconds, 1),
+        "peak_rss_mb": round(_max_rss_mb(resource.RUSAGE_SELF), 1),
+        "dump_peak_rss_mb": round(_max_rss_mb(resource.RUSAGE_CHILDREN), 1),
+        "peak_temp_mb": round(peak_temp / MB, 1),
+        "stages": stages,
+    }
+
+
+def _case_args(args):
+    argv = ["--size-mb", str(args.size_mb), "--compressibility", str(args.compressibility),
+            "--rate-mb", str(args.rate_mb), "--codec", args.codec, "--threads", str(args.threads),
+            "--part-size-mb", str(args.part_size_mb), "--concurrency", str(args.concurrency)]
+    if args.level is not None:
+        argv += ["--level", str(args.level)]
+    if args.endpoint_url:
+        argv += ["--endpoint-url", args.endpoint_url]
+    if args.encrypt:
+        argv += ["--encrypt", "--encrypt-threads", str(args.encrypt_threads)]
+    if args.verbose:
+        argv.append("--verbose")
+    return argv
+
+
+def run_isolated(case, args):
+    """Run a case in a fresh interpreter so its peak RSS is its own"""
+    with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+        cmd = [sys.executable, os.path.abspath(__file__), "--run-case", case,
+               "--result-file", result_file.name] + _case_args(args)
+        subprocess.run(cmd, check=True)
+        with open(result_file.name) as f:
+            return json.load(f)
+
+
+def parameters(args):
+    return {"size_mb": args.size_mb, "compressibility": args.compressibility, "rate_mb": args.rate_mb,
+            "codec": args.codec, "level": args.level, "threads": args.threads,
+            "part_size_mb": args.part_size_mb, "concurrency": args.concurrency, "encrypt": args.encrypt}
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of results against a baseline, as a list of messages"""
+    previous = {r["case"]: r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get(result["case"])
+        if before is None:
+            continue
+        if result["mb_per_s"] < before["mb_per_s"] * (1 - tolerance):
+            regressions.append(f"{result['case']}: throughput {before['mb_per_s']} -> {result['mb_per_s']} MB/s")
+        for field in ("peak_rss_mb", "peak_temp_mb"):
+            # Small absolute changes are noise, whatever the ratio
+            if result[field] > before[field] * (1 + tolerance) and result[field] - before[field] > 5:
+                regressions.append(f"{result['case']}: {field} {before[field]} -> {result[field]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", default=",".join(CASES), help="Comma-separated cases")
+    parser.add_argument("--size-mb", type=int, default=128, help="Size of the synthetic dump")
+    parser.add_argument("--compressibility", type=float, default=0.7,
+                        help="Share of SQL text in the dump, 0 (random) to 1 (text only)")
+    parser.add_argument("--rate-mb", type=float, default=0, help="Dump output rate in MB/s, 0 for unlimited")
+    parser.add_argument("--codec", default="gzip", help="Compression codec, or none")
+    parser.add_argument("--level", type=int, default=None, help="Compression level")
+    parser.add_argument("--threads", type=int, default=1, help="Compression threads")
+    parser.add_argument("--part-size-mb", type=int, default=16, help="S3 multipart part size")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent part uploads")
+    parser.add_argument("--endpoint-url", help="Local S3 endpoint instead of moto")
+    parser.add_argument("--encrypt", action="store_true", help="Encrypt backups client-side")
+    parser.add_argument("--encrypt-threads", type=int, default=1, help="Encryption worker threads")
+    parser.add_argument("--compare-encryption", action="store_true",
+                        help="Run every case with and without encryption and report the overhead")
+    parser.add_argument("--max-overhead", type=float, default=0.10,
+                        help="Allowed end-to-end overhead of encryption, as a fraction")
+    parser.add_argument("--baseline", help="Compare against this results file")
+    parser.add_argument("--save-baseline", help="Write the results to this file")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed regression, as a fraction")
+    parser.add_argument("--verbose", action="store_true", help="Show the backup log")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        result = run_case(args.run_case, args)
+        with open(args.result_file, "w") as f:
+            json.dump(result, f)
+        return
+
+    cases = args.cases.split(",")
+    unknown = set(cases) - set(CASES)
+    if unknown:
+        parser.error(f"Unknown case(s): {', '.join(sorted(unknown))}")
+
+    print(f"Input: {args.size_mb} MB, compressibility {args.compressibility}, "
+          f"dump rate {args.rate_mb or 'unlimited'} MB/s, codec {args.codec}")
+    print(f"{'case':<12} {'MB/s':>8} {'seconds':>8} {'RSS MB':>7} {'dump RSS':>8} {'temp MB':>8}  stages")
+    results = []
+    overheads = {}
+    for case in cases:
+        runs = [(args, case)]
+        if args.compare_encryption:
+            runs.append((argparse.Namespace(**dict(vars(args), encrypt=True)), f"{case}+enc"))
+        for run_args, label in runs:
+            r = dict(run_isolated(case, run_args), case=label)
+            results.append(r)
+            stages = ", ".join(f"{name} {s['mb_per_s']} MB/s" for name, s in r["stages"].items())
+            print(f"{r['case']:<12} {r['mb_per_s']:>8.1f} {r['seconds']:>8.2f} {r['peak_rss_mb']:>7.0f} "
+                  f"{r['dump_peak_rss_mb']:>8.0f} {r['peak_temp_mb']:>8.0f}  {stages}")
+        if args.compare_encryption:
+            overheads[case] = results[-1]["seconds"] / results[-2]["seconds"] - 1
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"parameters": parameters(args), "results": results}, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if overheads:
+        for case, overhead in overheads.items():
+            print(f"Encryption overhead {case}: {overhead:+.1%}")
+        too_slow = [case for case, overhead in overheads.items() if overhead > args.max_overhead]
+        if too_slow:
+            print(f"OVERHEAD above {args.max_overhead:.0%} for {', '.join(too_slow)}")
+            sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("parameters") != parameters(args):
+            print("Warning: the baseline was taken with different parameters")
+        regressions = compare(results, baseline, args.tolerance)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Benchmark how fast the CLI starts for commands that only read local state.
+
+    python benchmarks/startup_benchmark.py
+    python benchmarks/startup_benchmark.py --commands "status,logs --lines 5" --runs 10 --max-ms 100
+
+Each command runs --runs times in a fresh interpreter inside a scratch directory, so
+no real state is touched; the fastest run counts, which filters out scheduling noise.
+The time a bare interpreter needs to start is measured the same way and subtracted:
+what is left is what the CLI itself costs. Runs of the interpreter and the commands
+take turns, so a machine that slows down midway affects them all alike, and bytecode
+is cached as in an installed copy even when PYTHONDONTWRITEBYTECODE is set.
+
+The run exits with status 1 when a command takes more than --max-ms, when it imports
+one of the heavy modules that must stay lazy (boto3, yaml, the database drivers, the
+backup modules), or when `status` leaves a thread running.
+"""
+
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+CLI = os.path.join(REPO_DIR, "cli.py")
+
+COMMANDS = ("--help", "status", "logs")
+LAZY_MODULES = ("boto3", "botocore", "yaml", "mysql", "psycopg2", "cryptography", "backup", "s3", "cleanup")
+
+STATUS_THREADS = """
+import sys, threading
+sys.path.insert(0, {repo!r})
+import cli
+cli.cli.main(["status"], standalone_mode=False)
+print(threading.active_count())
+"""
+
+
+def _time(argvs, cwd, runs):
+    """Fastest wall time in ms of each command line, running them in turn"""
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    fastest = [float("inf")] * len(argvs)
+    for _ in range(runs):
+        for number, argv in enumerate(argvs):
+            started = time.perf_counter()
+            subprocess.run(argv, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            fastest[number] = min(fastest[number], (time.perf_counter() - started) * 1000)
+    return fastest
+
+
+def _imported(command, cwd):
+    """Top-level packages a command imported, from -X importtime"""
+    result = subprocess.run([sys.executable, "-X", "importtime", CLI] + shlex.split(command), cwd=cwd,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--commands", default=",".join(COMMANDS), help="Comma-separated CLI commands to time")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per command; the fastest counts")
+    parser.add_argument("--max-ms", type=float, default=100.0,
+                        help="Allowed startup time of a command on top of the bare interpreter")
+    args = parser.parse_args()
+
+    failures = []
+    commands = [c.strip() for c in args.commands.split(",") if c.strip()]
+    with tempfile.TemporaryDirectory(prefix="dbbackup-startup-") as cwd:
+        baseline, *totals = _time([[sys.executable, "-c", "pass"]]
+                                  + [[sys.executable, CLI] + shlex.split(c) for c in commands], cwd, args.runs)
+        print(f"{'command':<24} {'total ms':>10} {'cli ms':>8}")
+        print(f"{'(bare interpreter)':<24} {baseline:>10.1f} {0:>8.1f}")
+        for command, total in zip(commands, totals):
+            overhead = total - baseline
+            print(f"{command:<24} {total:>10.1f} {overhead:>8.1f}")
+            if overhead > args.max_ms:
+                failures.append(f"{command}: {overhead:.1f} ms over the interpreter, limit {args.max_ms:.0f} ms")
+            eager = sorted(_imported(command, cwd) & set(LAZY_MODULES))
+            if eager:
+                failures.append(f"{command}: imports {', '.join(eager)} at startup")
+
+        result = subprocess.run([sys.executable, "-c", STATUS_THREADS.format(repo=REPO_DIR)], cwd=cwd,
+                                capture_output=True, text=True, check=True)
+        threads = int(result.stdout.strip().splitlines()[-1])
+        if threads != 1:
+            failures.append(f"status left {threads - 1} thread(s) running")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,167 @@
-import boto3
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from utils.logger import logger
+from s3.client import get_client, get_max_concurrency
+from s3 import catalog
+from s3.digests import sidecar_key
 
-def cleanup_s3(config, retention_days):
-    s3_conf = config['s3']
-    session = boto3.Session(
-        aws_access_key_id=s3_conf['aws_access_key_id'],
-        aws_secret_access_key=s3_conf['aws_secret_access_key'],
-        region_name=s3_conf['region']
+DELETE_BATCH_SIZE = 1000
+
+
+def _parse_time(backup):
+    return datetime.datetime.strptime(backup['timestamp'], "%Y-%m-%d %H:%M:%S")
+
+
+def _gfs_keep(fulls, keep_daily, keep_weekly, keep_monthly):
+    """Newest full backup of each of the last N days, M ISO weeks and K months (fulls sorted newest first)"""
+    keep = {}
+    rules = (
+        ("daily", keep_daily, lambda t: t.date()),
+        ("weekly", keep_weekly, lambda t: tuple(t.isocalendar())[:2]),
+        ("monthly", keep_monthly, lambda t: (t.year, t.month)),
     )
-    s3 = session.client('s3')
+    for name, count, period_of in rules:
+        if not count:
+            continue
+        seen = set()
+        for backup in fulls:
+            period = period_of(_parse_time(backup))
+            if period in seen:
+                continue
+            seen.add(period)
+            if len(seen) > count:
+                break
+            keep.setdefault(backup['key'], f"gfs {name}")
+    return keep
+
+
+def _base_full(incremental, fulls):
+    """The most recent full backup taken before an incremental is the base of its chain"""
+    return next((f for f in fulls if f['timestamp'] <= incremental['timestamp']), None)
+
+
+def plan_cleanup(backups, now, retention_days=None, keep_daily=None, keep_weekly=None, keep_monthly=None):
+    """
+    Decide which catalogued backups to keep and which to delete.
+
+    A backup is kept if any configured rule keeps it: younger than retention_days, or
+    selected by the grandfather-father-son counts. Under GFS, incrementals are kept when
+    their base full is a daily keeper or the latest full. A full backup that a kept
+    incremental builds on is always kept, so no retained chain is ever broken.
+    Returns (keep, delete) as lists of (backup, reason).
+    """
+    gfs = any((keep_daily, keep_weekly, keep_monthly))
+    keep = {}
+
+    if retention_days is not None:
+        cutoff = now - datetime.timedelta(days=retention_days)
+        for backup in backups:
+            if backup['last_modified'] >= cutoff:
+                keep[backup['key']] = f"younger than {retention_days} days"
+    elif not gfs:
+        raise Exception("No retention rule given")
+
+    # Each database of each target has its own chains
+    by_db = {}
+    for backup in backups:
+        if backup['db'] and backup['type']:
+            by_db.setdefault((backup['db'], backup.get('target')), []).append(backup)
+
+    for items in by_db.values():
+        fulls = sorted((b for b in items if b['type'] == 'full'), key=lambda b: b['timestamp'], reverse=True)
+        incrementals = [b for b in items if b['type'] == 'incremental']
+
+        if gfs:
+            gfs_keep = _gfs_keep(fulls, keep_daily, keep_weekly, keep_monthly)
+            for key, reason in gfs_keep.items():
+                keep.setdefault(key, reason)
+            daily = {k for k, reason in gfs_keep.items() if reason == "gfs daily"}
+            for inc in incrementals:
+                base = _base_full(inc, fulls)
+                if base is None:
+                    # Older than every full: orphaned, unless there are no fulls at all
+                    if not fulls:
+                        keep.setdefault(inc['key'], "no full backup to compare against")
+                    continue
+                # The chain on top of the latest full is always kept
+                if base['key'] in daily or base is fulls[0]:
+                    keep.setdefault(inc['key'], "gfs daily chain")
+
+        for inc in incrementals:
+            if inc['key'] not in keep:
+                continue
+            base = _base_full(inc, fulls)
+            if base is not None:
+                keep.setdefault(base['key'], f"base of {inc['key']}")
+
+    # Without an age rule, leave objects we cannot classify alone
+    if retention_days is None:
+        for backup in backups:
+            if not (backup['db'] and backup['type']):
+                keep.setdefault(backup['key'], "unrecognised key")
+
+    kept = [(b, keep[b['key']]) for b in backups if b['key'] in keep]
+    deleted = [(b, f"{(now - b['last_modified']).days} days old") for b in backups if b['key'] not in keep]
+    return kept, deleted
+
+
+def _delete_batch(s3, bucket, keys):
+    response = s3.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": k} for k in keys], "Quiet": True})
+    errors = response.get("Errors", [])
+    for error in errors:
+        logger.error(f"Failed to delete {error['Key']}: {error.get('Message')}")
+    return {e['Key'] for e in errors}
+
+
+def cleanup_s3(config, retention_days=None, keep_daily=None, keep_weekly=None, keep_monthly=None,
+               dry_run=False, refresh=False, workers=None):
+    s3_conf = config['s3']
+    s3 = get_client(config)
 
     bucket = s3_conf['bucket']
-    logger.info(f"Cleaning up files older than {retention_days} days from {bucket}")
+    logger.info(f"Cleaning up backups in {bucket}")
 
-    response = s3.list_objects_v2(Bucket=bucket)
-    if 'Contents' not in response:
-        logger.info("No files found.")
-        return
+    if refresh or catalog.is_empty(config):
+        catalog.reconcile(config)
 
     now = datetime.datetime.now(datetime.timezone.utc)
+    backups = catalog.query_backups(config)
+    kept, deleted = plan_cleanup(backups, now, retention_days, keep_daily, keep_weekly, keep_monthly)
+    plan = {
+        "keep": kept,
+        "delete": deleted,
+        "keep_bytes": sum(b['size'] or 0 for b, _ in kept),
+        "delete_bytes": sum(b['size'] or 0 for b, _ in deleted),
+    }
+
+    if not deleted:
+        logger.info("No files found.")
+        return plan
+
+    for backup, reason in deleted:
+        logger.info(f"{'Would delete' if dry_run else 'Deleting'} {backup['key']} ({reason})")
+    if dry_run:
+        return plan
+
+    # Expand directory backups into their objects; digest sidecars go with them
+    keys = []
+    owner = {}
+    for backup, _ in deleted:
+        if backup['key'].endswith('/'):
+            objects = [obj['Key'] for prefix in (backup['key'], catalog.DIGEST_PREFIX + backup['key'])
+                       for obj in catalog.iter_objects(config, prefix=prefix)]
+        else:
+            objects = [backup['key'], sidecar_key(backup['key'])]
+        keys.extend(objects)
+        for key in objects:
+            owner[key] = backup['key']
+
+    batches = [keys[i:i + DELETE_BATCH_SIZE] for i in range(0, len(keys), DELETE_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=workers or get_max_concurrency(config)) as pool:
+        failed = set().union(*pool.map(lambda batch: _delete_batch(s3, bucket, batch), batches))
 
-    for obj in response['Contents']:
-        last_modified = obj['LastModified']
-        age = (now - last_modified).days
-        if age >= retention_days:
-            logger.info(f"Deleting {obj['Key']} (age: {age} days)")
-            s3.delete_object(Bucket=bucket, Key=obj['Key'])
+    failed_backups = {owner[k] for k in failed}
+    removed = [b['key'] for b, _ in deleted if b['key'] not in failed_backups]
+    catalog.remove_backups(config, removed)
+    logger.info(f"Deleted {len(keys) - len(failed)} objects in {len(batches)} batches")
+    return plan
@@ -1,81 +1,203 @@
 #!/usr/bin/env python3
 
 import click
-import threading
 import os
 from datetime import datetime
 from config_loader import load_config
-from backup import mysql_backup, postgres_backup, incremental_backup
-from s3 import uploader
-from cleanup import s3_cleanup
 from utils.logger import logger
-from utils.email_notifier import EmailNotifier
-from scheduler import Scheduler
-from state_manager import StateManager
-from utils.mysql_log_check import is_binary_logging_enabled
-from utils.postgres_log_check import is_wal_archiving_enabled
 
 # Globals
 STATE_FILE = "schedules.json"
 LOG_FILE = "logs/backup.log"
+# The codecs of utils.compression.CODECS, spelled out so startup does not import the compression stack
+CODEC_CHOICES = ["gzip", "zstd", "lz4"]
 
-state_manager = StateManager()
-_scheduler = Scheduler(state_manager)
+# Backup, S3 and database modules are imported by the commands that use them, so
+# commands that only read local state start quickly
+_state_manager = None
+
+def get_state_manager():
+    global _state_manager
+    if _state_manager is None:
+        from state_manager import StateManager
+        _state_manager = StateManager()
+    return _state_manager
 
 def get_scheduler():
-    global _scheduler
-    if _scheduler is None:
-        _scheduler = Scheduler(state_manager)
-    return _scheduler
+    """A scheduler that edits and lists schedules; it never dispatches backups, the daemon does"""
+    from scheduler import Scheduler
+    return Scheduler(get_state_manager(), dispatch=False)
+
+def _daemon_call(method, path, payload=None):
+    """Ask the running scheduler daemon; None when there is none, so the caller works on saved state"""
+    import control
+    try:
+        return control.call(method, path, payload)
+    except control.DaemonUnavailable:
+        return None
+    except Exception as e:
+        raise click.ClickException(str(e))
+
+def _check_level(codec, level):
+    """Reject a compression level the codec does not accept before anything is dumped"""
+    if level is None:
+        return
+    from utils.compression import resolve_codec
+    try:
+        resolve_codec(codec, level)
+    except Exception as e:
+        raise click.BadParameter(str(e), param_hint="'--level'")
+
+def run_backup(config, db, count, tables, schema_only, data_only, compress, notify_email, incremental, stream=False, jobs=1,
+               codec=None, level=None, threads=1, dedup=False, target=None):
+    """Take `count` backups of one database; returns (uploaded files, error messages)"""
+    from backup import mysql_backup, postgres_backup, incremental_backup, pitr
+    from backup.jobs import complete_backup_job, resume_backup_job
+    from utils import metrics, encryption
+    from utils.compression import resolve_codec
+    from utils.email_notifier import get_notifier
+    from utils.mysql_log_check import is_binary_logging_enabled
+    from utils.postgres_log_check import is_wal_archiving_enabled
 
-def run_backup(config, db, count, tables, schema_only, data_only, compress, notify_email, incremental):
     tables_list = tables.split(',') if tables else None
-    emailer = EmailNotifier()
+    compress = compress or codec is not None
+    if compress:
+        # A bad level would otherwise only fail once compression starts, after the dump
+        resolve_codec(codec, level)
     uploaded_files = []
+    errors = []
     backup_success = True
 
+    # Finish jobs an earlier run left behind before starting new ones; the scheduler resumes its own
+    for job in get_state_manager().pending_backup_jobs(db, target):
+        if job["meta"].get("schedule_id"):
+            continue
+        try:
+            path = resume_backup_job(config, job, get_state_manager())
+            if path:
+                uploaded_files.append(path)
+        except Exception as e:
+            logger.error(f"Resuming backup job {job['id']} failed: {e}")
+            errors.append(str(e))
+            backup_success = False
+
     for i in range(count):
+        run = metrics.start_run(target or db, db)
+        failed = False
         try:
             date_str = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-            logger.info(f"Starting backup {i + 1} of {count} for {db}")
+            if target:
+                # Keeps names unique when several targets are backed up at the same second
+                date_str += f"@{target}"
+            logger.info(f"Starting backup {i + 1} of {count} for {target or db}")
 
-            # Incremental logic
-            if incremental:
+            # Dedup: dump -> content-defined chunks -> only new chunks to S3
+            if dedup:
+                if incremental:
+                    raise Exception("Dedup mode is only supported for full backups")
                 if db == 'mysql':
-                    if not is_binary_logging_enabled(config):
-                        raise Exception("Binary logging is not enabled for MySQL.")
-                    file_path = incremental_backup.mysql_incremental_backup(config, date_str)
+                    key = mysql_backup.backup_dedup(config, date_str, tables_list, schema_only, data_only, codec, level)
                 elif db == 'postgres':
-                    if not is_wal_archiving_enabled(config):
-                        raise Exception("WAL archiving is not enabled for PostgreSQL.")
-                    file_path = incremental_backup.postgres_incremental_backup(config, date_str)
+                    key = postgres_backup.backup_dedup(config, date_str, tables_list, schema_only, data_only, codec, level)
                 else:
-                    raise Exception("Unsupported DB type for incremental backup")
-            else:
+                    raise Exception("Unsupported DB type")
+                uploaded_files.append(key)
+                continue
+
+            # Streaming: dump -> compress -> S3 multipart, no local file
+            if stream:
+                if incremental and db == 'mysql':
+                    if not is_binary_logging_enabled(config):
+                        raise Exception("Binary logging is not enabled for MySQL.")
+                    key, binlog_end, log_entry = incremental_backup.mysql_incremental_backup(
+                        config, date_str, compress, codec, level, threads, stream=True)
+                    if key:
+                        incremental_backup.save_binlog_position(config, binlog_end)
+                        pitr.record_entry(config, key, log_entry)
+                        uploaded_files.append(key)
+                    continue
+                if incremental:
+                    raise Exception("Streaming mode is only supported for full and MySQL incremental backups")
                 if db == 'mysql':
-                    file_path = mysql_backup.backup(config, date_str, tables_list, schema_only, data_only, compress)
+                    key = mysql_backup.backup_stream(config, date_str, tables_list, schema_only, data_only, compress,
+                                                     codec, level, threads)
                 elif db == 'postgres':
-                    file_path = postgres_backup.backup(config, date_str, tables_list, schema_only, data_only, compress)
+                    key = postgres_backup.backup_stream(config, date_str, tables_list, schema_only, data_only, compress,
+                                                        codec, level, threads)
                 else:
                     raise Exception("Unsupported DB type")
+                uploaded_files.append(key)
+                continue
 
-            # Upload
-            uploader.upload_to_s3(file_path, config)
-            uploaded_files.append(file_path)
-            logger.info(f"Uploaded backup file {file_path} to S3")
+            if incremental and db == 'postgres':
+                if not is_wal_archiving_enabled(config):
+                    raise Exception("WAL archiving is not enabled for PostgreSQL.")
+                # WAL segments are shipped straight to S3, one object each
+                keys = incremental_backup.postgres_incremental_backup(config, date_str, True,
+                                                                      codec, level, threads)
+                uploaded_files.extend(keys)
+                continue
+            if db not in ('mysql', 'postgres'):
+                raise Exception("Unsupported DB type")
+
+            # Local dumps are journaled stage by stage, so a crash or a failed upload resumes
+            # from the last finished stage instead of dumping again
+            meta = {"compress": False, "codec": codec, "level": level, "threads": threads, "jobs": jobs}
+            job_id = get_state_manager().create_backup_job(db, target, meta)
+            try:
+                if incremental:
+                    if not is_binary_logging_enabled(config):
+                        raise Exception("Binary logging is not enabled for MySQL.")
+                    file_path, binlog_end, log_entry = incremental_backup.mysql_incremental_backup(
+                        config, date_str, compress, codec, level, threads)
+                    if file_path is None:
+                        get_state_manager().update_backup_job(job_id, stage="abandoned")
+                        continue
+                    # Only move the binlog position forward once the events are safely in S3
+                    meta["binlog_end"] = list(binlog_end)
+                    meta["log_entry"] = log_entry
+                elif jobs > 1:
+                    if db == 'mysql':
+                        file_path = mysql_backup.backup_parallel(config, date_str, jobs, tables_list, schema_only,
+                                                                 data_only, compress, codec, level)
+                    else:
+                        file_path = postgres_backup.backup_parallel(config, date_str, jobs, tables_list, schema_only,
+                                                                    data_only, compress, codec, level)
+                else:
+                    # Dump uncompressed; compression is its own journaled stage
+                    if db == 'mysql':
+                        file_path = mysql_backup.backup(config, date_str, tables_list, schema_only, data_only, False,
+                                                        codec, level, threads)
+                    else:
+                        file_path = postgres_backup.backup(config, date_str, tables_list, schema_only, data_only,
+                                                           False, codec, level, threads)
+                    meta["compress"] = compress
+                # Directories are encrypted file by file while they upload
+                meta["encrypt"] = encryption.enabled(config) and not os.path.isdir(file_path)
+                if db == 'mysql' and not (incremental or tables_list or schema_only or data_only):
+                    # Complete dumps that know their binlog position are point-in-time recovery bases
+                    meta["log_entry"] = pitr.full_backup_entry(config, file_path)
+            except BaseException as e:
+                get_state_manager().update_backup_job(job_id, stage="abandoned", error=str(e))
+                raise
+
+            get_state_manager().update_backup_job(job_id, stage="dumped", path=file_path, meta=meta)
+            job = {"id": job_id, "stage": "dumped", "path": str(file_path), "meta": meta}
+            try:
+                uploaded_files.append(complete_backup_job(config, job, get_state_manager()))
+            except Exception as e:
+                # Keep the local dump: the next run resumes the upload instead of dumping again
+                get_state_manager().update_backup_job(job_id, error=str(e))
+                logger.warning(f"Kept the local dump of backup job {job_id} for a retry")
+                raise
 
         except Exception as e:
             logger.error(f"Backup failed: {e}")
+            errors.append(str(e))
             backup_success = False
-
+            failed = True
         finally:
-            # Always clean up local backup file
-            try:
-                if 'file_path' in locals() and os.path.exists(file_path):
-                    os.remove(file_path)
-                    logger.info(f"Deleted local file: {file_path}")
-            except Exception as cleanup_err:
-                logger.warning(f"Failed to delete local file: {cleanup_err}")
+            metrics.finish_run(config, run, not failed)
 
     if backup_success:
         logger.info("All backups and uploads completed successfully.")
@@ -83,19 +205,54 @@ def run_backup(config, db, count, tables, schema_only, data_only, compress, noti
         logger.warning("Backup process completed with errors.")
 
     if notify_email:
-        t = threading.Thread(
-            target=emailer.notify_in_background,
-            args=(config, notify_email, uploaded_files, db, count, backup_success)
-        )
-        t.daemon = True
-        t.start()
+        get_notifier().notify(config, notify_email, uploaded_files, db, count, backup_success, errors)
+
+    return uploaded_files, errors
+
+def run_target_backups(config, names, parallelism, per_host_limit, options):
+    """Back up several named targets concurrently and print a report; returns the per-target results"""
+    from backup import targets
+
+    selected = targets.select_targets(config, names)
+    if not selected:
+        raise Exception("No targets configured")
+
+    def run(target_conf, target):
+        opts = dict(options, **(target.get("options") or {}))
+        files, errors = run_backup(target_conf, target["type"], opts["count"], opts["tables"], opts["schema_only"],
+                                   opts["data_only"], opts["compress"], None, opts["incremental"], opts["stream"],
+                                   opts["jobs"], opts["codec"], opts["level"], opts["threads"], opts["dedup"],
+                                   target=target["name"])
+        if errors:
+            raise Exception("; ".join(errors))
+        return files
+
+    started = datetime.now()
+    results = targets.run_targets(config, selected, run, parallelism, per_host_limit)
+    elapsed = (datetime.now() - started).total_seconds()
+
+    for result in results:
+        status = "OK" if result["success"] else "FAILED"
+        click.echo(f"{result['target']:<24} {result['type']:<9} {result['host']:<28} {status:<7} "
+                   f"{len(result['files']):>4} file(s) {result['duration']:>8.1f}s")
+        if result["error"]:
+            click.echo(f"    {result['error']}")
+    serial = sum(r["duration"] for r in results)
+    failed = sum(1 for r in results if not r["success"])
+    click.echo(f"{len(results) - failed}/{len(results)} targets succeeded in {elapsed:.1f}s "
+               f"({serial:.1f}s of backup work)")
+    return results
 
 @click.group()
 def cli():
     pass
 
 @cli.command()
-@click.option('--db', required=True, type=click.Choice(['postgres', 'mysql']))
+@click.option('--db', default=None, type=click.Choice(['postgres', 'mysql']))
+@click.option('--targets', 'target_names', default=None, help='Comma-separated names of configured targets to back up')
+@click.option('--all', 'all_targets', is_flag=True, help='Back up every configured target')
+@click.option('--parallel', default=None, type=click.IntRange(min=1), help='Targets to back up at once')
+@click.option('--per-host', default=None, type=click.IntRange(min=1), help='Targets to back up at once on one host')
 @click.option('--count', default=1, help='Number of backups to take immediately')
 @click.option('--tables', default=None, help='Comma-separated list of tables')
 @click.option('--schema-only', is_flag=True)
@@ -103,60 +260,246 @@ def cli():
 @click.option('--compress', is_flag=True)
 @click.option('--notify', default=None, help='Email address to notify after upload completes')
 @click.option('--incremental', is_flag=True, help='Perform an incremental backup')
-def backup(db, count, tables, schema_only, data_only, compress, notify, incremental):
+@click.option('--stream', is_flag=True, help='Stream the dump straight to S3 without a local file')
+@click.option('--jobs', default=1, type=click.IntRange(min=1), help='Dump tables in parallel with N workers')
+@click.option('--codec', default=None, type=click.Choice(CODEC_CHOICES), help='Compression codec (implies --compress)')
+@click.option('--level', default=None, type=int, help='Compression level for the codec')
+@click.option('--threads', default=1, type=click.IntRange(min=1), help='Compression threads')
+@click.option('--dedup', is_flag=True, help='Upload only chunks not already stored by earlier backups')
+def backup(db, target_names, all_targets, parallel, per_host, count, tables, schema_only, data_only, compress, notify,
+           incremental, stream, jobs, codec, level, threads, dedup):
     """Take immediate backups"""
+    _check_level(codec, level)
     config = load_config()
-    run_backup(config, db, count, tables, schema_only, data_only, compress, notify, incremental)
+    if target_names or all_targets:
+        if db:
+            raise click.UsageError("--db cannot be combined with --targets/--all.")
+        options = dict(count=count, tables=tables, schema_only=schema_only, data_only=data_only, compress=compress,
+                       incremental=incremental, stream=stream, jobs=jobs, codec=codec, level=level, threads=threads,
+                       dedup=dedup)
+        names = None if all_targets else [name.strip() for name in target_names.split(',') if name.strip()]
+        try:
+            results = run_target_backups(config, names, parallel, per_host, options)
+        except Exception as e:
+            raise click.ClickException(str(e))
+        failed = [r["target"] for r in results if not r["success"]]
+        if failed:
+            raise click.ClickException(f"Backup failed for: {', '.join(failed)}")
+        return
+    if not db:
+        raise click.UsageError("Give --db, --targets or --all.")
+    run_backup(config, db, count, tables, schema_only, data_only, compress, notify, incremental, stream, jobs,
+               codec, level, threads, dedup)
+
+@cli.command()
+def resume():
+    """Finish backup jobs an earlier run left dumped but not uploaded"""
+    from backup import targets
+    from backup.jobs import resume_backup_job
+
+    config = load_config()
+    pending = get_state_manager().pending_backup_jobs()
+    if not pending:
+        click.echo("No unfinished backup jobs.")
+        return
+    configured = targets.load_targets(config)
+    failed = 0
+    for job in pending:
+        job_config = config
+        if job["target"]:
+            if job["target"] not in configured:
+                click.echo(f"Skipping job {job['id']}: target {job['target']} is no longer configured")
+                continue
+            job_config = targets.target_config(config, configured[job["target"]])
+        elif job["meta"].get("config_path"):
+            # Left by a scheduled run, which reads the config its schedule names
+            job_config = get_state_manager().load_config(job["meta"]["config_path"])
+        try:
+            path = resume_backup_job(job_config, job, get_state_manager())
+            click.echo(f"Job {job['id']}: " + (f"uploaded {path}" if path else "discarded"))
+        except Exception as e:
+            failed += 1
+            click.echo(f"Job {job['id']}: failed again: {e}")
+    if failed:
+        raise click.ClickException(f"{failed} job(s) still unfinished")
 
 @cli.command()
 @click.option('--db', required=True, type=click.Choice(['postgres', 'mysql']))
-@click.option('--count', required=True, type=int, help='Number of backups to generate')
-@click.option('--gap', required=True, type=int, help='Gap between backups in days')
+@click.option('--count', default=None, type=int, help='Number of backups to generate (default: until cancelled)')
+@click.option('--gap', default=None, type=int, help='Gap between backups in days')
+@click.option('--every', default=None, type=click.IntRange(min=1), help='Gap between backups in minutes')
+@click.option('--cron', default=None, help="Cron expression for backup times, e.g. '0 2 * * *'")
+@click.option('--catch-up', default='once', type=click.Choice(['skip', 'once', 'all']),
+              help='What to do about runs missed while the scheduler was down')
+@click.option('--id', 'schedule_id', default=None, help='Schedule id (replaces an existing schedule with this id)')
 @click.option('--tables', default=None, help='Comma-separated list of tables')
 @click.option('--schema-only', is_flag=True)
 @click.option('--data-only', is_flag=True)
 @click.option('--compress', is_flag=True)
 @click.option('--notify', default=None, help='Email address to notify after each backup')
-def schedule(db, count, gap, tables, schema_only, data_only, compress, notify):
+@click.option('--codec', default=None, type=click.Choice(CODEC_CHOICES), help='Compression codec (implies --compress)')
+@click.option('--level', default=None, type=int, help='Compression level for the codec')
+@click.option('--threads', default=1, type=click.IntRange(min=1), help='Compression threads')
+def schedule(db, count, gap, every, cron, catch_up, schedule_id, tables, schema_only, data_only, compress, notify,
+             codec, level, threads):
     """Schedule recurring backups"""
-    get_scheduler().add_schedule(
+    if sum(option is not None for option in (gap, every, cron)) != 1:
+        raise click.UsageError("Give exactly one of --gap, --every or --cron.")
+    _check_level(codec, level)
+    options = dict(
         db=db,
         count=count,
         gap=gap,
         tables=tables,
         schema_only=schema_only,
         data_only=data_only,
-        compress=compress,
-        notify=notify
+        compress=compress or codec is not None,
+        notify=notify,
+        codec=codec,
+        level=level,
+        threads=threads,
+        schedule_id=schedule_id,
+        cron=cron,
+        interval=every * 60 if every else None,
+        catch_up=catch_up
     )
-    click.echo(f"Scheduled {count} backups for {db} every {gap} day(s).")
+    try:
+        result = _daemon_call("POST", "/schedules", dict(options, config_path=os.path.abspath("config.yaml")))
+        if result is None:
+            result = {"id": get_scheduler().add_schedule(**options)}
+            click.echo("Scheduler daemon is not running; the schedule starts when it does.")
+    except Exception as e:
+        raise click.ClickException(str(e))
+    schedule_id = result["id"]
+    when = f"at '{cron}'" if cron else f"every {every} minute(s)" if every else f"every {gap} day(s)"
+    total = f"{count} backups" if count else "backups"
+    click.echo(f"Scheduled {total} for {db} {when} (id {schedule_id}).")
 
 @cli.command()
 def status():
     """Show all active backup schedules"""
-    schedules = get_scheduler().get_active_schedules()
+    result = _daemon_call("GET", "/status")
+    if result is None:
+        click.echo("Scheduler daemon is not running; showing saved schedules.")
+        schedules = get_scheduler().get_active_schedules()
+    else:
+        schedules = result["schedules"]
     if not schedules:
         click.echo("No active schedules.")
         return
-    for db, details in schedules.items():
-        click.echo(f"DB: {db}")
-        click.echo(f"  Count: {details['count']}")
-        click.echo(f"  Gap (days): {details['gap']}")
+    for schedule_id, details in schedules.items():
+        click.echo(f"Schedule: {schedule_id}" + (" (running)" if details.get('running') else ""))
+        click.echo(f"  DB: {details['db']}")
+        click.echo(f"  Count: {details['count'] or 'until cancelled'}")
+        if details.get('cron'):
+            click.echo(f"  Cron: {details['cron']}")
+        else:
+            click.echo(f"  Every: {details['interval'] // 60} minute(s)")
+        click.echo(f"  Catch-up: {details.get('catch_up', 'once')}")
+        click.echo(f"  Next run: {details.get('next_run')}")
         click.echo(f"  Backups completed: {details['completed']}")
+        if details.get('last_error'):
+            click.echo(f"  Last error: {details['last_error']}")
         click.echo(f"  Tables: {details['tables']}")
         click.echo(f"  Schema only: {details['schema_only']}")
         click.echo(f"  Data only: {details['data_only']}")
         click.echo(f"  Compress: {details['compress']}")
+        if details['compress']:
+            click.echo(f"  Codec: {details.get('codec') or 'gzip'}")
         click.echo(f"  Notify email: {details['notify']}")
 
 @cli.command()
-@click.option('--db', required=True, type=click.Choice(['postgres', 'mysql']))
-def cancel(db):
-    """Cancel active backup schedule for a database"""
-    if get_scheduler().cancel_schedule(db):
-        click.echo(f"Cancelled schedule for {db}.")
+@click.option('--db', default=None, type=click.Choice(['postgres', 'mysql']), help='Cancel every schedule for this database')
+@click.option('--id', 'schedule_id', default=None, help='Cancel one schedule by id')
+def cancel(db, schedule_id):
+    """Cancel active backup schedules"""
+    if not db and not schedule_id:
+        raise click.UsageError("Give --db or --id.")
+    result = _daemon_call("POST", "/schedules/cancel", {"id": schedule_id, "db": db})
+    if result is None:
+        cancelled = get_scheduler().cancel_schedule(schedule_id=schedule_id, db=db)
+    else:
+        cancelled = result["cancelled"]
+    if cancelled:
+        click.echo(f"Cancelled schedule(s): {', '.join(cancelled)}.")
+    else:
+        click.echo("No matching active schedule found.")
+
+@cli.command(name="run-now")
+@click.option('--id', 'schedule_id', required=True, help='Schedule to run')
+def run_now(schedule_id):
+    """Run a scheduled backup now, without moving its next run"""
+    if _daemon_call("POST", f"/schedules/{schedule_id}/run") is None:
+        raise click.ClickException("Scheduler daemon is not running; start it with run_scheduler.py.")
+    click.echo(f"Started schedule {schedule_id}; follow it with `progress`.")
+
+def _megabytes(size):
+    return f"{size / (1024 * 1024):.1f} MB" if size is not None else "-"
+
+@cli.command()
+def progress():
+    """Show backups the scheduler is running and the most recent jobs"""
+    result = _daemon_call("GET", "/progress")
+    if result is None:
+        click.echo("Scheduler daemon is not running.")
+        recent = get_state_manager().job_history(limit=10)
+    else:
+        recent = result["recent"]
+        if not result["running"]:
+            click.echo("No backups running.")
+        for job in result["running"]:
+            click.echo(f"Schedule: {job['schedule_id']} ({job['db']})" + (" run by hand" if job['manual'] else ""))
+            click.echo(f"  Running for: {job['seconds']:.0f}s")
+            if job['stage']:
+                click.echo(f"  Stage: {job['stage']} for {job['stage_seconds']:.0f}s, "
+                           f"{_megabytes(job['bytes_in'])} in, {_megabytes(job['bytes_out'])} out")
+            for stage in job['stages_done']:
+                click.echo(f"  Done: {stage['stage']} in {stage['seconds']:.1f}s, {_megabytes(stage['bytes_out'])}")
+    if recent:
+        click.echo("Recent jobs:")
+    for job in recent:
+        line = f"  {job['started_at']}  {job['schedule_id']} ({job['db']})  {job['status']}"
+        if job['error']:
+            line += f": {job['error']}"
+        click.echo(line)
+
+@cli.command(name="binlog-stream")
+@click.option('--dir', 'output_dir', default=None, help='Local directory for in-progress binlog files')
+@click.option('--interval', default=10, type=int, help='Seconds between checks for rotated binlogs')
+@click.option('--codec', default='zstd', type=click.Choice(CODEC_CHOICES), help='Compression codec')
+@click.option('--level', default=None, type=int, help='Compression level for the codec')
+@click.option('--threads', default=1, type=click.IntRange(min=1), help='Compression threads')
+def binlog_stream(output_dir, interval, codec, level, threads):
+    """Continuously stream MySQL binlogs and ship each one to S3 as it closes"""
+    from backup import incremental_backup
+    from utils.mysql_log_check import is_binary_logging_enabled
+
+    _check_level(codec, level)
+    config = load_config()
+    if not is_binary_logging_enabled(config):
+        raise click.ClickException("Binary logging is not enabled for MySQL.")
+    incremental_backup.binlog_daemon(config, output_dir, interval, codec, level, threads)
+
+@cli.command(name="wal-ship")
+@click.option('--watch', is_flag=True, help='Keep running and ship WAL files as they appear')
+@click.option('--interval', default=10, type=int, help='Seconds between archive checks in --watch mode')
+@click.option('--jobs', default=4, type=click.IntRange(min=1), help='Segments compressed and uploaded in parallel')
+@click.option('--codec', default='zstd', type=click.Choice(CODEC_CHOICES), help='Compression codec')
+@click.option('--level', default=None, type=int, help='Compression level for the codec')
+def wal_ship(watch, interval, jobs, codec, level):
+    """Ship new PostgreSQL WAL segments to S3"""
+    from backup import wal_shipper
+    from utils.postgres_log_check import is_wal_archiving_enabled
+
+    _check_level(codec, level)
+    config = load_config()
+    if not is_wal_archiving_enabled(config):
+        raise click.ClickException("WAL archiving is not enabled for PostgreSQL.")
+    if watch:
+        wal_shipper.watch(config, interval, jobs, codec, level)
     else:
-        click.echo(f"No active schedule found for {db}.")
+        keys = wal_shipper.ship_new_segments(config, jobs, codec, level)
+        click.echo(f"Shipped {len(keys)} WAL files.")
 
 @cli.command()
 @click.option('--lines', default=20, help='Number of log lines to show')
@@ -171,20 +514,53 @@ def logs(lines):
         click.echo(line.rstrip())
 
 @cli.command()
-@click.option('--retention-days', required=True, type=int, help="Delete backups older than N days from S3")
-def cleanup(retention_days):
+@click.option('--retention-days', default=None, type=int, help="Delete backups older than N days from S3")
+@click.option('--keep-daily', default=None, type=int, help='Keep the newest full backup of each of the last N days')
+@click.option('--keep-weekly', default=None, type=int, help='Keep the newest full backup of each of the last N weeks')
+@click.option('--keep-monthly', default=None, type=int, help='Keep the newest full backup of each of the last N months')
+@click.option('--dry-run', is_flag=True, help='Only print what would be deleted')
+@click.option('--refresh', is_flag=True, help='Reconcile the local catalog with S3 first')
+@click.option('--gc-chunks', is_flag=True, help='Also delete dedup chunks no manifest references')
+def cleanup(retention_days, keep_daily, keep_weekly, keep_monthly, dry_run, refresh, gc_chunks):
     """Cleanup old backups from S3"""
+    from backup import dedup
+    from cleanup import s3_cleanup
+
+    if retention_days is None and not any((keep_daily, keep_weekly, keep_monthly)):
+        raise click.UsageError("Give --retention-days and/or --keep-daily/--keep-weekly/--keep-monthly")
     config = load_config()
-    click.echo(f"Starting cleanup for backups older than {retention_days} days")
-    s3_cleanup.cleanup_s3(config, retention_days)
+    click.echo("Starting cleanup" + (f" for backups older than {retention_days} days" if retention_days is not None else ""))
+    plan = s3_cleanup.cleanup_s3(config, retention_days, keep_daily, keep_weekly, keep_monthly, dry_run, refresh)
+    if dry_run:
+        for backup, reason in plan['delete']:
+            click.echo(f"DELETE {backup['key']} ({reason}, {backup['size'] or 0} bytes)")
+        for backup, reason in plan['keep']:
+            click.echo(f"KEEP   {backup['key']} ({reason})")
+        click.echo(f"Would delete {len(plan['delete'])} backups ({plan['delete_bytes'] / 1024 / 1024:.2f} MB), "
+                   f"keep {len(plan['keep'])} ({plan['keep_bytes'] / 1024 / 1024:.2f} MB)")
+    if gc_chunks:
+        # Runs after the manifests are gone so their chunks show up as unreferenced
+        orphans = dedup.gc_chunks(config, dry_run=dry_run)
+        click.echo(f"{'Would delete' if dry_run else 'Deleted'} {len(orphans)} unreferenced dedup chunks")
+    if dry_run:
+        return
     click.echo(f"Cleanup completed.")
 
 @cli.command()
 @click.option('--db', type=click.Choice(['postgres', 'mysql']), default=None, help='Filter backups by DB type')
-def list_backups(db):
+@click.option('--type', 'backup_type', type=click.Choice(['full', 'incremental']), default=None,
+              help='Filter backups by type')
+@click.option('--since', type=click.DateTime(), default=None, help='Only backups taken at or after this time')
+@click.option('--until', type=click.DateTime(), default=None, help='Only backups taken at or before this time')
+@click.option('--target', default=None, help='Filter backups by configured target name')
+@click.option('--refresh', is_flag=True, help='Reconcile the local catalog with S3 first')
+def list_backups(db, backup_type, since, until, target, refresh):
     """List all backups uploaded to S3"""
+    from s3 import uploader
+
     config = load_config()
-    backups = uploader.list_backups(config, db_filter=db)
+    backups = uploader.list_backups(config, db_filter=db, backup_type=backup_type, since=since, until=until,
+                                    refresh=refresh, target=target)
 
     if not backups:
         click.echo("No backups found.")
@@ -194,7 +570,115 @@ def list_backups(db):
     for backup in sorted(backups, key=lambda x: x['last_modified'], reverse=True):
         size_kb = backup['size'] / 1024
         timestamp = backup['last_modified'].strftime('%Y-%m-%d %H:%M:%S')
-        logger.info(f"- {backup['key']} | Uploaded at: {timestamp} | Size: {size_kb:.2f} KB")
+        codec = backup.get('codec') or 'none'
+        logger.info(f"- {backup['key']} | Uploaded at: {timestamp} | Size: {size_kb:.2f} KB | Codec: {codec}")
+
+@cli.command(name="verify")
+@click.option('--key', 'keys', multiple=True, help='Backup key to verify (repeatable; default: every catalogued backup)')
+@click.option('--db', type=click.Choice(['postgres', 'mysql']), default=None, help='Only backups of this DB type')
+@click.option('--type', 'backup_type', type=click.Choice(['full', 'incremental']), default=None,
+              help='Only backups of this type')
+@click.option('--since', type=click.DateTime(), default=None, help='Only backups taken at or after this time')
+@click.option('--target', default=None, help='Only backups of this configured target')
+@click.option('--sample', is_flag=True, help='Check random blocks of the backups until --budget runs out')
+@click.option('--budget', default=60.0, type=click.FloatRange(min=0), help='Seconds to spend in --sample mode')
+@click.option('--concurrency', default=None, type=click.IntRange(min=1), help='Ranged GETs in flight')
+def verify_command(keys, db, backup_type, since, target, sample, budget, concurrency):
+    """Check backups in S3 against the digests recorded at upload, without downloading them to disk"""
+    from backup import verify
+    from s3 import uploader
+
+    config = load_config()
+    try:
+        if not keys:
+            keys = [b["key"] for b in uploader.list_backups(config, db_filter=db, backup_type=backup_type, since=since,
+                                                            target=target)]
+        if not keys:
+            click.echo("No backups found.")
+            return
+        if sample:
+            results = verify.verify_sample(config, list(keys), budget, concurrency)
+        else:
+            results = [verify.verify_backup(config, key, concurrency) for key in keys]
+    except Exception as e:
+        raise click.ClickException(str(e))
+
+    for result in results:
+        click.echo(f"{result['status'].upper():<10} {result['key']} ({result['checked']} blocks, "
+                   f"{result['bytes'] / 1024 / 1024:.1f} MB)")
+        for error in result["errors"]:
+            click.echo(f"    {error}")
+        for object_key in result["unverified"]:
+            click.echo(f"    no digest recorded for {object_key}")
+    failed = [r["key"] for r in results if r["status"] == "failed"]
+    if failed:
+        raise click.ClickException(f"{len(failed)} of {len(results)} backups failed verification")
+
+@cli.command(name="restore")
+@click.option('--key', default=None, help='Backup key to restore (default: the latest full backup)')
+@click.option('--db', type=click.Choice(['postgres', 'mysql']), default=None, help='Database type to restore into')
+@click.option('--target', 'target_name', default=None, help='Configured target to restore into')
+@click.option('--tables', default=None, help='Comma-separated tables (per-table and directory backups only)')
+@click.option('--jobs', default=4, type=click.IntRange(min=1), help='Tables restored in parallel')
+@click.option('--clean', is_flag=True, help='Drop objects before recreating them (pg_restore only)')
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation')
+def restore_command(key, db, target_name, tables, jobs, clean, yes):
+    """Restore a backup from S3 into the configured database"""
+    from backup import restore, targets
+    from s3 import catalog
+
+    config = load_config()
+    try:
+        if target_name:
+            target = targets.select_targets(config, [target_name])[0]
+            if db and db != target["type"]:
+                raise click.UsageError(f"Target {target_name} is a {target['type']} database")
+            config, db = targets.target_config(config, target), target["type"]
+        key = restore.resolve_backup(config, key, db, target_name)
+        key_db = catalog.parse_backup_key(key)[0]
+        if not yes:
+            click.confirm(f"Restore {key} into {key_db} database {config[key_db]['database']}?", abort=True)
+        tables_list = [t.strip() for t in tables.split(',') if t.strip()] if tables else None
+        restore.restore(config, key, db, target_name, tables_list, jobs, clean)
+    except (click.ClickException, click.Abort):
+        raise
+    except Exception as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Restored {key}.")
+
+@cli.command(name="pitr")
+@click.option('--to', 'to_time', required=True, type=click.DateTime(), help='Recover MySQL to this local time')
+@click.option('--target', 'target_name', default=None, help='Configured target to recover')
+@click.option('--dry-run', is_flag=True, help='Only print the recovery plan')
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation')
+def pitr_command(to_time, target_name, dry_run, yes):
+    """Point-in-time recovery: latest full backup before --to plus the binlog incrementals after it"""
+    from backup import pitr, targets
+
+    config = load_config()
+    try:
+        if target_name:
+            target = targets.select_targets(config, [target_name])[0]
+            if target["type"] != "mysql":
+                raise click.UsageError("Point-in-time recovery needs a MySQL target")
+            config = targets.target_config(config, target)
+        started = datetime.now()
+        recovery_plan = pitr.plan(config, to_time, target_name)
+        elapsed_ms = (datetime.now() - started).total_seconds() * 1000
+        click.echo(f"Base:  {recovery_plan['base']['key']} ({recovery_plan['base']['end_time']})")
+        for segment in recovery_plan["logs"]:
+            click.echo(f"Apply: {segment['key']} ({segment['start_time']} - {segment['end_time']})")
+        click.echo(f"Stop at {recovery_plan['stop_time']}; planned in {elapsed_ms:.1f} ms")
+        if dry_run:
+            return
+        if not yes:
+            click.confirm(f"Recover {config['mysql']['database']} to {recovery_plan['stop_time']}?", abort=True)
+        pitr.replay(config, recovery_plan)
+    except (click.ClickException, click.Abort):
+        raise
+    except Exception as e:
+        raise click.ClickException(str(e))
+    click.echo("Point-in-time recovery completed.")
 
 @cli.command(name="load-config")
 @click.option('--path', prompt="Enter YAML config file path", help="Path to your config.yaml file")
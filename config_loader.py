@@ -1,5 +1,4 @@
-import yaml
-
 def load_config(path='config.yaml'):
+    import yaml
     with open(path, 'r') as file:
         return yaml.safe_load(file)
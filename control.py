@@ -0,0 +1,49 @@
+"""
+Client of the scheduler daemon's control socket: JSON over HTTP on a Unix socket.
+
+    GET  /status               active schedules, live from the daemon's memory
+    GET  /progress             running backups with their current stage, and recent jobs
+    POST /schedules            add (or replace) a schedule, body: add_schedule's arguments
+    POST /schedules/cancel     body: {"id": ...} or {"db": ...}
+    POST /schedules/<id>/run   run a schedule now, outside its timetable
+
+The socket is config/scheduler.sock unless DBBACKUP_SOCKET names another path. Only
+its owner may connect. The daemon's side is in control_server.py; this module stays
+small because every CLI command that reads schedules imports it.
+"""
+import json
+import os
+
+DEFAULT_SOCKET = os.path.join("config", "scheduler.sock")
+
+
+class DaemonUnavailable(Exception):
+    """No scheduler daemon is listening on the control socket"""
+
+
+def socket_path():
+    return os.getenv("DBBACKUP_SOCKET", DEFAULT_SOCKET)
+
+
+def call(method, path, payload=None, timeout=10):
+    """Send one request to the daemon and return its JSON answer"""
+    address = socket_path()
+    if not os.path.exists(address):
+        raise DaemonUnavailable(f"Scheduler daemon is not running (no socket at {address})")
+    from utils.docker_helper import UnixHTTPConnection
+
+    conn = UnixHTTPConnection(address, timeout=timeout)
+    try:
+        try:
+            conn.connect()
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise DaemonUnavailable(f"Scheduler daemon is not running ({e})")
+        body = json.dumps(payload).encode() if payload is not None else None
+        conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        data = json.loads(response.read() or b"{}")
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise Exception(data.get("error") or f"Scheduler daemon returned {response.status}")
+    return data
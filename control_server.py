@@ -0,0 +1,125 @@
+"""
+Daemon side of the control socket; the endpoints are listed in control.py.
+"""
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from control import socket_path
+from utils.logger import logger
+
+HISTORY_LIMIT = 10
+
+
+def _progress(scheduler):
+    now = time.monotonic()
+    running = []
+    for schedule_id, job in scheduler.get_progress().items():
+        stage = job["run"].current
+        running.append({
+            "schedule_id": schedule_id,
+            "db": job["db"],
+            "job_id": job["job_id"],
+            "manual": job["manual"],
+            "seconds": round(now - job["started"], 1),
+            "stage": stage.name if stage else None,
+            "stage_seconds": round(now - stage.started, 1) if stage else None,
+            "bytes_in": stage.bytes_in if stage else None,
+            "bytes_out": stage.bytes_out if stage else None,
+            "stages_done": [{"stage": e["stage"], "seconds": e["seconds"], "bytes_out": e["bytes_out"]}
+                            for e in job["run"].stages],
+        })
+    return {"running": running, "recent": scheduler.state_manager.job_history(limit=HISTORY_LIMIT)}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _reply(self, status, data):
+        body = json.dumps(data, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _payload(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _handle(self, routes):
+        scheduler = self.server.scheduler
+        path = self.path.rstrip("/")
+        try:
+            if path in routes:
+                result = routes[path](scheduler)
+            elif self.command == "POST" and path.startswith("/schedules/") and path.endswith("/run"):
+                schedule_id = path[len("/schedules/"):-len("/run")]
+                result = {"id": scheduler.run_now(schedule_id)}
+            else:
+                self._reply(404, {"error": f"No such endpoint: {self.command} {self.path}"})
+                return
+        except Exception as e:
+            self._reply(400, {"error": str(e)})
+            return
+        self._reply(200, result)
+
+    def do_GET(self):
+        self._handle({
+            "/status": lambda s: {"schedules": s.get_active_schedules()},
+            "/progress": _progress,
+        })
+
+    def do_POST(self):
+        payload = self._payload()
+        self._handle({
+            "/schedules": lambda s: {"id": s.add_schedule(**payload)},
+            "/schedules/cancel": lambda s: {"cancelled": s.cancel_schedule(schedule_id=payload.get("id"),
+                                                                           db=payload.get("db"))},
+        })
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return "control"
+
+    def log_message(self, format, *args):
+        logger.debug("Control socket: " + format % args)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(scheduler, path=None):
+    """Start answering control requests in a background thread; returns the server (call shutdown() to stop)"""
+    path = path or socket_path()
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            raise Exception(f"Another scheduler daemon is listening on {path}")
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Left behind by a daemon that did not exit cleanly
+            os.unlink(path)
+        finally:
+            probe.close()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    umask = os.umask(0o177)
+    try:
+        server = _Server(path, _Handler)
+    finally:
+        os.umask(umask)
+    server.scheduler = scheduler
+    threading.Thread(target=server.serve_forever, name="control", daemon=True).start()
+    logger.info(f"Control socket listening on {path}")
+    return server
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+    try:
+        os.unlink(server.server_address)
+    except OSError:
+        pass
@@ -1,26 +1,57 @@
 import smtplib
 from email.message import EmailMessage
+from utils.logger import logger
 
 class EmailSender:
+    """One SMTP session that stays open between messages and reconnects when the server dropped it"""
+
     def __init__(self, config):
         self.config = config['email']
+        self.server = None
 
-    def send_notification(self, subject, body, to_email):
-        # Use to_email from argument instead of hardcoded
-        smtp_server = self.config['smtp_server']
-        smtp_port = self.config['smtp_port']
-        smtp_user = self.config['username']
-        smtp_pass = self.config['password']
-        from_addr = self.config['from']
+    def _connect(self):
+        server = smtplib.SMTP(self.config['smtp_server'], self.config['smtp_port'], timeout=30)
+        try:
+            if self.config.get('starttls', True):
+                server.starttls()
+            # Local relays often take mail without logging in
+            if self.config.get('username'):
+                server.login(self.config['username'], self.config['password'])
+        except Exception:
+            server.close()
+            raise
+        return server
 
+    def send(self, msg):
+        for attempt in (1, 2):
+            if self.server is None:
+                self.server = self._connect()
+            try:
+                self.server.send_message(msg)
+                return
+            except OSError as e:
+                if isinstance(e, smtplib.SMTPException) and not isinstance(e, smtplib.SMTPServerDisconnected):
+                    # Refused by the server, a new connection would not help
+                    raise
+                # An idle session may have been closed by the server; one fresh connection gets a retry
+                self.server.close()
+                self.server = None
+                if attempt == 2:
+                    raise
+                logger.info(f"SMTP session lost ({e}), reconnecting")
+
+    def send_notification(self, subject, body, to_email):
         msg = EmailMessage()
         msg['Subject'] = subject
-        msg['From'] = from_addr
+        msg['From'] = self.config['from']
         msg['To'] = to_email
         msg.set_content(body)
+        self.send(msg)
 
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            if self.config.get('starttls', True):
-                server.starttls()
-            server.login(smtp_user, smtp_pass)
-            server.send_message(msg)
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                self.server.close()
+            self.server = None
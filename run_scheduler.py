@@ -1,13 +1,36 @@
 #!/usr/bin/env python3
 
-from scheduler import Scheduler
+from scheduler import Scheduler, DEFAULT_MAX_WORKERS, DEFAULT_PER_HOST_LIMIT
 from state_manager import StateManager
 from utils.logger import logger
+import control_server
+import signal
+import sys
 import time
 
-if __name__ == "__main__":
+
+def main():
+    # Exit normally on SIGTERM so queued notifications are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     state_mgr = StateManager()
-    scheduler = Scheduler(state_mgr)
+    try:
+        settings = state_mgr.load_config().get("scheduler") or {}
+    except FileNotFoundError:
+        settings = {}
+    scheduler = Scheduler(state_mgr, settings.get("max_workers", DEFAULT_MAX_WORKERS),
+                          settings.get("per_host_limit", DEFAULT_PER_HOST_LIMIT), dispatch=False)
+    # The CLI sends schedule changes here, so they apply without a restart. Only the daemon
+    # that owns the socket runs backups: a second one fails here before anything is due.
+    server = control_server.serve(scheduler)
+    scheduler.start()
     logger.info("Scheduler started. Waiting for scheduled tasks...")
-    while True:
-        time.sleep(60)
\ No newline at end of file
+    try:
+        while True:
+            time.sleep(60)
+    finally:
+        control_server.stop(server)
+        scheduler.stop(wait=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+import os
+import re
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime, timezone
+from utils.logger import logger
+from utils.compression import detect_codec
+from s3.client import get_client
+
+DEFAULT_CATALOG_FILE = os.path.join("config", "catalog.db")
+
+# Content-addressed chunks of dedup backups and shipped WAL files are tracked in their
+# own tables, never as backups, so retention cleanup cannot touch them
+CHUNK_PREFIX = "chunks/"
+WAL_PREFIX = "wal/"
+# Leases of running dedup backups and the chunk GC marker (backup/dedup.py)
+LOCK_PREFIX = "dedup-locks/"
+# Digest sidecars (s3/digests.py) are deleted together with their backups
+DIGEST_PREFIX = "digests/"
+
+# e.g. mysql_backup_2026-10-01-02-00-00.sql.zst, pg_inc_backup_2026-10-01-02-00-00.tar.gz,
+# postgres_backup_2026-10-01-02-00-00/ (parallel/directory backups),
+# mysql_backup_2026-10-01-02-00-00@orders.sql.gz (backup of the named target "orders")
+KEY_PATTERN = re.compile(
+    r"^(?P<db>mysql|postgres|pg)_(?P<kind>backup|incremental_backup|inc_backup)_"
+    r"(?P<ts>\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})(?:@(?P<target>[A-Za-z0-9-]+))?"
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    key TEXT PRIMARY KEY,
+    db TEXT,
+    target TEXT,
+    type TEXT,
+    timestamp TEXT,
+    size INTEGER,
+    codec TEXT,
+    checksum TEXT,
+    last_modified TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_backups_db_timestamp ON backups (db, timestamp);
+CREATE TABLE IF NOT EXISTS chunks (
+    hash TEXT PRIMARY KEY,
+    size INTEGER,
+    codec TEXT
+);
+CREATE TABLE IF NOT EXISTS chunk_index_state (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS wal_segments (
+    name TEXT PRIMARY KEY,
+    key TEXT,
+    size INTEGER,
+    archived_at TEXT,
+    shipped_at TEXT
+);
+CREATE TABLE IF NOT EXISTS log_index (
+    key TEXT PRIMARY KEY,
+    kind TEXT,
+    server TEXT,
+    target TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    start_file TEXT,
+    start_pos INTEGER,
+    end_file TEXT,
+    end_pos INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_log_index_server ON log_index (server, kind, start_file, start_pos);
+"""
+
+_schema_lock = threading.Lock()
+_initialized = set()
+
+
+def catalog_path(config):
+    return config.get("catalog", {}).get("path", DEFAULT_CATALOG_FILE)
+
+
+def _connect(config):
+    path = catalog_path(config)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    with _schema_lock:
+        if path not in _initialized:
+            conn.executescript(SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(backups)")}
+            if "target" not in columns:
+                # Catalogs created before named targets existed
+                conn.execute("ALTER TABLE backups ADD COLUMN target TEXT")
+                conn.commit()
+            if "codec" not in {row[1] for row in conn.execute("PRAGMA table_info(chunks)")}:
+                # Chunk indexes without codecs are dropped and rebuilt from S3 on the next dedup backup
+                conn.execute("DELETE FROM chunks")
+                conn.execute("ALTER TABLE chunks ADD COLUMN codec TEXT")
+                conn.commit()
+            _initialized.add(path)
+    return closing(conn)
+
+
+def parse_backup_key(key):
+    """Return (db, type, timestamp) for a backup key, or (None, None, None) if it is not one of ours"""
+    match = KEY_PATTERN.match(key)
+    if not match:
+        return None, None, None
+    db = "postgres" if match["db"] == "pg" else match["db"]
+    backup_type = "full" if match["kind"] == "backup" else "incremental"
+    timestamp = datetime.strptime(match["ts"], "%Y-%m-%d-%H-%M-%S").strftime("%Y-%m-%d %H:%M:%S")
+    return db, backup_type, timestamp
+
+
+def parse_target(key):
+    """Name of the target a backup key belongs to, None for single-database backups"""
+    match = KEY_PATTERN.match(key)
+    return match["target"] if match else None
+
+
+def backup_key_of(object_key):
+    """Objects of a directory backup are catalogued under their top-level prefix"""
+    if "/" in object_key:
+        return object_key.split("/", 1)[0] + "/"
+    return object_key
+
+
+def _utc_iso(value):
+    # Stored in UTC so plain string comparison orders correctly
+    return value.astimezone(timezone.utc).isoformat()
+
+
+def _row(key, size, last_modified, checksum=None, codec=None):
+    db, backup_type, timestamp = parse_backup_key(key)
+    if isinstance(last_modified, datetime):
+        last_modified = _utc_iso(last_modified)
+    return {
+        "key": key,
+        "db": db,
+        "target": parse_target(key),
+        "type": backup_type,
+        "timestamp": timestamp or (last_modified or "")[:19].replace("T", " "),
+        "size": size,
+        "codec": codec or detect_codec(key),
+        "checksum": checksum,
+        "last_modified": last_modified,
+    }
+
+
+def _upsert(conn, rows):
+    conn.executemany(
+        "INSERT OR REPLACE INTO backups (key, db, target, type, timestamp, size, codec, checksum, last_modified) "
+        "VALUES (:key, :db, :target, :type, :timestamp, :size, :codec, :checksum, :last_modified)",
+        rows
+    )
+
+
+def record_backup(config, key, size, last_modified=None, checksum=None, codec=None):
+    last_modified = last_modified or datetime.now().astimezone()
+    with _connect(config) as conn, conn:
+        _upsert(conn, [_row(key, size, last_modified, checksum, codec)])
+
+
+def record_upload(config, key):
+    """Add a freshly uploaded object to the catalog using its S3 size and checksum"""
+    s3 = get_client(config)
+    head = s3.head_object(Bucket=config["s3"]["bucket"], Key=key, ChecksumMode="ENABLED")
+    checksum = next((f"{name[len('Checksum'):].lower()}:{value}" for name, value in head.items()
+                     if name.startswith("Checksum") and name != "ChecksumType" and value), None)
+    record_backup(config, key, head["ContentLength"], head["LastModified"],
+                  checksum or head.get("ETag", "").strip('"'), head.get("Metadata", {}).get("codec"))
+
+
+def remove_backups(config, keys):
+    with _connect(config) as conn, conn:
+        conn.executemany("DELETE FROM backups WHERE key = ?", [(k,) for k in keys])
+        conn.executemany("DELETE FROM log_index WHERE key = ?", [(k,) for k in keys])
+
+
+def is_empty(config):
+    with _connect(config) as conn:
+        return conn.execute("SELECT 1 FROM backups LIMIT 1").fetchone() is None
+
+
+def iter_objects(config, prefix=""):
+    """Yield every object in the bucket, following list_objects_v2 pagination"""
+    s3 = get_client(config)
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=config["s3"]["bucket"], Prefix=prefix):
+        yield from page.get("Contents", [])
+
+
+def reconcile(config):
+    """Rebuild the catalog from a full, paginated listing of the bucket"""
+    logger.info(f"Reconciling backup catalog with S3 bucket {config['s3']['bucket']}")
+    backups = {}
+    for obj in iter_objects(config):
+        if obj["Key"].startswith((CHUNK_PREFIX, WAL_PREFIX, DIGEST_PREFIX, LOCK_PREFIX)):
+            continue
+        key = backup_key_of(obj["Key"])
+        entry = backups.get(key)
+        if entry is None:
+            backups[key] = _row(key, obj["Size"], obj["LastModified"],
+                                (obj.get("ETag") or "").strip('"') if key == obj["Key"] else None)
+        else:
+            entry["size"] += obj["Size"]
+            entry["last_modified"] = max(entry["last_modified"], _utc_iso(obj["LastModified"]))
+
+    with _connect(config) as conn, conn:
+        existing = {r["key"]: r["checksum"] for r in conn.execute("SELECT key, checksum FROM backups")}
+        for key, row in backups.items():
+            # Keep the richer checksum recorded at upload time
+            if existing.get(key):
+                row["checksum"] = existing[key]
+        stale = [(k,) for k in existing if k not in backups]
+        conn.executemany("DELETE FROM backups WHERE key = ?", stale)
+        conn.executemany("DELETE FROM log_index WHERE key = ?", stale)
+        _upsert(conn, list(backups.values()))
+
+    logger.info(f"Catalog reconciled: {len(backups)} backups, {len(stale)} stale entries removed")
+    return len(backups), len(stale)
+
+
+def query_backups(config, db=None, backup_type=None, since=None, until=None, older_than=None, target=None):
+    """Query the catalog; since/until filter on backup time, older_than on upload time"""
+    sql = "SELECT * FROM backups WHERE 1 = 1"
+    params = []
+    if db:
+        sql += " AND db = ?"
+        params.append(db)
+    if target:
+        sql += " AND target = ?"
+        params.append(target)
+    if backup_type:
+        sql += " AND type = ?"
+        params.append(backup_type)
+    if since:
+        sql += " AND timestamp >= ?"
+        params.append(since.strftime("%Y-%m-%d %H:%M:%S"))
+    if until:
+        sql += " AND timestamp <= ?"
+        params.append(until.strftime("%Y-%m-%d %H:%M:%S"))
+    if older_than:
+        sql += " AND last_modified < ?"
+        params.append(_utc_iso(older_than))
+    sql += " ORDER BY timestamp DESC"
+
+    with _connect(config) as conn:
+        rows = conn.execute(sql, params).fetchall()
+
+    return [{
+        "key": r["key"],
+        "db": r["db"],
+        "target": r["target"],
+        "type": r["type"],
+        "timestamp": r["timestamp"],
+        "last_modified": datetime.fromisoformat(r["last_modified"]),
+        "size": r["size"],
+        "codec": r["codec"],
+        "checksum": r["checksum"],
+    } for r in rows]
+
+
+def known_chunks(config):
+    """Chunk hash -> codec of the stored chunk object"""
+    with _connect(config) as conn:
+        return {row[0]: row[1] for row in conn.execute("SELECT hash, codec FROM chunks")}
+
+
+def add_chunks(config, rows, replace=False):
+    """Record (hash, size, codec) rows in the chunk index; replace=True rebuilds it from scratch"""
+    with _connect(config) as conn, conn:
+        if replace:
+            conn.execute("DELETE FROM chunks")
+        conn.executemany("INSERT OR REPLACE INTO chunks (hash, size, codec) VALUES (?, ?, ?)", rows)
+
+
+def chunk_generation(config):
+    """The chunk GC generation the local index was last synced with"""
+    with _connect(config) as conn:
+        row = conn.execute("SELECT value FROM chunk_index_state WHERE name = 'generation'").fetchone()
+    return row[0] if row else None
+
+
+def set_chunk_generation(config, generation):
+    with _connect(config) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO chunk_index_state (name, value) VALUES ('generation', ?)", (generation,))
+
+
+def remove_chunks(config, hashes):
+    with _connect(config) as conn, conn:
+        conn.executemany("DELETE FROM chunks WHERE hash = ?", [(h,) for h in hashes])
+
+
+def shipped_wal_segments(config):
+    with _connect(config) as conn:
+        return {row[0] for row in conn.execute("SELECT name FROM wal_segments")}
+
+
+def record_wal_segment(config, name, key, size, archived_at):
+    """archived_at is the file's mtime, i.e. roughly when PostgreSQL finished the segment"""
+    archived = datetime.fromtimestamp(archived_at, timezone.utc).isoformat()
+    with _connect(config) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO wal_segments (name, key, size, archived_at, shipped_at) VALUES (?, ?, ?, ?, ?)",
+            (name, key, size, archived, datetime.now(timezone.utc).isoformat())
+        )
+
+
+LOG_INDEX_FIELDS = ("kind", "server", "target", "start_time", "end_time", "start_file", "start_pos", "end_file",
+                    "end_pos")
+
+
+def record_log_entry(config, key, entry):
+    """
+    Index a backup for point-in-time recovery: a full backup ("full") with the binlog
+    position of its snapshot, or a binlog incremental ("binlog") with the positions and
+    local times it covers. Times are "%Y-%m-%d %H:%M:%S".
+    """
+    with _connect(config) as conn, conn:
+        conn.execute(f"INSERT OR REPLACE INTO log_index (key, {', '.join(LOG_INDEX_FIELDS)}) "
+                     f"VALUES (?, {', '.join('?' for _ in LOG_INDEX_FIELDS)})",
+                     [key] + [entry.get(field) for field in LOG_INDEX_FIELDS])
+
+
+def log_entries(config, server, kind=None):
+    """Indexed entries of a server in binlog order"""
+    sql = "SELECT * FROM log_index WHERE server = ?"
+    params = [server]
+    if kind:
+        sql += " AND kind = ?"
+        params.append(kind)
+    sql += " ORDER BY start_file, start_pos, end_file, end_pos"
+    with _connect(config) as conn:
+        return [dict(row) for row in conn.execute(sql, params).fetchall()]
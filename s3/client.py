@@ -0,0 +1,91 @@
+import threading
+import boto3
+from boto3.s3.transfer import S3Transfer, TransferConfig
+from botocore.config import Config
+
+MB = 1024 * 1024
+CHECKSUM_ALGORITHMS = ("CRC32", "CRC32C", "SHA1", "SHA256")
+
+_lock = threading.Lock()
+_clients = {}
+_transfers = {}
+
+
+def _client_key(s3_conf):
+    return (s3_conf.get("aws_access_key_id"), s3_conf.get("region"), s3_conf.get("endpoint_url"))
+
+
+def get_client(config):
+    """Return the process-wide S3 client for this config, creating it on first use"""
+    s3_conf = config["s3"]
+    key = _client_key(s3_conf)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            # Enough pooled connections for every concurrent part plus listing/deletes
+            pool_size = max(10, get_max_concurrency(config) * 2)
+            client = boto3.client(
+                "s3",
+                aws_access_key_id=s3_conf["aws_access_key_id"],
+                aws_secret_access_key=s3_conf["aws_secret_access_key"],
+                region_name=s3_conf["region"],
+                endpoint_url=s3_conf.get("endpoint_url"),
+                config=Config(max_pool_connections=pool_size, retries={"mode": "adaptive"})
+            )
+            _clients[key] = client
+        return client
+
+
+def get_transfer(config):
+    """Return the process-wide transfer manager used for file uploads"""
+    s3_conf = config["s3"]
+    key = _client_key(s3_conf)
+    client = get_client(config)
+    with _lock:
+        transfer = _transfers.get(key)
+        if transfer is None:
+            transfer = S3Transfer(client, get_transfer_config(config))
+            _transfers[key] = transfer
+        return transfer
+
+
+def get_transfer_config(config):
+    return TransferConfig(
+        multipart_threshold=get_multipart_threshold(config),
+        multipart_chunksize=get_part_size(config),
+        max_concurrency=get_max_concurrency(config),
+        use_threads=True
+    )
+
+
+def get_part_size(config):
+    # S3 rejects parts below 5 MB (except the last one)
+    return max(int(config["s3"].get("part_size_mb", 64)), 5) * MB
+
+
+def get_multipart_threshold(config):
+    """Uploads smaller than this are stored with a single put instead of a multipart upload"""
+    return int(config["s3"].get("multipart_threshold_mb", 64)) * MB
+
+
+def get_max_concurrency(config):
+    return int(config["s3"].get("max_concurrency", 8))
+
+
+def get_checksum_algorithm(config):
+    """Checksum algorithm S3 should compute and store per part, None to disable"""
+    # CRC32C would need botocore[crt]; CRC32 works with a plain botocore install
+    algorithm = config["s3"].get("checksum_algorithm", "CRC32")
+    if not algorithm or str(algorithm).lower() == "none":
+        return None
+    algorithm = str(algorithm).upper()
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise Exception(f"Unsupported checksum algorithm: {algorithm} (choose from {', '.join(CHECKSUM_ALGORITHMS)})")
+    return algorithm
+
+
+def reset_clients():
+    """Drop cached clients, e.g. when switching to a local S3 stand-in in tests"""
+    with _lock:
+        _transfers.clear()
+        _clients.clear()
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import threading
+from botocore.exceptions import ClientError
+from utils.logger import logger
+from s3.client import get_client
+from s3.catalog import DIGEST_PREFIX
+
+# SHA-256 of every block (the upload's parts) plus a SHA-256 over those block digests.
+# Blocks are hashed in the part upload threads and can be verified one by one.
+ALGORITHM = "sha256-blocks"
+
+
+def block_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def top_digest(blocks):
+    return hashlib.sha256(b"".join(bytes.fromhex(b) for b in blocks)).hexdigest()
+
+
+def make_record(block_size, size, blocks):
+    return {"algorithm": ALGORITHM, "block_size": block_size, "size": size, "sha256": top_digest(blocks),
+            "blocks": blocks}
+
+
+class BlockDigests:
+    """Digests of an object's blocks, added by part number from any thread"""
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.blocks = {}
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def add(self, number, data):
+        digest = block_digest(data)
+        with self._lock:
+            self.blocks[number] = digest
+            self.size += len(data)
+
+    def record(self):
+        if sorted(self.blocks) != list(range(1, len(self.blocks) + 1)):
+            raise Exception("Digests of some blocks are missing")
+        # An empty object still has one (empty) block
+        blocks = [self.blocks[n] for n in sorted(self.blocks)] or [block_digest(b"")]
+        return make_record(self.block_size, self.size, blocks)
+
+
+def sidecar_key(key):
+    """Digest sidecar of an object: digests/<key>.json"""
+    return f"{DIGEST_PREFIX}{key}.json"
+
+
+def write_sidecar(config, key, record):
+    # Like the catalog, a missing digest must not fail a backup that is already safely uploaded
+    try:
+        get_client(config).put_object(Bucket=config["s3"]["bucket"], Key=sidecar_key(key),
+                                      Body=json.dumps(dict(record, key=key)).encode())
+    except Exception as e:
+        logger.warning(f"Could not store the digest of {key}: {e}")
+
+
+def read_sidecar(config, key):
+    """The digest record of an object, or None when none was stored"""
+    try:
+        body = get_client(config).get_object(Bucket=config["s3"]["bucket"], Key=sidecar_key(key))["Body"].read()
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(body)
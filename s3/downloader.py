@@ -0,0 +1,130 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.logger import logger
+from utils import encryption
+from s3.client import MB, get_client, get_transfer, get_max_concurrency
+from s3.catalog import iter_objects
+
+_END = object()
+
+
+def get_download_part_size(config):
+    # Smaller than upload parts: every part in flight is held in memory until its turn comes
+    return max(int(config["s3"].get("download_part_size_mb", 16)), 1) * MB
+
+
+def ordered_fetch(fetch, items, concurrency):
+    """
+    Yield fetch(item) for every item, in order, with at most `concurrency` fetches in flight.
+
+    Results are handed out as soon as the oldest one is ready, so memory stays bounded
+    at `concurrency` results however large the whole sequence is.
+    """
+    items = iter(items)
+    window = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        def refill():
+            while len(window) < concurrency:
+                item = next(items, _END)
+                if item is _END:
+                    return
+                window.append(pool.submit(fetch, item))
+
+        try:
+            refill()
+            while window:
+                result = window.popleft().result()
+                refill()
+                yield result
+        finally:
+            for future in window:
+                future.cancel()
+
+
+def iter_object(config, key, concurrency=None):
+    """Yield the bytes of an S3 object in order, fetched with parallel ranged GETs"""
+    s3 = get_client(config)
+    bucket = config["s3"]["bucket"]
+    size = s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+    part_size = get_download_part_size(config)
+
+    def fetch(start):
+        end = min(start + part_size, size) - 1
+        return s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")["Body"].read()
+
+    logger.info(f"Downloading s3://{bucket}/{key} ({size} bytes)")
+    yield from ordered_fetch(fetch, range(0, size, part_size), concurrency or get_max_concurrency(config))
+
+
+def iter_decrypted(config, key, concurrency=None, start=0, end=None):
+    """
+    Yield the plaintext of an encrypted S3 object, or of its byte range [start, end).
+
+    Only the records covering the range are fetched; every download part is a whole
+    number of records, so parts are decrypted in the fetching threads, in parallel.
+    """
+    s3 = get_client(config)
+    bucket = config["s3"]["bucket"]
+    size = s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+    header = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{encryption.HEADER.size - 1}")["Body"].read()
+    decryptor = encryption.Decryptor(header, encryption.master_key(config))
+    chunk_size, record_size = decryptor.chunk_size, decryptor.record_size
+    count = decryptor.record_count(size)
+    end = decryptor.plaintext_size(size) if end is None else min(end, decryptor.plaintext_size(size))
+    if start >= end:
+        return
+    per_part = max(get_download_part_size(config) // record_size, 1)
+    stop = -(-end // chunk_size)
+
+    def fetch(first):
+        last = min(first + per_part, stop) - 1
+        byte_range = f"bytes={decryptor.record_offset(first)}-{min(decryptor.record_offset(last + 1), size) - 1}"
+        body = s3.get_object(Bucket=bucket, Key=key, Range=byte_range)["Body"].read()
+        data = b"".join(decryptor.decrypt(index, body[n * record_size:(n + 1) * record_size], index == count - 1)
+                        for n, index in enumerate(range(first, last + 1)))
+        offset = first * chunk_size
+        return data[max(start - offset, 0):end - offset]
+
+    logger.info(f"Downloading and decrypting s3://{bucket}/{key} ({size} bytes)")
+    records = range(start // chunk_size, stop, per_part)
+    yield from ordered_fetch(fetch, records, concurrency or get_max_concurrency(config))
+
+
+def iter_backup(config, key, concurrency=None):
+    """Yield the bytes of a backup object as it was before any encryption"""
+    if encryption.is_encrypted(key):
+        return iter_decrypted(config, key, concurrency)
+    return iter_object(config, key, concurrency)
+
+
+def _plain_name(name):
+    return name[:-len(encryption.ENCRYPTED_EXTENSION)] if encryption.is_encrypted(name) else name
+
+
+def download_prefix(config, prefix, dest_dir, names=None, max_workers=4):
+    """
+    Download the objects under `prefix` (only `names` when given) into dest_dir, returns
+    the file names. Encrypted files are decrypted on the way and lose their extension.
+    """
+    bucket = config["s3"]["bucket"]
+    transfer = get_transfer(config)
+    keys = [obj["Key"] for obj in iter_objects(config, prefix)]
+    if names is not None:
+        keys = [k for k in keys if _plain_name(k[len(prefix):]) in names]
+    os.makedirs(dest_dir, exist_ok=True)
+    per_file = max(get_max_concurrency(config) // max_workers, 1)
+
+    def download(key):
+        name = _plain_name(key[len(prefix):])
+        if encryption.is_encrypted(key):
+            with open(os.path.join(dest_dir, name), "wb") as f:
+                for data in iter_decrypted(config, key, per_file):
+                    f.write(data)
+        else:
+            transfer.download_file(bucket, key, os.path.join(dest_dir, name))
+        return name
+
+    logger.info(f"Downloading {len(keys)} files from s3://{bucket}/{prefix}")
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(download, keys))
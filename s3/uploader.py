@@ -1,46 +1,323 @@
-import boto3
+import json
 import os
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, wait
 from utils.logger import logger
+from utils.compression import detect_codec, read_chunks
+from utils import encryption
+from s3.client import get_client, get_part_size, get_max_concurrency, get_multipart_threshold, get_checksum_algorithm
+from s3 import catalog
+from s3.digests import BlockDigests, block_digest, write_sidecar
+from utils import metrics, throttle
 
-def upload_to_s3(file_path, config):
+def _object_args(key, config):
+    # Record the codec on the object so restore does not have to trust the extension alone
+    codec = detect_codec(key)
+    args = {"Metadata": {"codec": codec}} if codec else {}
+    if encryption.is_encrypted(key):
+        args.setdefault("Metadata", {})["encryption"] = "aes-256-gcm-chunked"
+    algorithm = get_checksum_algorithm(config)
+    if algorithm:
+        args["ChecksumAlgorithm"] = algorithm
+    return args
+
+def _record(config, key, size=None):
+    # The catalog is an index, a failure to update it must not fail the backup
+    try:
+        if size is None:
+            catalog.record_upload(config, key)
+        else:
+            catalog.record_backup(config, key, size)
+    except Exception as e:
+        logger.warning(f"Could not record {key} in backup catalog: {e}")
+
+def _encrypts(key, config):
+    # Files encrypted before upload keep their encryption; everything else is encrypted on the way
+    return encryption.enabled(config) and not encryption.is_encrypted(key)
+
+def upload_to_s3(file_path, config, key=None):
+    """Upload a local file, read once through upload_stream so it is digested and encrypted on the way"""
+    key = key or os.path.basename(file_path)
+    logger.info(f"Uploading {file_path} to S3 bucket {config['s3']['bucket']}")
+    with open(file_path, "rb") as f:
+        return upload_stream(read_chunks(f), key, config)
+
+class PartPool:
+    """Upload threads and slots that several streaming uploads share, so their parts in flight are bounded together"""
+
+    def __init__(self, config):
+        size = get_max_concurrency(config)
+        self.executor = ThreadPoolExecutor(max_workers=size)
+        self.slots = threading.BoundedSemaphore(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.executor.shutdown(wait=True)
+
+def upload_stream(chunks, key, config, record=True, parent_stage=None, encrypt=True, parts=None):
+    """
+    Upload an iterable of byte chunks to S3 without touching disk; returns the key, which
+    gains the encrypted extension when encryption is enabled.
+
+    A stream below `multipart_threshold_mb` is stored with a single put, anything larger as
+    a multipart upload. At most `max_concurrency` parts are in flight and one more is being
+    filled, so memory stays bounded at roughly (max_concurrency + 1) * part_size (or the
+    threshold, if that is larger). When all upload slots are busy the producer blocks, which
+    in turn stops reading from the dump process; so does the upload rate limit, if one is
+    configured (utils/throttle.py).
+    Uploads given the same `parts` (a PartPool) share its threads and slots instead of
+    bringing their own. With parent_stage the upload counts towards that metrics stage.
+
+    Every part is digested in its upload thread and the digests are stored in a sidecar
+    (s3/digests.py); a single-put object also carries its SHA-256 as metadata.
+    """
+    if encrypt and _encrypts(key, config):
+        chunks = encryption.encrypt_chunks(chunks, encryption.master_key(config), encryption.get_chunk_size(config),
+                                           encryption.get_threads(config))
+        key += encryption.ENCRYPTED_EXTENSION
     s3_conf = config["s3"]
     bucket = s3_conf["bucket"]
-    key = os.path.basename(file_path)
+    part_size = get_part_size(config)
+    threshold = get_multipart_threshold(config)
+    object_args = _object_args(key, config)
+    algorithm = object_args.get("ChecksumAlgorithm")
+    checksum_field = f"Checksum{algorithm}" if algorithm else None
 
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=s3_conf["aws_access_key_id"],
-        aws_secret_access_key=s3_conf["aws_secret_access_key"],
-        region_name=s3_conf["region"]
-    )
+    s3 = get_client(config)
 
-    logger.info(f"Uploading {file_path} to S3 bucket {bucket}")
-    s3.upload_file(file_path, bucket, key)
-    logger.info("Upload successful.")
-    s3.close()
+    logger.info(f"Streaming upload to s3://{bucket}/{key}")
+    own_pool = parts is None
+    if own_pool:
+        parts = PartPool(config)
+    buffer = bytearray()
+    upload_id = None
+    futures = []
+    part_number = 0
+    total = 0
+    digests = BlockDigests(part_size)
+    limit = throttle.upload_bucket(config)
+
+    def upload_part(number, body):
+        try:
+            digests.add(number, body)
+            extra = {"ChecksumAlgorithm": algorithm} if algorithm else {}
+            response = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                      PartNumber=number, Body=body, **extra)
+            stage.add_retries(response)
+            part = {"PartNumber": number, "ETag": response["ETag"]}
+            if checksum_field:
+                part[checksum_field] = response[checksum_field]
+            return part
+        finally:
+            parts.slots.release()
+
+    def submit(body):
+        nonlocal part_number
+        part_number += 1
+        parts.slots.acquire()
+        # Stop feeding the upload as soon as any earlier part has failed
+        for future in futures:
+            if future.done() and future.exception():
+                parts.slots.release()
+                raise future.exception()
+        futures.append(parts.executor.submit(upload_part, part_number, body))
+
+    with nullcontext(parent_stage) if parent_stage else metrics.stage("upload") as stage:
+        try:
+            for chunk in throttle.throttled(chunks, limit, stage):
+                buffer += chunk
+                total += len(chunk)
+                if upload_id is None and len(buffer) < threshold:
+                    continue
+                while len(buffer) >= part_size:
+                    if upload_id is None:
+                        upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, **object_args)["UploadId"]
+                    submit(bytes(buffer[:part_size]))
+                    del buffer[:part_size]
+
+            if upload_id is None:
+                # Whole stream stayed below the threshold, so its digest is known before it is stored
+                body = bytes(buffer)
+                if body:
+                    digests.add(1, body)
+                metadata = dict(object_args.get("Metadata", {}), sha256=block_digest(body))
+                s3.put_object(Bucket=bucket, Key=key, Body=body, **dict(object_args, Metadata=metadata))
+            else:
+                if buffer:
+                    submit(bytes(buffer))
+                uploaded = [f.result() for f in futures]
+                s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                             MultipartUpload={"Parts": uploaded})
+        except BaseException:
+            if upload_id is not None:
+                logger.error(f"Aborting multipart upload of {key}")
+                for future in futures:
+                    # A part that never started gives back the slot its upload thread would have
+                    if future.cancel():
+                        parts.slots.release()
+                wait(futures)
+                s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+        finally:
+            if own_pool:
+                parts.executor.shutdown(wait=True)
+        if not parent_stage:
+            stage.bytes_out = total
+
+    logger.info(f"Upload successful: {key} ({total} bytes)")
+    write_sidecar(config, key, digests.record())
+    if record:
+        _record(config, key)
+    return key
+
+def _uploaded_parts(s3, bucket, key, upload_id):
+    parts = {}
+    for page in s3.get_paginator("list_parts").paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+        for part in page.get("Parts", []):
+            parts[part["PartNumber"]] = part
+    return parts
 
-def list_backups(config, db_filter=None):
+def upload_file_resumable(file_path, config, key=None, state=None):
+    """
+    Upload a local file as a multipart upload that survives a crash.
+
+    The UploadId and every finished part are checkpointed in `state` (a StateManager).
+    Run again after a failure, it asks S3 which parts it already holds and uploads only
+    the rest. A failed upload is left open for that retry rather than aborted.
+    """
     s3_conf = config["s3"]
     bucket = s3_conf["bucket"]
+    key = key or os.path.basename(file_path)
+    size = os.path.getsize(file_path)
+    part_size = get_part_size(config)
+    if size <= part_size or size < get_multipart_threshold(config) or _encrypts(key, config):
+        # Encrypting on the way cannot resume: the data key would differ between attempts
+        return upload_to_s3(file_path, config, key)
+
+    s3 = get_client(config)
+    object_args = _object_args(key, config)
+    algorithm = object_args.get("ChecksumAlgorithm")
+    checksum_field = f"Checksum{algorithm}" if algorithm else None
+
+    upload_id = None
+    done = {}
+    checkpoint = state.load_upload_checkpoint(key) if state else None
+    if checkpoint:
+        try:
+            if not checkpoint[2]:
+                raise Exception("its part size was not recorded")
+            # Keep the part size the upload was started with, whatever the config says now
+            part_size = checkpoint[2]
+            part_count = -(-size // part_size)
+            done = _uploaded_parts(s3, bucket, key, checkpoint[0])
+            for number, part in done.items():
+                if number > part_count or part["Size"] != min(part_size, size - (number - 1) * part_size):
+                    raise Exception("parts do not match the local file")
+            upload_id = checkpoint[0]
+            logger.info(f"Resuming upload of {key}: {len(done)} parts already in S3")
+        except Exception as e:
+            logger.warning(f"Cannot resume upload of {key}, starting over: {e}")
+            try:
+                s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=checkpoint[0])
+            except Exception:
+                pass
+            done = {}
+            part_size = get_part_size(config)
+
+    if upload_id is None:
+        upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, **object_args)["UploadId"]
+        if state:
+            state.save_upload_checkpoint(key, upload_id, [], part_size)
+
+    part_count = -(-size // part_size)
+    missing = [n for n in range(1, part_count + 1) if n not in done]
+    lock = threading.Lock()
+    digests = BlockDigests(part_size)
+    limit = throttle.upload_bucket(config)
+    logger.info(f"Uploading {file_path} to S3 bucket {bucket} ({len(missing)} of {part_count} parts)")
+
+    def upload_part(number):
+        with open(file_path, "rb") as f:
+            f.seek((number - 1) * part_size)
+            body = f.read(part_size)
+        digests.add(number, body)
+        if limit is not None:
+            stage.add_throttled(limit.consume(len(body)))
+        extra = {"ChecksumAlgorithm": algorithm} if algorithm else {}
+        response = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=body, **extra)
+        stage.add_retries(response)
+        part = {"PartNumber": number, "ETag": response["ETag"]}
+        if checksum_field:
+            part[checksum_field] = response[checksum_field]
+        with lock:
+            done[number] = part
+            if state:
+                state.save_upload_checkpoint(key, upload_id, sorted(done), part_size)
+
+    with metrics.stage("upload", resumed_parts=part_count - len(missing)) as stage:
+        with ThreadPoolExecutor(max_workers=get_max_concurrency(config)) as pool:
+            list(pool.map(upload_part, missing))
+
+        fields = ("PartNumber", "ETag", checksum_field) if checksum_field else ("PartNumber", "ETag")
+        parts = [{f: done[n][f] for f in fields if done[n].get(f)} for n in sorted(done)]
+        s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+        # Only what this run sent counts towards its throughput
+        stage.bytes_out = sum(min(part_size, size - (n - 1) * part_size) for n in missing)
+    if state:
+        state.clear_upload_checkpoint(key)
+    # Parts an earlier run uploaded were not read by this one
+    with open(file_path, "rb") as f:
+        for number in sorted(set(range(1, part_count + 1)) - set(digests.blocks)):
+            f.seek((number - 1) * part_size)
+            digests.add(number, f.read(part_size))
+    write_sidecar(config, key, digests.record())
+    logger.info("Upload successful.")
+    _record(config, key)
+    return key
+
+def upload_directory(dir_path, config, max_workers=4):
+    """Upload every file of a backup directory under a prefix named after it, manifest last"""
+    from backup.manifest import MANIFEST_NAME
+
+    bucket = config["s3"]["bucket"]
+    prefix = os.path.basename(os.path.normpath(dir_path))
+
+    files = sorted(f for f in os.listdir(dir_path) if f != MANIFEST_NAME)
+    logger.info(f"Uploading {len(files)} files from {dir_path} to S3 bucket {bucket}")
+
+    def upload(name):
+        with open(os.path.join(dir_path, name), "rb") as f:
+            upload_stream(read_chunks(f), f"{prefix}/{name}", config, record=False, parent_stage=stage, parts=parts)
+        return name
+
+    # One set of part slots for all files: parts in flight stay at max_concurrency however many files upload
+    with metrics.stage("upload", files=len(files)) as stage, PartPool(config) as parts:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            list(pool.map(upload, files))
+
+        # The manifest goes up last so its presence marks a complete backup
+        manifest_path = os.path.join(dir_path, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if encryption.enabled(config):
+                # Stays readable so restore can plan, but tells it the files need decrypting
+                manifest["encrypted"] = True
+            upload_stream([json.dumps(manifest, indent=4).encode()], f"{prefix}/{MANIFEST_NAME}", config,
+                          record=False, parent_stage=stage, encrypt=False, parts=parts)
+        total = sum(os.path.getsize(os.path.join(dir_path, f)) for f in os.listdir(dir_path))
+        stage.bytes_out = total
+
+    logger.info("Upload successful.")
+    _record(config, f"{prefix}/", total)
+    return prefix
 
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=s3_conf["aws_access_key_id"],
-        aws_secret_access_key=s3_conf["aws_secret_access_key"],
-        region_name=s3_conf["region"]
-    )
-
-    logger.info(f"Listing backups in S3 bucket {bucket}")
-    response = s3.list_objects_v2(Bucket=bucket)
-
-    backups = []
-    for obj in response.get('Contents', []):
-        key = obj['Key']
-        if db_filter is None or db_filter in key:
-            backups.append({
-                "key": key,
-                "last_modified": obj["LastModified"],
-                "size": obj["Size"]
-            })
-
-    return backups
+def list_backups(config, db_filter=None, backup_type=None, since=None, until=None, refresh=False, target=None):
+    """List backups from the local catalog, reconciling it with S3 first if asked or if it is empty"""
+    if refresh or catalog.is_empty(config):
+        catalog.reconcile(config)
+    return catalog.query_backups(config, db=db_filter, backup_type=backup_type, since=since, until=until,
+                                 target=target)
@@ -1,150 +1,371 @@
+import heapq
+import itertools
+import os
 import threading
 import time
-from datetime import datetime
-from backup import mysql_backup, postgres_backup
-from s3 import uploader
-from utils.logger import logger
-from utils.email_notifier import EmailNotifier
-from utils.logger import disable_console_logging
+import uuid
+from collections import deque
 from datetime import datetime, timedelta
+from utils.logger import logger
+from utils.cron import CronExpression
+from state_manager import PROGRESS_FIELDS
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_PER_HOST_LIMIT = 1
+# A run that starts more than this many seconds after its slot counts as missed
+MISFIRE_GRACE = 60
+# skip: drop missed runs, once: run a single catch-up, all: run every missed slot
+CATCH_UP_POLICIES = ("skip", "once", "all")
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _following(details, scheduled, not_before=None):
+    """The trigger time after `scheduled`, or the first one after `not_before` when given"""
+    if details.get("cron"):
+        return CronExpression(details["cron"]).next_after(max(scheduled, not_before or scheduled))
+    interval = timedelta(seconds=details["interval"])
+    following = scheduled + interval
+    if not_before and following <= not_before:
+        # Stay aligned to the original slots
+        following += interval * ((not_before - following) // interval + 1)
+    return following
+
+
+def _host_of(config, db):
+    conf = (config or {}).get(db, {})
+    return f"{conf.get('host', 'localhost')}:{conf.get('port', '')}"
+
 
 class Scheduler:
-    def __init__(self, state_manager):
+    """
+    Runs any number of schedules from one dispatcher thread.
+
+    Next-run times sit in a heap; the dispatcher sleeps until the earliest is due and
+    hands it to a bounded worker pool, holding it back while its database host already
+    has `per_host_limit` backups running. With dispatch=False nothing runs until start()
+    is called; until then the instance only edits and lists the saved schedules.
+    """
+
+    def __init__(self, state_manager, max_workers=DEFAULT_MAX_WORKERS, per_host_limit=DEFAULT_PER_HOST_LIMIT,
+                 dispatch=True):
         self.state_manager = state_manager
-        self.schedules = self.state_manager.load_schedules()
-        self.threads = {}  # db -> Thread
+        self.schedules = self._migrate(self.state_manager.load_schedules())
         self.lock = threading.Lock()
-        self.emailer = None
+        self.wakeup = threading.Condition(self.lock)
+        self.heap = []          # (next run timestamp, sequence, schedule id)
+        self.sequence = itertools.count()
+        self.current = {}       # schedule id -> sequence of its live heap entry
+        self.waiting = deque()  # (schedule id, slot, late) due but held back by a limit
+        self.running = {}       # schedule id -> host
+        self.progress = {}      # schedule id -> the running job, see get_progress
+        self.max_workers = max_workers
+        self.per_host_limit = per_host_limit
+        self.pool = None
+        self.stopped = False
 
-        # Start any active schedules from saved state
-        for db, details in self.schedules.items():
-            if not details.get("stopped", False) and details.get("count", 0) > details.get("completed", 0):
-                self._start_thread(db, details)
+        # Resume active schedules from saved state
+        with self.wakeup:
+            for schedule_id, details in self.schedules.items():
+                if self._is_active(details):
+                    self._push(schedule_id, details)
 
-    def _start_thread(self, db, details):
-        if db in self.threads and self.threads[db].is_alive():
-            logger.info(f"Schedule for {db} already running.")
+        self.dispatcher = None
+        if dispatch:
+            self.start()
+
+    def start(self):
+        """Start running due schedules (once; a later call does nothing)"""
+        if self.dispatcher is not None:
             return
+        # Imported here so the CLI, which only edits and lists schedules, starts quickly
+        from concurrent.futures import ThreadPoolExecutor
+        self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="backup")
+        self.dispatcher = threading.Thread(target=self._dispatch, name="scheduler", daemon=True)
+        self.dispatcher.start()
 
-        thread = threading.Thread(target=self._run_schedule, args=(db,))
-        thread.daemon = True
-        self.threads[db] = thread
-        thread.start()
-        logger.info(f"Started schedule thread for {db}.")
+    @staticmethod
+    def _migrate(schedules):
+        # Older state was keyed by db with a gap in days
+        for key, details in schedules.items():
+            details.setdefault("db", key)
+            if not details.get("cron") and not details.get("interval"):
+                details["interval"] = int(details.get("gap", 1)) * 86400
+            details.setdefault("catch_up", "once")
+        return schedules
 
-    def _run_schedule(self, db):
-        # Disable console logs for scheduler thread
-        # disable_console_logging()
-        while True:
-            with self.lock:
-                schedule = self.schedules.get(db)
-                if not schedule or schedule.get("stopped", False):
-                    logger.info(f"Schedule for {db} stopped or removed.")
-                    break
-
-                count = schedule.get("count", 0)
-                completed = schedule.get("completed", 0)
-                if completed >= count:
-                    logger.info(f"Schedule for {db} completed all backups.")
-                    schedule["stopped"] = True
-                    self.state_manager.save_schedules(self.schedules)
-                    break
-
-                gap_days = schedule.get("gap", 1)
-                last_backup_str = schedule.get("last_backup_time")
-                if last_backup_str:
-                    last_backup_time = datetime.strptime(last_backup_str, "%Y-%m-%d %H:%M:%S")
-                    next_allowed_time = last_backup_time + timedelta(days=gap_days)
-                    now = datetime.now()
-                    time.sleep(60)
-                    # if now < next_allowed_time:
-                    #     sleep_seconds = (next_allowed_time - now).total_seconds()
-                    #     logger.info(f"Next backup for {db} scheduled in {int(sleep_seconds)} seconds.")
-                    #     time.sleep(sleep_seconds)
-
-                # Prepare backup params
-                config = schedule.get("config")
-                tables = schedule.get("tables")
-                schema_only = schedule.get("schema_only", False)
-                data_only = schedule.get("data_only", False)
-                compress = schedule.get("compress", False)
-                notify = schedule.get("notify")
-
-            logger.info(f"Starting scheduled backup {completed + 1} of {count} for {db}")
+    @staticmethod
+    def _is_active(details):
+        count = details.get("count")
+        return not details.get("stopped", False) and (count is None or details.get("completed", 0) < count)
+
+    def _push(self, schedule_id, details):
+        if details.get("next_run"):
+            next_run = datetime.strptime(details["next_run"], TIME_FORMAT)
+        elif details.get("cron"):
+            next_run = CronExpression(details["cron"]).next_after(datetime.now())
+        else:
+            next_run = datetime.now()
+        details["next_run"] = next_run.strftime(TIME_FORMAT)
+        sequence = next(self.sequence)
+        self.current[schedule_id] = sequence
+        heapq.heappush(self.heap, (next_run.timestamp(), sequence, schedule_id))
+        self.wakeup.notify()
+
+    def _dispatch(self):
+        with self.wakeup:
+            while not self.stopped:
+                self._start_waiting()
+                now = time.time()
+                if self.heap and self.heap[0][0] <= now:
+                    timestamp, sequence, schedule_id = heapq.heappop(self.heap)
+                    details = self.schedules.get(schedule_id)
+                    # Entries of cancelled or rescheduled schedules are dropped lazily
+                    if self.current.get(schedule_id) != sequence or not details or not self._is_active(details):
+                        continue
+                    del self.current[schedule_id]
+                    self._due(schedule_id, details, datetime.fromtimestamp(timestamp), now - timestamp)
+                    continue
+                # Wake at least once a minute so wall-clock jumps are noticed
+                timeout = min(self.heap[0][0] - now, 60) if self.heap else 60
+                self.wakeup.wait(timeout)
+
+    def _due(self, schedule_id, details, slot, late):
+        if late > MISFIRE_GRACE and details.get("catch_up") == "skip":
+            next_run = _following(details, slot, not_before=datetime.now())
+            logger.info(f"Skipping missed run of {schedule_id} due at {slot.strftime(TIME_FORMAT)}")
+            details["next_run"] = next_run.strftime(TIME_FORMAT)
+            self._push(schedule_id, details)
+            self.state_manager.update_schedule(schedule_id, next_run=details["next_run"])
+            return
+        self.waiting.append((schedule_id, slot, late))
+
+    def _start_waiting(self):
+        held = deque()
+        while self.waiting and len(self.running) < self.max_workers:
+            schedule_id, slot, late = self.waiting.popleft()
+            details = self.schedules.get(schedule_id)
+            if not details or not self._is_active(details):
+                continue
+            host = details.get("host") or "localhost"
+            # A schedule run by hand is still running when its slot comes, or the other way round
+            if schedule_id in self.running or sum(1 for h in self.running.values() if h == host) >= self.per_host_limit:
+                held.append((schedule_id, slot, late))
+                continue
+            self.running[schedule_id] = host
+            self.pool.submit(self._run, schedule_id, details, slot, late)
+        held.extend(self.waiting)
+        self.waiting = held
+
+    def _backup(self, schedule_id, details, config):
+        """Dump one scheduled backup and upload it through the backup job journal; returns the local path"""
+        from backup import mysql_backup, postgres_backup, pitr
+        from backup.jobs import complete_backup_job
+        from utils import encryption
+
+        db = details["db"]
+        tables = details.get("tables")
+        if db == 'postgres':
+            backup = postgres_backup.backup
+        elif db == 'mysql':
+            backup = mysql_backup.backup
+        else:
+            raise Exception(f"Unsupported DB {db} in scheduler.")
+        meta = {"compress": details.get("compress", False), "codec": details.get("codec"),
+                "level": details.get("level"), "threads": details.get("threads", 1),
+                "schedule_id": schedule_id, "config_path": details.get("config_path")}
+        job_id = self.state_manager.create_backup_job(db, None, meta)
+        try:
+            # Dump uncompressed; compression is its own journaled stage
+            file_path = backup(config, datetime.now().strftime("%Y-%m-%d-%H-%M-%S"),
+                               tables.split(',') if tables else None, details.get("schema_only", False),
+                               details.get("data_only", False), False, details.get("codec"), details.get("level"),
+                               details.get("threads", 1))
+            meta["encrypt"] = encryption.enabled(config)
+            if db == 'mysql' and not (tables or details.get("schema_only") or details.get("data_only")):
+                meta["log_entry"] = pitr.full_backup_entry(config, file_path)
+        except BaseException as e:
+            self.state_manager.update_backup_job(job_id, stage="abandoned", error=str(e))
+            raise
+        self.state_manager.update_backup_job(job_id, stage="dumped", path=file_path, meta=meta)
+        try:
+            return complete_backup_job(config, {"id": job_id, "stage": "dumped", "path": str(file_path), "meta": meta},
+                                       self.state_manager)
+        except Exception as e:
+            self.state_manager.update_backup_job(job_id, error=str(e))
+            logger.warning(f"Kept the local dump of backup job {job_id}; the next run of {schedule_id} uploads it")
+            raise
 
+    def _run(self, schedule_id, details, slot, late):
+        from backup.jobs import resume_backup_job
+        from utils import metrics
+        from utils.email_notifier import get_notifier
+
+        db = details["db"]
+        count = details.get("count")
+        completed = details.get("completed", 0)
+        notify = details.get("notify")
+        logger.info(f"Starting scheduled backup {completed + 1}" + (f" of {count}" if count else "")
+                    + f" for {schedule_id} ({db})")
+
+        error = None
+        files = []
+        config = None
+        try:
+            job_id = self.state_manager.start_job(schedule_id, db)
+            run = metrics.start_run(schedule_id, db)
+            with self.lock:
+                self.progress[schedule_id] = {"db": db, "job_id": job_id, "started": time.monotonic(), "run": run,
+                                              "manual": slot is None}
             try:
-                date_str = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-                if db == 'postgres':
-                    file_path = postgres_backup.backup(config, date_str, tables.split(',') if tables else None,
-                                                    schema_only, data_only, compress)
-                elif db == 'mysql':
-                    file_path = mysql_backup.backup(config, date_str, tables.split(',') if tables else None,
-                                                    schema_only, data_only, compress)
-                else:
-                    logger.error(f"Unsupported DB {db} in scheduler.")
-                    break
-
-                uploader.upload_to_s3(file_path, config)
-                logger.info(f"Uploaded backup file {file_path} for scheduled backup {completed + 1} of {count}")
+                # Config is read at run time, so edits to it apply to the next run
+                config = self.state_manager.load_config(details.get("config_path"))
+                # A dump whose upload failed on an earlier run goes up before a new one is taken
+                for job in self.state_manager.pending_backup_jobs(db):
+                    if job["meta"].get("schedule_id") == schedule_id:
+                        path = resume_backup_job(config, job, self.state_manager)
+                        if path:
+                            files.append(path)
+                files.append(self._backup(schedule_id, details, config))
+                logger.info(f"Uploaded backup file {files[-1]} for scheduled backup {completed + 1} of {schedule_id}")
 
                 if notify:
-                    self.emailer = EmailNotifier(config)
-                    threading.Thread(target=self.emailer.notify_in_background,
-                                    args=(notify, [file_path], db, 1, True), daemon=True).start()
+                    get_notifier().notify(config, notify, files, db, len(files))
+            except Exception as e:
+                error = str(e)
+                logger.error(f"Scheduled backup failed for {schedule_id}: {e}")
+            metrics.finish_run(config, run, error is None)
+            self.state_manager.finish_job(job_id, [str(f) for f in files], error)
+        except Exception as e:
+            # A backup already in S3 still counts; one that never got to run does not
+            if not files:
+                error = error or str(e)
+            logger.error(f"Could not record the result of scheduled backup {schedule_id}: {e}")
+        finally:
+            self._finish(schedule_id, details, slot, late, error)
 
-                # Save updated state
-                with self.lock:
-                    schedule["completed"] = completed + 1
-                    schedule["last_backup_time"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    self.state_manager.save_schedules(self.schedules)
+    def _finish(self, schedule_id, details, slot, late, error):
+        """Release a finished run and move its schedule on; always runs, so a schedule never stays running"""
+        with self.wakeup:
+            self.running.pop(schedule_id, None)
+            self.progress.pop(schedule_id, None)
+            # Unless the schedule was replaced under the same id while this ran
+            if self.schedules.get(schedule_id) is details:
+                details["last_backup_time"] = datetime.now().strftime(TIME_FORMAT)
+                details["last_error"] = error
+                if error is None:
+                    details["completed"] = details.get("completed", 0) + 1
+                if self._is_active(details):
+                    # A run by hand (no slot) leaves the timetable's next run as it was
+                    if slot is not None:
+                        # After a single catch-up, continue from now rather than replaying every slot
+                        catch_up = late > MISFIRE_GRACE and details.get("catch_up") == "once"
+                        next_run = _following(details, slot, not_before=datetime.now() if catch_up else None)
+                        details["next_run"] = next_run.strftime(TIME_FORMAT)
+                        self._push(schedule_id, details)
+                elif not details.get("stopped"):
+                    logger.info(f"Schedule {schedule_id} completed all backups.")
+                    details["stopped"] = True
+                try:
+                    self.state_manager.update_schedule(schedule_id, **{k: details.get(k) for k in PROGRESS_FIELDS})
+                except Exception as e:
+                    logger.error(f"Could not save progress of schedule {schedule_id}: {e}")
+            self.wakeup.notify()
 
-            except Exception as e:
-                logger.error(f"Scheduled backup failed for {db}: {e}")
-                break
+    def add_schedule(self, db, count, gap, tables, schema_only, data_only, compress, notify,
+                     codec=None, level=None, threads=1, schedule_id=None, cron=None, interval=None,
+                     catch_up="once", config_path=None):
+        """Add a schedule (or replace the one with the same id) and return its id"""
+        from utils.compression import resolve_codec
 
-    def add_schedule(self, db, count, gap, tables, schema_only, data_only, compress, notify):
-        with self.lock:
-            # If schedule exists, stop previous schedule thread first
-            if db in self.schedules and not self.schedules[db].get("stopped", False):
-                logger.info(f"Stopping existing schedule for {db}")
-                self.schedules[db]["stopped"] = True
-                self.state_manager.save_schedules(self.schedules)
-
-            # Add new schedule
-            config = self.state_manager.load_config()
-            self.schedules[db] = {
+        if catch_up not in CATCH_UP_POLICIES:
+            raise Exception(f"Unknown catch-up policy: {catch_up}")
+        if compress:
+            resolve_codec(codec, level)
+        if cron:
+            CronExpression(cron)
+        elif not interval:
+            interval = int(gap or 1) * 86400
+
+        config_path = os.path.abspath(config_path or self.state_manager.config_file)
+        config = self.state_manager.load_config(config_path)
+        with self.wakeup:
+            schedule_id = schedule_id or f"{db}-{uuid.uuid4().hex[:8]}"
+            if schedule_id in self.schedules and not self.schedules[schedule_id].get("stopped", False):
+                logger.info(f"Replacing existing schedule {schedule_id}")
+
+            self.schedules[schedule_id] = {
+                "db": db,
                 "count": count,
                 "gap": gap,
+                "cron": cron,
+                "interval": None if cron else interval,
+                "catch_up": catch_up,
                 "tables": tables,
                 "schema_only": schema_only,
                 "data_only": data_only,
                 "compress": compress,
+                "codec": codec,
+                "level": level,
+                "threads": threads,
                 "notify": notify,
                 "completed": 0,
                 "stopped": False,
-                "config": config
+                "config_path": config_path,
+                "host": _host_of(config, db)
             }
-            self.state_manager.save_schedules(self.schedules)
-            self._start_thread(db, self.schedules[db])
+            self._push(schedule_id, self.schedules[schedule_id])
+            self.state_manager.save_schedule(schedule_id, self.schedules[schedule_id])
+        logger.info(f"Added schedule {schedule_id} for {db}")
+        return schedule_id
 
-    def cancel_schedule(self, db):
+    def cancel_schedule(self, schedule_id=None, db=None):
+        """Cancel one schedule by id, or every schedule of a database; returns the cancelled ids"""
+        cancelled = []
+        with self.wakeup:
+            for key, details in self.schedules.items():
+                if details.get("stopped", False):
+                    continue
+                if key == schedule_id or (db is not None and details["db"] == db):
+                    details["stopped"] = True
+                    self.current.pop(key, None)
+                    cancelled.append(key)
+                    self.state_manager.update_schedule(key, stopped=True)
+            if cancelled:
+                self.wakeup.notify()
+        for key in cancelled:
+            logger.info(f"Cancelled schedule {key}")
+        return cancelled
+
+    def run_now(self, schedule_id):
+        """Start a backup of a schedule outside its timetable, as soon as the limits allow"""
+        with self.wakeup:
+            details = self.schedules.get(schedule_id)
+            if not details or not self._is_active(details):
+                raise Exception(f"No active schedule {schedule_id}")
+            if schedule_id in self.running or any(w[0] == schedule_id and w[1] is None for w in self.waiting):
+                raise Exception(f"Schedule {schedule_id} is already running or about to run")
+            self.waiting.append((schedule_id, None, 0))
+            self.wakeup.notify()
+        logger.info(f"Running schedule {schedule_id} now")
+        return schedule_id
+
+    def get_progress(self):
+        """Backups running right now: schedule id -> db, job id, start time, metrics run"""
         with self.lock:
-            if db in self.schedules and not self.schedules[db].get("stopped", False):
-                self.schedules[db]["stopped"] = True
-                self.state_manager.save_schedules(self.schedules)
-                logger.info(f"Cancelled schedule for {db}")
-                return True
-        return False
+            return dict(self.progress)
 
     def get_active_schedules(self):
         with self.lock:
-            return {db: details for db, details in self.schedules.items() if not details.get("stopped", False)}
+            return {key: dict(details, running=key in self.running)
+                    for key, details in self.schedules.items() if not details.get("stopped", False)}
+
+    def stop(self, wait=True):
+        with self.wakeup:
+            self.stopped = True
+            self.wakeup.notify()
+        if self.pool is not None:
+            self.pool.shutdown(wait=wait)
 
 if __name__ == "__main__":
-    from state_manager import StateManager
-    state_mgr = StateManager()
-    scheduler = Scheduler(state_mgr)
-    logger.info("Scheduler started. Waiting for scheduled tasks...")
-    # Block forever
-    while True:
-        time.sleep(60)
\ No newline at end of file
+    from run_scheduler import main
+    main()
@@ -1,30 +1,277 @@
 import json
 import os
-import threading
+import sqlite3
+import uuid
+from contextlib import closing
+from datetime import datetime
 
 CONFIG_FILE = "config.yaml"
 
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS schedules (
+    id TEXT PRIMARY KEY,
+    db TEXT NOT NULL,
+    options TEXT NOT NULL,
+    config_path TEXT,
+    count INTEGER,
+    completed INTEGER NOT NULL DEFAULT 0,
+    stopped INTEGER NOT NULL DEFAULT 0,
+    next_run TEXT,
+    last_backup_time TEXT,
+    last_error TEXT,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS job_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    schedule_id TEXT,
+    db TEXT,
+    started_at TEXT,
+    finished_at TEXT,
+    status TEXT,
+    files TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_job_history_schedule ON job_history (schedule_id, id);
+CREATE TABLE IF NOT EXISTS backup_jobs (
+    id TEXT PRIMARY KEY,
+    db TEXT,
+    target TEXT,
+    stage TEXT,
+    path TEXT,
+    key TEXT,
+    meta TEXT,
+    error TEXT,
+    created_at TEXT,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_backup_jobs_stage ON backup_jobs (stage);
+CREATE TABLE IF NOT EXISTS binlog_positions (
+    server TEXT PRIMARY KEY,
+    file TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS upload_checkpoints (
+    key TEXT PRIMARY KEY,
+    upload_id TEXT,
+    parts TEXT,
+    part_size INTEGER,
+    updated_at TEXT
+);
+"""
+
+# Schedule fields with their own column; everything else is kept as JSON in `options`
+SCHEDULE_COLUMNS = ("db", "config_path", "count", "completed", "stopped", "next_run", "last_backup_time", "last_error")
+PROGRESS_FIELDS = ("completed", "stopped", "next_run", "last_backup_time", "last_error")
+
+# Stages a journaled backup job goes through; a job that crashed resumes after the last one reached.
+# Jobs whose dump failed, or whose local files are gone, end as "abandoned".
+JOB_STAGES = ("dumping", "dumped", "compressed", "uploading", "uploaded")
+JOB_FIELDS = ("stage", "path", "key", "meta", "error")
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
 class StateManager:
-    def __init__(self):
-        self.state_file = os.path.join("config", "schedules.json")
-        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
-        self.lock = threading.Lock()
+    """
+    Scheduler state in SQLite (config/state.db, WAL mode): one row per schedule, progress
+    updates touch only that row, so the CLI and the daemon can share the file safely.
+    """
 
-    def load_schedules(self):
-        if not os.path.exists(self.state_file):
+    def __init__(self, state_dir="config", config_file=CONFIG_FILE):
+        self.state_db = os.path.join(state_dir, "state.db")
+        self.legacy_state_file = os.path.join(state_dir, "schedules.json")
+        self.legacy_binlog_file = os.path.join(state_dir, "binlog_position.json")
+        self.config_file = config_file
+        os.makedirs(state_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            if "part_size" not in {row[1] for row in conn.execute("PRAGMA table_info(upload_checkpoints)")}:
+                # Checkpoints from before part sizes were recorded cannot be resumed and start over
+                conn.execute("ALTER TABLE upload_checkpoints ADD COLUMN part_size INTEGER")
+                conn.commit()
+        self._import_legacy_schedules()
+        self._import_legacy_binlog_positions()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.state_db, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return closing(conn)
+
+    def _load_json(self, path):
+        if not os.path.exists(path):
             return {}
-        with open(self.state_file, "r") as f:
+        with open(path, "r") as f:
             try:
                 return json.load(f)
             except Exception:
                 return {}
 
+    def _import_legacy_schedules(self):
+        """Move schedules from the old schedules.json into the database, once"""
+        if not os.path.exists(self.legacy_state_file):
+            return
+        schedules = self._load_json(self.legacy_state_file)
+        with self._connect() as conn, conn:
+            existing = {row[0] for row in conn.execute("SELECT id FROM schedules")}
+            for schedule_id, details in schedules.items():
+                if schedule_id not in existing:
+                    db = details.get("db", schedule_id)
+                    conf = (details.get("config") or {}).get(db, {})
+                    host = f"{conf.get('host', 'localhost')}:{conf.get('port', '')}"
+                    self._upsert(conn, schedule_id, dict(details, db=db, host=details.get("host", host)))
+        os.replace(self.legacy_state_file, f"{self.legacy_state_file}.migrated")
+
+    def _import_legacy_binlog_positions(self):
+        """Move binlog positions from the old binlog_position.json into the database, once"""
+        if not os.path.exists(self.legacy_binlog_file):
+            return
+        positions = self._load_json(self.legacy_binlog_file)
+        with self._connect() as conn, conn:
+            for server, entry in positions.items():
+                conn.execute("INSERT OR IGNORE INTO binlog_positions (server, file, position, updated_at) "
+                             "VALUES (?, ?, ?, ?)", (server, entry["file"], int(entry["position"]), _now()))
+        os.replace(self.legacy_binlog_file, f"{self.legacy_binlog_file}.migrated")
+
+    def load_binlog_position(self, server):
+        """Last binlog (file, position) backed up for a server, or None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT file, position FROM binlog_positions WHERE server = ?", (server,)).fetchone()
+        return (row["file"], row["position"]) if row else None
+
+    def save_binlog_position(self, server, binlog_file, position):
+        with self._connect() as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO binlog_positions (server, file, position, updated_at) "
+                         "VALUES (?, ?, ?, ?)", (server, binlog_file, int(position), _now()))
+
+    @staticmethod
+    def _upsert(conn, schedule_id, details):
+        # Config is referenced by path, never copied: it holds credentials
+        options = {k: v for k, v in details.items() if k not in SCHEDULE_COLUMNS and k != "config"}
+        conn.execute(
+            "INSERT OR REPLACE INTO schedules (id, db, options, config_path, count, completed, stopped, next_run, "
+            "last_backup_time, last_error, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (schedule_id, details["db"], json.dumps(options), details.get("config_path"), details.get("count"),
+             details.get("completed", 0), int(bool(details.get("stopped", False))), details.get("next_run"),
+             details.get("last_backup_time"), details.get("last_error"), _now())
+        )
+
+    def load_schedules(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM schedules").fetchall()
+        schedules = {}
+        for row in rows:
+            details = json.loads(row["options"])
+            details.update({column: row[column] for column in SCHEDULE_COLUMNS})
+            details["stopped"] = bool(row["stopped"])
+            schedules[row["id"]] = details
+        return schedules
+
+    def save_schedule(self, schedule_id, details):
+        with self._connect() as conn, conn:
+            self._upsert(conn, schedule_id, details)
+
     def save_schedules(self, schedules):
-        with self.lock:
-            with open(self.state_file, "w") as f:
-                json.dump(schedules, f, indent=4)
+        with self._connect() as conn, conn:
+            for schedule_id, details in schedules.items():
+                self._upsert(conn, schedule_id, details)
+
+    def update_schedule(self, schedule_id, **fields):
+        """Update progress fields (completed, stopped, next_run, ...) of one schedule"""
+        unknown = set(fields) - set(PROGRESS_FIELDS)
+        if unknown:
+            raise Exception(f"Not a schedule progress field: {', '.join(sorted(unknown))}")
+        if "stopped" in fields:
+            fields["stopped"] = int(bool(fields["stopped"]))
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn, conn:
+            conn.execute(f"UPDATE schedules SET {assignments}, updated_at = ? WHERE id = ?",
+                         list(fields.values()) + [_now(), schedule_id])
+
+    def start_job(self, schedule_id, db):
+        """Record the start of a scheduled backup, returns the job id"""
+        with self._connect() as conn, conn:
+            cursor = conn.execute("INSERT INTO job_history (schedule_id, db, started_at, status) VALUES (?, ?, ?, ?)",
+                                  (schedule_id, db, _now(), "running"))
+            return cursor.lastrowid
+
+    def finish_job(self, job_id, files=None, error=None):
+        with self._connect() as conn, conn:
+            conn.execute("UPDATE job_history SET finished_at = ?, status = ?, files = ?, error = ? WHERE id = ?",
+                         (_now(), "failed" if error else "success", json.dumps(files or []), error, job_id))
+
+    def job_history(self, schedule_id=None, limit=20):
+        sql = "SELECT * FROM job_history"
+        params = []
+        if schedule_id:
+            sql += " WHERE schedule_id = ?"
+            params.append(schedule_id)
+        sql += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [dict(row, files=json.loads(row["files"] or "[]")) for row in rows]
+
+    def create_backup_job(self, db, target=None, meta=None):
+        """Open a journal entry for a backup that is about to be dumped, returns its id"""
+        job_id = uuid.uuid4().hex[:12]
+        with self._connect() as conn, conn:
+            conn.execute("INSERT INTO backup_jobs (id, db, target, stage, meta, created_at, updated_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (job_id, db, target, "dumping", json.dumps(meta or {}), _now(), _now()))
+        return job_id
+
+    def update_backup_job(self, job_id, **fields):
+        unknown = set(fields) - set(JOB_FIELDS)
+        if unknown:
+            raise Exception(f"Not a backup job field: {', '.join(sorted(unknown))}")
+        if "meta" in fields:
+            fields["meta"] = json.dumps(fields["meta"])
+        if "path" in fields and fields["path"] is not None:
+            fields["path"] = str(fields["path"])
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn, conn:
+            conn.execute(f"UPDATE backup_jobs SET {assignments}, updated_at = ? WHERE id = ?",
+                         list(fields.values()) + [_now(), job_id])
+
+    def pending_backup_jobs(self, db=None, target=None):
+        """
+        Journaled jobs that have not reached the uploaded stage, oldest first: all of them,
+        or those of one database and target (None meaning the plain, untargeted database)
+        """
+        sql = "SELECT * FROM backup_jobs WHERE stage NOT IN ('uploaded', 'abandoned')"
+        params = []
+        if db:
+            sql += " AND db = ? AND target IS ?"
+            params.extend([db, target])
+        sql += " ORDER BY created_at"
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [dict(row, meta=json.loads(row["meta"] or "{}")) for row in rows]
+
+    def save_upload_checkpoint(self, key, upload_id, parts, part_size):
+        """Remember the part size of a multipart upload and the parts finished so far"""
+        with self._connect() as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO upload_checkpoints (key, upload_id, parts, part_size, updated_at) "
+                         "VALUES (?, ?, ?, ?, ?)", (key, upload_id, json.dumps(parts), part_size, _now()))
+
+    def load_upload_checkpoint(self, key):
+        """(upload id, finished part numbers, part size) of an interrupted upload, or None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT upload_id, parts, part_size FROM upload_checkpoints WHERE key = ?",
+                               (key,)).fetchone()
+        if row is None:
+            return None
+        return row["upload_id"], json.loads(row["parts"]), row["part_size"]
+
+    def clear_upload_checkpoint(self, key):
+        with self._connect() as conn, conn:
+            conn.execute("DELETE FROM upload_checkpoints WHERE key = ?", (key,))
 
-    def load_config(self):
+    def load_config(self, path=None):
         import yaml
-        with open(CONFIG_FILE, "r") as f:
+        with open(path or self.config_file, "r") as f:
             return yaml.safe_load(f)
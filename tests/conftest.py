@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """State, catalog and log paths are relative, so every test runs in its own directory"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def s3_config(workdir):
+    """Config for a moto S3 with an empty bucket; the cached clients are rebuilt for it"""
+    moto = pytest.importorskip("moto")
+    import boto3
+    from s3.client import reset_clients
+
+    config = {
+        "s3": {"bucket": "backups", "region": "us-east-1", "aws_access_key_id": "testing",
+               "aws_secret_access_key": "testing", "part_size_mb": 5, "max_concurrency": 4,
+               "multipart_threshold_mb": 5},
+        "catalog": {"path": str(workdir / "catalog.db")},
+    }
+    with moto.mock_aws():
+        reset_clients()
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="backups")
+        yield config
+        reset_clients()
@@ -0,0 +1,24 @@
+import pytest
+from click.testing import CliRunner
+
+import cli
+from utils.compression import resolve_codec
+
+
+@pytest.mark.parametrize("codec,level", [("gzip", 10), ("gzip", -1), ("zstd", 0), ("zstd", 23), ("lz4", 17)])
+def test_levels_outside_the_codec_range_are_rejected(codec, level):
+    with pytest.raises(Exception, match="out of range"):
+        resolve_codec(codec, level)
+
+
+def test_levels_default_per_codec():
+    assert resolve_codec("gzip", 9) == ("gzip", 9)
+    assert resolve_codec("zstd") == ("zstd", 3)
+    assert resolve_codec(None, 0) == ("gzip", 0)
+
+
+def test_cli_rejects_a_bad_level_before_dumping(monkeypatch):
+    monkeypatch.setattr(cli, "run_backup", lambda *args, **kwargs: pytest.fail("a backup was started"))
+    result = CliRunner().invoke(cli.cli, ["backup", "--db", "mysql", "--codec", "gzip", "--level", "15"])
+    assert result.exit_code == 2
+    assert "out of range for gzip (0-9)" in result.output
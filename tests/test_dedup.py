@@ -0,0 +1,78 @@
+import datetime
+import os
+
+import pytest
+
+from backup import dedup
+from s3 import catalog
+from s3.client import get_client
+from utils.compression import decompress_chunks
+
+
+def _dump(seed, lines=150000):
+    rng = __import__("random").Random(seed)
+    return b"".join(f"INSERT INTO t VALUES ({i}, '{rng.random()}');\n".encode() for i in range(lines))
+
+
+def _reassemble(config, key):
+    manifest = dedup.read_manifest(config, key)
+    s3 = get_client(config)
+    parts = []
+    for entry in manifest["chunks"]:
+        codec = dedup.chunk_codec(manifest, entry)
+        body = s3.get_object(Bucket="backups", Key=dedup.chunk_key(entry[0], codec))["Body"].read()
+        parts.append(b"".join(decompress_chunks([body], codec)))
+    return b"".join(parts)
+
+
+def _age_chunks(config, monkeypatch):
+    """Make every chunk look older than the GC grace period"""
+    listed = catalog.iter_objects
+    old = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=2)
+
+    def aged(config, prefix=""):
+        for obj in listed(config, prefix):
+            yield dict(obj, LastModified=old) if obj["Key"].startswith(catalog.CHUNK_PREFIX) else obj
+    monkeypatch.setattr(catalog, "iter_objects", aged)
+
+
+def test_reused_chunks_keep_the_codec_they_were_stored_with(s3_config):
+    data = _dump(1)
+    first = dedup.store_stream([data], "mysql_backup_2026-01-01-00-00-00.sql", s3_config, codec="gzip")
+    second = dedup.store_stream([data + b"-- tail\n"], "mysql_backup_2026-01-02-00-00-00.sql", s3_config,
+                                codec="zstd")
+
+    manifest = dedup.read_manifest(s3_config, second)
+    assert {dedup.chunk_codec(manifest, e) for e in manifest["chunks"][:-1]} == {"gzip"}
+    assert _reassemble(s3_config, first) == data
+    assert _reassemble(s3_config, second) == data + b"-- tail\n"
+
+
+def test_gc_waits_for_running_backups(s3_config):
+    lease, _ = dedup._acquire_lease(s3_config, "mysql_backup_2026-01-01-00-00-00.sql")
+    with pytest.raises(Exception, match="running"):
+        dedup.gc_chunks(s3_config)
+    get_client(s3_config).delete_object(Bucket="backups", Key=lease)
+    assert dedup.gc_chunks(s3_config) == []
+
+
+def test_backup_does_not_start_while_gc_runs(s3_config):
+    dedup._write_gc_marker(s3_config, None, running=True)
+    with pytest.raises(Exception, match="GC is running"):
+        dedup.store_stream([b"x\n"], "mysql_backup_2026-01-01-00-00-00.sql", s3_config)
+    assert not list(catalog.iter_objects(s3_config, prefix=catalog.LOCK_PREFIX + "backup-"))
+
+
+def test_index_is_rebuilt_after_gc_on_another_host(s3_config, workdir, monkeypatch):
+    data = _dump(2)
+    key = dedup.store_stream([data], "mysql_backup_2026-01-01-00-00-00.sql", s3_config)
+    other_host = dict(s3_config, catalog={"path": str(workdir / "other.db")})
+    get_client(s3_config).delete_object(Bucket="backups", Key=key)
+    _age_chunks(s3_config, monkeypatch)
+    assert dedup.gc_chunks(other_host)
+    assert not list(catalog.iter_objects(s3_config, prefix=catalog.CHUNK_PREFIX))
+
+    # This host's index still lists the deleted chunks, the new GC generation makes it re-check S3
+    key = dedup.store_stream([data], "mysql_backup_2026-01-02-00-00-00.sql", s3_config)
+    assert dedup.read_manifest(s3_config, key)["new_chunks"] == len(dedup.read_manifest(s3_config, key)["chunks"])
+    assert _reassemble(s3_config, key) == data
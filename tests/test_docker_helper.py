@@ -0,0 +1,99 @@
+import json
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from utils import docker_helper
+
+CONTAINERS = [
+    {"Id": "a" * 64, "Names": ["/db-mysql-1"], "Image": "docker.io/library/mysql:8.0", "Labels": {}},
+    {"Id": "b" * 64, "Names": ["/reporting"], "Image": "postgres:16", "Labels": {"backup": "reporting"}},
+    {"Id": "c" * 64, "Names": ["/pg-main"], "Image": "postgres:16", "Labels": {"backup": "main"}},
+]
+
+
+class FakeDocker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.requests = []
+        self.containers = list(CONTAINERS)
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(self.path)
+                body = json.dumps(server.containers).encode() if self.path == "/containers/json" else b"{}"
+                self.send_response(200 if self.path == "/containers/json" else 404)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def address_string(self):
+                return "docker"
+
+            def log_message(self, format, *args):
+                pass
+
+        super().__init__(path, Handler)
+
+
+@pytest.fixture
+def docker(workdir, monkeypatch):
+    path = str(workdir / "docker.sock")
+    monkeypatch.setenv("DOCKER_HOST", f"unix://{path}")
+    docker_helper.invalidate_container_cache()
+    server = FakeDocker(path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    docker_helper.invalidate_container_cache()
+
+
+def test_containers_are_resolved_by_image_and_label(docker):
+    assert docker_helper.find_running_container("mysql") == "db-mysql-1"
+    assert docker_helper.find_running_container("postgres", {"postgres": {"container_label": "backup=main"}}) == "pg-main"
+    assert docker_helper.find_running_container("postgres", {"postgres": {"container": "pinned"}}) == "pinned"
+    assert len(docker.requests) == 1
+
+
+def test_listing_is_cached_for_the_ttl(docker, monkeypatch):
+    docker_helper.list_running_containers()
+    docker.containers = []
+    assert docker_helper.list_running_containers()
+    monkeypatch.setattr(docker_helper.time, "monotonic", lambda: 10 ** 9)
+    assert docker_helper.list_running_containers() == []
+    assert len(docker.requests) == 2
+
+
+def test_unreachable_docker_is_retried_before_the_ttl(workdir, monkeypatch):
+    path = str(workdir / "docker.sock")
+    monkeypatch.setenv("DOCKER_HOST", f"unix://{path}")
+    docker_helper.invalidate_container_cache()
+    assert docker_helper.list_running_containers() is None
+
+    server = FakeDocker(path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        now = docker_helper.time.monotonic()
+        monkeypatch.setattr(docker_helper.time, "monotonic", lambda: now + docker_helper.DOCKER_RETRY_INTERVAL)
+        assert [c["name"] for c in docker_helper.list_running_containers()][0] == "db-mysql-1"
+    finally:
+        server.shutdown()
+        server.server_close()
+        docker_helper.invalidate_container_cache()
+
+
+def test_failed_throttled_command_drops_the_cache(docker, workdir):
+    from utils.throttle import TokenBucket
+
+    docker_helper.list_running_containers()
+    ok = docker_helper.run_command_with_fallback(["/nonexistent/mysqldump"], str(workdir / "out.sql"),
+                                                 bucket=TokenBucket(10 ** 9))
+    assert not ok
+    docker_helper.list_running_containers()
+    assert len(docker.requests) == 2
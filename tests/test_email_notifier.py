@@ -0,0 +1,157 @@
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from utils.email_notifier import EmailNotifier
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Just enough of an SMTP server for smtplib: records each message body and can drop sessions"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+        self.messages = []
+        self.sessions = []
+        self.refuse = False
+
+    def drop_sessions(self):
+        for connection in self.sessions:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.server.sessions.append(self.connection)
+        self.reply("220 stand-in")
+        data = None
+        for raw in self.rfile:
+            line = raw.decode().rstrip("\r\n")
+            if data is not None:
+                if line == ".":
+                    self.server.messages.append("\n".join(data))
+                    data = None
+                    self.reply("250 queued")
+                else:
+                    data.append(line)
+                continue
+            command = line.upper()
+            if command.startswith("MAIL") and self.server.refuse:
+                self.reply("550 refused")
+            elif command == "DATA":
+                data = []
+                self.reply("354 go ahead")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+
+@pytest.fixture
+def smtp():
+    server = SMTPStandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _config(smtp, **email):
+    defaults = {"smtp_server": "127.0.0.1", "smtp_port": smtp.server_address[1], "from": "backup@example.com",
+                "starttls": False, "digest_window": 0.2, "max_per_hour": 20}
+    return {"email": dict(defaults, **email)}
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def test_events_within_the_window_are_one_digest(smtp):
+    config = _config(smtp)
+    notifier = EmailNotifier()
+    for number in range(3):
+        notifier.notify(config, "ops@example.com", [f"dump{number}.sql"], "mysql", 1, success=number != 1,
+                        errors=["dump failed"] if number == 1 else None)
+    notifier.notify(config, "dba@example.com", ["pg.sql"], "postgres", 1)
+
+    assert _wait_for(lambda: len(smtp.messages) == 2)
+    time.sleep(0.3)
+    assert len(smtp.messages) == 2
+    digest = next(m for m in smtp.messages if "ops@example.com" in m)
+    assert "Subject: Backup digest: 3 runs, 1 with errors" in digest
+    assert all(f"dump{number}.sql" in digest for number in range(3))
+    # Both went through the one session
+    assert len(smtp.sessions) == 1
+
+
+def test_rate_limit_holds_back_until_flush(smtp):
+    config = _config(smtp, digest_window=0, max_per_hour=1)
+    notifier = EmailNotifier()
+    notifier.notify(config, "ops@example.com", ["first.sql"], "mysql", 1)
+    assert _wait_for(lambda: len(smtp.messages) == 1)
+
+    notifier.notify(config, "ops@example.com", ["second.sql"], "mysql", 1)
+    notifier.notify(config, "ops@example.com", ["third.sql"], "mysql", 1)
+    assert not _wait_for(lambda: len(smtp.messages) > 1, timeout=0.5)
+
+    notifier.flush()
+    assert len(smtp.messages) == 2
+    assert "second.sql" in smtp.messages[1] and "third.sql" in smtp.messages[1]
+
+
+def test_failed_sends_do_not_count_against_the_rate_limit(smtp):
+    config = _config(smtp, digest_window=0, max_per_hour=1)
+    notifier = EmailNotifier()
+    smtp.refuse = True
+    notifier.notify(config, "ops@example.com", ["lost.sql"], "mysql", 1)
+    assert _wait_for(lambda: not notifier.pending and not notifier.sending)
+
+    smtp.refuse = False
+    notifier.notify(config, "ops@example.com", ["kept.sql"], "mysql", 1)
+    assert _wait_for(lambda: len(smtp.messages) == 1)
+    assert "kept.sql" in smtp.messages[0]
+
+
+def test_reconnects_after_the_server_dropped_the_session(smtp):
+    config = _config(smtp, digest_window=0)
+    notifier = EmailNotifier()
+    notifier.notify(config, "ops@example.com", ["first.sql"], "mysql", 1)
+    assert _wait_for(lambda: len(smtp.messages) == 1)
+
+    smtp.drop_sessions()
+    notifier.notify(config, "ops@example.com", ["second.sql"], "mysql", 1)
+    assert _wait_for(lambda: len(smtp.messages) == 2)
+    assert "second.sql" in smtp.messages[1]
+    assert len(smtp.sessions) == 2
+
+
+def test_pending_digests_are_sent_at_exit(smtp, workdir):
+    # A digest window far longer than the process lives
+    config = _config(smtp, digest_window=600)
+    script = ("from utils.email_notifier import get_notifier\n"
+              f"get_notifier().notify({config!r}, 'ops@example.com', ['exit.sql'], 'mysql', 1)\n")
+    subprocess.run([sys.executable, "-c", script], check=True, cwd=workdir,
+                   env=dict(os.environ, PYTHONPATH=REPO_DIR), timeout=30)
+    assert _wait_for(lambda: len(smtp.messages) == 1)
+    assert "exit.sql" in smtp.messages[0]
@@ -0,0 +1,109 @@
+import pytest
+
+pytest.importorskip("mysql.connector")
+
+from backup import mysql_backup, restore
+
+
+class FakeCursor:
+    """Answers queries from a list of (statement prefix, rows); records what was executed"""
+
+    def __init__(self, answers, executed):
+        self.answers = answers
+        self.executed = executed
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+        self.rows = next(rows for prefix, rows in self.answers if sql.startswith(prefix))
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, answers):
+        self.answers = answers
+        self.executed = []
+
+    def cursor(self):
+        return FakeCursor(self.answers, self.executed)
+
+
+def test_generated_columns_are_left_to_the_server(workdir):
+    conn = FakeConnection([
+        ("SHOW CREATE TABLE", [("orders", "CREATE TABLE `orders` (...)")]),
+        ("SELECT COLUMN_NAME", [("id", ""), ("total", "STORED GENERATED"), ("net", "VIRTUAL GENERATED"),
+                                ("updated", "DEFAULT_GENERATED on update CURRENT_TIMESTAMP")]),
+        ("SELECT `id`,`updated`", [(1, "2026-10-01 12:00:00"), (2, None)]),
+    ])
+    rows = mysql_backup._dump_table(conn, "orders", workdir / "orders.sql", False, False)
+
+    assert rows == 2
+    assert "SELECT `id`,`updated` FROM `orders`" in conn.executed
+    assert (b"INSERT INTO `orders` (`id`,`updated`) VALUES (1,'2026-10-01 12:00:00'),(2,NULL);"
+            in (workdir / "orders.sql").read_bytes())
+
+
+def test_schema_objects_are_dumped_in_dependency_order(workdir):
+    conn = FakeConnection([
+        ("SHOW FULL TABLES WHERE Table_type = 'VIEW'", [("top_customers", "VIEW"), ("customer_totals", "VIEW")]),
+        ("SHOW CREATE VIEW `top_customers`",
+         [("top_customers", "CREATE VIEW `top_customers` AS select * from `app`.`customer_totals`")]),
+        ("SHOW CREATE VIEW `customer_totals`",
+         [("customer_totals", "CREATE VIEW `customer_totals` AS select * from `app`.`orders`")]),
+        ("SHOW TRIGGERS", [("orders_audit", "INSERT", "orders")]),
+        ("SHOW CREATE TRIGGER", [("orders_audit", "STRICT_TRANS_TABLES",
+                                  "CREATE TRIGGER `orders_audit` AFTER INSERT ON `orders` FOR EACH ROW BEGIN "
+                                  "INSERT INTO audit VALUES (NEW.id); END")]),
+        ("SHOW PROCEDURE STATUS", [("app", "archive_orders")]),
+        ("SHOW CREATE PROCEDURE", [("archive_orders", "", "CREATE PROCEDURE `archive_orders`() BEGIN END")]),
+        ("SHOW FUNCTION STATUS", []),
+        ("SHOW EVENTS", [("app", "nightly_archive")]),
+        ("SHOW CREATE EVENT", [("nightly_archive", "", "SYSTEM",
+                                "CREATE EVENT `nightly_archive` ON SCHEDULE EVERY 1 DAY DO CALL archive_orders()")]),
+    ])
+    counts = mysql_backup._dump_schema_objects(conn, "app", workdir / "objects.sql")
+
+    assert counts == {"views": 2, "triggers": 1, "procedures": 1, "functions": 0, "events": 1}
+    script = (workdir / "objects.sql").read_text()
+    assert script.index("CREATE VIEW `customer_totals`") < script.index("CREATE VIEW `top_customers`")
+    assert "SET SESSION sql_mode = 'STRICT_TRANS_TABLES';;\nDROP TRIGGER IF EXISTS `orders_audit`;;\n" in script
+    assert "INSERT INTO audit VALUES (NEW.id); END;;\n" in script
+    assert script.index("DELIMITER ;;") < script.index("CREATE TRIGGER") < script.index("DELIMITER ;\n")
+
+
+@pytest.fixture
+def restored(monkeypatch):
+    keys = []
+    monkeypatch.setattr(restore.downloader, "iter_backup", lambda config, key, concurrency=None: iter([key.encode()]))
+    monkeypatch.setattr(restore, "pipe_into_client", lambda config, db, chunks: keys.append(b"".join(chunks).decode()))
+    return keys
+
+
+MANIFEST = {"format": "per-table", "tables": [{"name": "customers", "file": "customers.sql", "bytes": 10},
+                                              {"name": "orders", "file": "orders.sql", "bytes": 10}],
+            "schema_objects": {"file": "_schema_objects.sql", "bytes": 5, "views": 1}}
+
+
+def test_schema_objects_are_restored_after_the_tables(restored):
+    config = {"s3": {"bucket": "backups"}}
+    restore.restore_mysql_tables(config, "mysql_backup_2026-10-01-12-00-00/", MANIFEST, jobs=2)
+    assert sorted(restored[:2]) == ["mysql_backup_2026-10-01-12-00-00/customers.sql",
+                                    "mysql_backup_2026-10-01-12-00-00/orders.sql"]
+    assert restored[2] == "mysql_backup_2026-10-01-12-00-00/_schema_objects.sql"
+
+
+def test_selected_tables_leave_the_schema_objects_out(restored):
+    config = {"s3": {"bucket": "backups"}}
+    restore.restore_mysql_tables(config, "mysql_backup_2026-10-01-12-00-00/", MANIFEST, tables=["orders"], jobs=2)
+    assert restored == ["mysql_backup_2026-10-01-12-00-00/orders.sql"]
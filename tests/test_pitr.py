@@ -0,0 +1,108 @@
+import struct
+import subprocess
+import time
+from datetime import datetime
+
+import pytest
+
+from backup import incremental_backup, mysql_backup, pitr
+from s3 import catalog
+from state_manager import StateManager
+
+DUMP_HEADER = (b"-- MySQL dump 10.13\n"
+               b"CHANGE MASTER TO MASTER_LOG_FILE='binlog.000003', MASTER_LOG_POS=120;\n")
+
+
+@pytest.fixture
+def mysql_config(s3_config, monkeypatch):
+    monkeypatch.setattr(mysql_backup, "server_capabilities", lambda config, db: {"log_bin": True})
+    return dict(s3_config, mysql={"host": "db1", "port": 3306, "user": "backup", "password": "secret",
+                                  "database": "app"})
+
+
+def _event(when, kind, size=40):
+    timestamp = int(datetime.strptime(when, "%Y-%m-%d %H:%M:%S").timestamp())
+    return struct.pack("<IBIIIH", timestamp, kind, 1, size, 0, 0) + b"\0" * (size - 19)
+
+
+def _binlog(path, *events):
+    # Format description, the given (time, type) events, then the rotate that closed the file
+    body = [_event(events[0][0], 15)] + [_event(when, kind) for when, kind in events] + [_event(events[-1][0], 4)]
+    path.write_bytes(incremental_backup.BINLOG_MAGIC + b"".join(body))
+
+
+def _fake_dump(*chunks):
+    def start_dump(*args):
+        yield from chunks
+    return start_dump
+
+
+class _Stop(Exception):
+    pass
+
+
+def _ship_once(config, output_dir, monkeypatch):
+    """One pass of the binlog daemon over the files already in output_dir"""
+    class Stream:
+        returncode = None
+
+        def __init__(self, cmd, stderr):
+            pass
+
+        def poll(self):
+            return None
+
+        def terminate(self):
+            self.returncode = -15
+
+        def wait(self):
+            return self.returncode
+
+    monkeypatch.setattr(incremental_backup, "command_exists", lambda cmd: True)
+    monkeypatch.setattr(subprocess, "Popen", Stream)
+    monkeypatch.setattr(time, "sleep", lambda seconds: (_ for _ in ()).throw(_Stop()))
+    with pytest.raises(_Stop):
+        incremental_backup.binlog_daemon(config, output_dir)
+
+
+def test_streamed_full_backup_is_a_recovery_base(mysql_config, monkeypatch):
+    monkeypatch.setattr(mysql_backup, "_start_dump", _fake_dump(DUMP_HEADER, b"INSERT INTO t VALUES (1);\n"))
+    key = mysql_backup.backup_stream(mysql_config, "2026-10-01-12-00-00")
+
+    [base] = catalog.log_entries(mysql_config, "db1:3306", kind="full")
+    assert base["key"] == key
+    assert (base["start_file"], base["start_pos"], base["end_time"]) == ("binlog.000003", 120, "2026-10-01 12:00:00")
+
+
+def test_partial_dumps_are_not_recovery_bases(mysql_config):
+    assert mysql_backup.is_pitr_base(mysql_config)
+    assert not mysql_backup.is_pitr_base(mysql_config, tables=["t"])
+    assert not mysql_backup.is_pitr_base(dict(mysql_config, mysql=dict(mysql_config["mysql"], pitr=False)))
+
+
+def test_raw_event_times_skip_bookkeeping(workdir):
+    _binlog(workdir / "binlog.000003", ("2026-10-01 12:05:00", 2), ("2026-10-01 12:20:00", 2))
+    assert incremental_backup.raw_event_times(workdir / "binlog.000003") == ("2026-10-01 12:05:00",
+                                                                             "2026-10-01 12:20:00")
+
+
+def test_daemon_segments_continue_the_chain(mysql_config, workdir, monkeypatch):
+    monkeypatch.setattr(mysql_backup, "_start_dump", _fake_dump(DUMP_HEADER))
+    mysql_backup.backup_stream(mysql_config, "2026-10-01-12-00-00")
+
+    StateManager().save_binlog_position("db1:3306", "binlog.000003", 4)
+    stream_dir = workdir / "stream"
+    stream_dir.mkdir()
+    _binlog(stream_dir / "binlog.000003", ("2026-10-01 11:50:00", 2), ("2026-10-01 12:20:00", 2))
+    _binlog(stream_dir / "binlog.000004", ("2026-10-01 12:30:00", 2), ("2026-10-01 13:10:00", 2))
+    # Still being written
+    _binlog(stream_dir / "binlog.000005", ("2026-10-01 13:20:00", 2))
+    _ship_once(mysql_config, stream_dir, monkeypatch)
+
+    assert sorted(p.name for p in stream_dir.iterdir()) == ["binlog.000005"]
+    assert StateManager().load_binlog_position("db1:3306") == ("binlog.000005", 4)
+    recovery = pitr.plan(mysql_config, datetime(2026, 10, 1, 13, 0))
+    assert [(s["start_file"], s["end_file"]) for s in recovery["logs"]] == [("binlog.000003", "binlog.000004"),
+                                                                          ("binlog.000004", "binlog.000005")]
+    assert all(pitr.is_raw_binlog(s["key"]) for s in recovery["logs"])
+    assert not pitr.is_raw_binlog("mysql_incremental_backup_2026-10-01-12-00-00.sql.zst.enc")
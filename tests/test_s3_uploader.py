@@ -0,0 +1,144 @@
+import base64
+import hashlib
+import os
+import threading
+import time
+import zlib
+
+import pytest
+
+from backup import verify
+from s3.client import MB, get_checksum_algorithm, get_client
+from s3.digests import read_sidecar
+from s3.uploader import upload_directory, upload_file_resumable, upload_stream, upload_to_s3
+
+
+def _checksum(config, key):
+    return get_client(config).get_object_attributes(Bucket="backups", Key=key,
+                                                    ObjectAttributes=["Checksum"]).get("Checksum", {})
+
+
+def test_default_checksum_is_crc32():
+    # CRC32C needs the optional awscrt package, CRC32 does not
+    assert get_checksum_algorithm({"s3": {}}) == "CRC32"
+    assert get_checksum_algorithm({"s3": {"checksum_algorithm": "none"}}) is None
+
+
+def test_stream_is_split_into_parts_of_the_configured_size(s3_config):
+    data = os.urandom(12 * MB)
+    chunks = (data[i:i + MB] for i in range(0, len(data), MB))
+    key = upload_stream(chunks, "mysql_backup_2026-01-01-00-00-00.sql.gz", s3_config)
+
+    s3 = get_client(s3_config)
+    assert s3.get_object(Bucket="backups", Key=key)["Body"].read() == data
+    sizes = [s3.head_object(Bucket="backups", Key=key, PartNumber=n)["ContentLength"] for n in (1, 2, 3)]
+    assert sizes == [5 * MB, 5 * MB, 2 * MB]
+
+
+def _crc32(body):
+    return base64.b64encode(zlib.crc32(body).to_bytes(4, "big")).decode()
+
+
+def test_parts_carry_crc32_checksums(s3_config, monkeypatch):
+    s3 = get_client(s3_config)
+    completed = []
+    complete = s3.complete_multipart_upload
+    monkeypatch.setattr(s3, "complete_multipart_upload",
+                        lambda **kwargs: completed.append(kwargs["MultipartUpload"]["Parts"]) or complete(**kwargs))
+    data = os.urandom(11 * MB)
+    upload_stream([data], "mysql_backup_2026-01-01-00-00-00.sql.gz", s3_config)
+
+    parts = completed[0]
+    bodies = [data[:5 * MB], data[5 * MB:10 * MB], data[10 * MB:]]
+    assert [p["PartNumber"] for p in parts] == [1, 2, 3]
+    assert [p["ChecksumCRC32"] for p in parts] == [_crc32(b) for b in bodies]
+
+
+def test_small_stream_is_a_single_put_with_checksum(s3_config):
+    key = upload_stream([b"tiny dump"], "mysql_backup_2026-01-01-00-00-00.sql", s3_config)
+
+    head = get_client(s3_config).head_object(Bucket="backups", Key=key, ChecksumMode="ENABLED")
+    assert head["ContentLength"] == len(b"tiny dump")
+    assert "ChecksumCRC32" in head
+
+
+def test_single_put_metadata_is_the_sha256_of_the_object(s3_config):
+    key = upload_stream([b"hello"], "mysql_backup_2026-01-01-00-00-00.sql", s3_config)
+
+    head = get_client(s3_config).head_object(Bucket="backups", Key=key)
+    assert head["Metadata"]["sha256"] == hashlib.sha256(b"hello").hexdigest()
+    assert verify._check_record(s3_config, key, read_sidecar(s3_config, key)) is None
+
+
+def test_streams_below_the_multipart_threshold_are_a_single_put(s3_config, monkeypatch):
+    config = dict(s3_config, s3=dict(s3_config["s3"], multipart_threshold_mb=20))
+    s3 = get_client(config)
+    monkeypatch.setattr(s3, "create_multipart_upload", lambda **kwargs: pytest.fail("multipart upload started"))
+    data = os.urandom(12 * MB)
+    key = upload_stream((data[i:i + MB] for i in range(0, len(data), MB)), "mysql_backup_2026-01-01-00-00-00.sql",
+                        config)
+
+    assert s3.get_object(Bucket="backups", Key=key)["Body"].read() == data
+
+
+def test_directory_files_share_the_part_slots(s3_config, workdir, monkeypatch):
+    config = dict(s3_config, s3=dict(s3_config["s3"], max_concurrency=2))
+    backup_dir = workdir / "mysql_backup_2026-01-01-00-00-00"
+    backup_dir.mkdir()
+    files = {f"t{n}.sql": os.urandom(11 * MB) for n in range(3)}
+    for name, data in files.items():
+        (backup_dir / name).write_bytes(data)
+
+    s3 = get_client(config)
+    lock = threading.Lock()
+    in_flight = [0, 0]
+    upload_part = s3.upload_part
+
+    def counted(**kwargs):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        try:
+            time.sleep(0.05)
+            return upload_part(**kwargs)
+        finally:
+            with lock:
+                in_flight[0] -= 1
+    monkeypatch.setattr(s3, "upload_part", counted)
+    upload_directory(str(backup_dir), config, max_workers=3)
+
+    assert in_flight[1] <= 2
+    for name, data in files.items():
+        assert s3.get_object(Bucket="backups", Key=f"{backup_dir.name}/{name}")["Body"].read() == data
+
+
+def test_file_upload_uses_crc32_without_crt(s3_config, workdir):
+    path = workdir / "postgres_backup_2026-01-01-00-00-00.sql"
+    data = os.urandom(7 * MB)
+    path.write_bytes(data)
+
+    for key in (upload_to_s3(str(path), s3_config), upload_file_resumable(str(path), s3_config)):
+        assert get_client(s3_config).get_object(Bucket="backups", Key=key)["Body"].read() == data
+        assert "ChecksumCRC32" in _checksum(s3_config, key)
+
+
+def test_resume_uses_the_recorded_part_size(s3_config, workdir):
+    from state_manager import StateManager
+
+    path = workdir / "mysql_backup_2026-01-01-00-00-00.sql.zst"
+    data = os.urandom(12 * MB)
+    path.write_bytes(data)
+    key = path.name
+    state = StateManager()
+    s3 = get_client(s3_config)
+    # An earlier run with 5 MB parts where only the short last part finished
+    upload_id = s3.create_multipart_upload(Bucket="backups", Key=key, ChecksumAlgorithm="CRC32")["UploadId"]
+    s3.upload_part(Bucket="backups", Key=key, UploadId=upload_id, PartNumber=3, Body=data[10 * MB:],
+                   ChecksumAlgorithm="CRC32")
+    state.save_upload_checkpoint(key, upload_id, [3], 5 * MB)
+
+    config = dict(s3_config, s3=dict(s3_config["s3"], part_size_mb=6))
+    upload_file_resumable(str(path), config, key, state=state)
+
+    assert s3.get_object(Bucket="backups", Key=key)["Body"].read() == data
+    assert state.load_upload_checkpoint(key) is None
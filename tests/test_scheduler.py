@@ -0,0 +1,92 @@
+import socket
+import time
+
+import pytest
+
+from scheduler import Scheduler
+from state_manager import StateManager
+
+
+@pytest.fixture
+def scheduler(workdir, monkeypatch):
+    from backup import mysql_backup
+
+    (workdir / "config.yaml").write_text("mysql:\n  host: db1\n  port: 3306\n")
+    monkeypatch.setenv("TMP", str(workdir))
+    dumps = []
+
+    def fake_backup(config, date, *args):
+        path = workdir / f"mysql_backup_{date}-{len(dumps)}.sql"
+        path.write_text("-- dump\n")
+        dumps.append(path)
+        return path
+    monkeypatch.setattr(mysql_backup, "backup", fake_backup)
+    scheduler = Scheduler(StateManager(), dispatch=False)
+    scheduler.add_schedule("mysql", None, None, None, False, False, False, None, cron="0 3 * * *",
+                           schedule_id="nightly")
+    yield scheduler
+    scheduler.stop()
+
+
+def _run(scheduler):
+    details = scheduler.schedules["nightly"]
+    scheduler.running["nightly"] = details["host"]
+    scheduler._run("nightly", details, None, 0)
+    return details
+
+
+def test_failed_upload_keeps_the_dump_for_the_next_run(scheduler, monkeypatch):
+    from s3 import uploader
+
+    uploaded = []
+    monkeypatch.setattr(uploader, "upload_file_resumable", lambda path, config, key, state: (_ for _ in ()).throw(
+        Exception("network down")))
+    details = _run(scheduler)
+    assert "nightly" not in scheduler.running
+    assert details["last_error"] == "network down"
+    [job] = scheduler.state_manager.pending_backup_jobs("mysql")
+    assert job["meta"]["schedule_id"] == "nightly"
+
+    monkeypatch.setattr(uploader, "upload_file_resumable", lambda path, config, key, state: uploaded.append(key) or key)
+    details = _run(scheduler)
+    assert details["last_error"] is None and details["completed"] == 1
+    assert len(uploaded) == 2
+    assert not scheduler.state_manager.pending_backup_jobs("mysql")
+
+
+def test_schedule_is_released_when_recording_fails(scheduler, monkeypatch):
+    from s3 import uploader
+
+    monkeypatch.setattr(uploader, "upload_file_resumable", lambda path, config, key, state: key)
+
+    def broken(*args):
+        raise Exception("database is locked")
+    monkeypatch.setattr(scheduler.state_manager, "finish_job", broken)
+    details = _run(scheduler)
+    assert "nightly" not in scheduler.running
+    assert details["completed"] == 1
+
+
+def test_refused_second_daemon_runs_nothing(workdir, monkeypatch):
+    import run_scheduler
+
+    (workdir / "config.yaml").write_text("mysql:\n  host: db1\n  port: 3306\n")
+    # Due right away: a daemon that dispatches at all would start it
+    Scheduler(StateManager(), dispatch=False).add_schedule("mysql", None, None, None, False, False, False, None,
+                                                           interval=60, schedule_id="frequent")
+    path = str(workdir / "control.sock")
+    monkeypatch.setenv("DBBACKUP_SOCKET", path)
+    monkeypatch.setattr(run_scheduler.signal, "signal", lambda *args: None)
+    runs = []
+    monkeypatch.setattr(Scheduler, "_run", lambda self, *args: runs.append(args))
+
+    first = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    first.bind(path)
+    first.listen()
+    try:
+        with pytest.raises(Exception, match="Another scheduler daemon"):
+            run_scheduler.main()
+        time.sleep(0.5)
+    finally:
+        first.close()
+    assert runs == []
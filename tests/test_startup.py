@@ -0,0 +1,19 @@
+import os
+import subprocess
+import sys
+
+from cli import CODEC_CHOICES
+from utils.compression import CODECS
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks",
+                         "startup_benchmark.py")
+
+
+def test_codec_choices_match_the_compression_codecs():
+    assert CODEC_CHOICES == list(CODECS)
+
+
+def test_cli_starts_within_budget():
+    # More runs than the script's default: the fastest counts, so this keeps a loaded machine from failing it
+    result = subprocess.run([sys.executable, BENCHMARK, "--runs", "10"], capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stdout + result.stderr
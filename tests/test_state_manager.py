@@ -0,0 +1,23 @@
+import json
+
+from state_manager import StateManager
+
+
+def test_binlog_positions_are_kept_in_the_state_db(workdir):
+    state = StateManager()
+    assert state.load_binlog_position("db1:3306") is None
+    state.save_binlog_position("db1:3306", "binlog.000007", 1234)
+    state.save_binlog_position("db1:3306", "binlog.000008", 4)
+
+    assert StateManager().load_binlog_position("db1:3306") == ("binlog.000008", 4)
+    assert not (workdir / "config" / "binlog_position.json").exists()
+
+
+def test_legacy_binlog_positions_are_imported_once(workdir):
+    (workdir / "config").mkdir()
+    legacy = workdir / "config" / "binlog_position.json"
+    legacy.write_text(json.dumps({"db1:3306": {"file": "binlog.000003", "position": "120"}}))
+
+    assert StateManager().load_binlog_position("db1:3306") == ("binlog.000003", 120)
+    assert not legacy.exists()
+    assert (workdir / "config" / "binlog_position.json.migrated").exists()
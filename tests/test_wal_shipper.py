@@ -0,0 +1,49 @@
+import pytest
+
+from backup import wal_shipper
+from s3 import catalog, uploader
+
+SEGMENT_SIZE = 1024 * 1024
+
+
+@pytest.fixture
+def wal_config(s3_config, workdir, monkeypatch):
+    monkeypatch.setattr(wal_shipper, "_unsettled", {})
+    archive = workdir / "wal_archive"
+    archive.mkdir()
+    return dict(s3_config, postgres={"wal_archive_dir": str(archive), "wal_segment_size_mb": 1})
+
+
+def _archive(config, name, size):
+    path = f"{config['postgres']['wal_archive_dir']}/{name}"
+    with open(path, "wb") as f:
+        f.write(b"\1" * size)
+    return path
+
+
+def test_segments_still_being_archived_wait(wal_config):
+    _archive(wal_config, "000000010000000000000001", SEGMENT_SIZE)
+    _archive(wal_config, "000000010000000000000002", SEGMENT_SIZE // 2)
+
+    keys = wal_shipper.ship_new_segments(wal_config, jobs=2, compress=False)
+    assert keys == ["wal/00000001/000000010000000000000001"]
+    assert catalog.shipped_wal_segments(wal_config) == {"000000010000000000000001"}
+
+    # Unchanged since the last poll: archive_command wrote a short file on purpose
+    keys = wal_shipper.ship_new_segments(wal_config, jobs=2, compress=False)
+    assert keys == ["wal/00000001/000000010000000000000002"]
+
+
+def test_segment_written_during_upload_is_not_recorded(wal_config, monkeypatch):
+    path = _archive(wal_config, "000000010000000000000003", SEGMENT_SIZE)
+    upload_stream = uploader.upload_stream
+
+    def racing_upload(chunks, key, config, **kwargs):
+        result = upload_stream(chunks, key, config, **kwargs)
+        with open(path, "ab") as f:
+            f.write(b"\2")
+        return result
+    monkeypatch.setattr(uploader, "upload_stream", racing_upload)
+
+    assert wal_shipper.ship_new_segments(wal_config, jobs=1, compress=False) == []
+    assert catalog.shipped_wal_segments(wal_config) == set()
@@ -0,0 +1,212 @@
+import gzip
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils import metrics
+
+# codec -> file extension; the extension is what listing and restore use to detect the codec
+CODECS = {
+    "gzip": ".gz",
+    "zstd": ".zst",
+    "lz4": ".lz4",
+}
+# Appended after the codec's extension by client-side encryption (utils/encryption.py)
+ENCRYPTED_EXTENSION = ".enc"
+
+DEFAULT_LEVELS = {
+    "gzip": 6,
+    "zstd": 3,
+    "lz4": 0,
+}
+# Lowest and highest level each codec accepts
+LEVEL_RANGES = {
+    "gzip": (0, 9),
+    "zstd": (1, 22),
+    "lz4": (0, 16),
+}
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def _require(codec):
+    try:
+        if codec == "zstd":
+            import zstandard
+            return zstandard
+        if codec == "lz4":
+            import lz4.frame
+            return lz4.frame
+    except ImportError:
+        package = "zstandard" if codec == "zstd" else "lz4"
+        raise Exception(f"Codec {codec} needs the '{package}' package installed")
+    return None
+
+
+def resolve_codec(codec=None, level=None):
+    """Validate a codec name and level, filling in the codec's default level"""
+    codec = codec or "gzip"
+    if codec not in CODECS:
+        raise Exception(f"Unsupported codec: {codec} (choose from {', '.join(CODECS)})")
+    if level is None:
+        return codec, DEFAULT_LEVELS[codec]
+    lowest, highest = LEVEL_RANGES[codec]
+    if not lowest <= level <= highest:
+        raise Exception(f"Compression level {level} is out of range for {codec} ({lowest}-{highest})")
+    return codec, level
+
+
+def extension(codec):
+    return CODECS[codec]
+
+
+def detect_codec(name):
+    """Return the codec a backup file or key was compressed with, or None if it is not compressed"""
+    name = str(name)
+    if name.endswith(ENCRYPTED_EXTENSION):
+        name = name[:-len(ENCRYPTED_EXTENSION)]
+    for codec, ext in CODECS.items():
+        if name.endswith(ext):
+            return codec
+    return None
+
+
+def gzip_chunks(chunks, level=6):
+    """Gzip-compress an iterable of byte chunks on the fly"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def fixed_blocks(chunks, block_size=BLOCK_SIZE):
+    """Regroup byte chunks into blocks of block_size bytes, the last one possibly shorter"""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= block_size:
+            yield bytes(buffer[:block_size])
+            del buffer[:block_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def _parallel_blocks(chunks, compress_block, threads):
+    """
+    Compress fixed-size blocks independently on a thread pool and yield them in order.
+
+    zlib and lz4 release the GIL while compressing, so blocks really run in parallel.
+    Only a couple of blocks per thread are kept in flight to bound memory.
+    """
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for block in fixed_blocks(chunks):
+            pending.append(pool.submit(compress_block, block))
+            if len(pending) >= threads * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def compress_chunks(chunks, codec="gzip", level=None, threads=1):
+    """Compress an iterable of byte chunks with the given codec, using `threads` workers"""
+    codec, level = resolve_codec(codec, level)
+
+    if codec == "zstd":
+        zstandard = _require("zstd")
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads if threads > 1 else 0)
+        obj = compressor.compressobj()
+        for chunk in chunks:
+            data = obj.compress(chunk)
+            if data:
+                yield data
+        yield obj.flush()
+        return
+
+    if codec == "lz4":
+        lz4_frame = _require("lz4")
+        if threads > 1:
+            # Concatenated frames decode as one stream
+            yield from _parallel_blocks(chunks, lambda b: lz4_frame.compress(b, compression_level=level), threads)
+            return
+        compressor = lz4_frame.LZ4FrameCompressor(compression_level=level)
+        yield compressor.begin()
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+        return
+
+    if threads > 1:
+        # Every block becomes its own gzip member; multi-member files are valid gzip
+        def gzip_block(block):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            return compressor.compress(block) + compressor.flush()
+        yield from _parallel_blocks(chunks, gzip_block, threads)
+        return
+
+    yield from gzip_chunks(chunks, level)
+
+
+def decompress_chunks(chunks, codec):
+    """Decompress an iterable of byte chunks, handling multi-member gzip and multi-frame lz4"""
+    if codec is None:
+        yield from chunks
+        return
+
+    if codec == "zstd":
+        zstandard = _require("zstd")
+        make = lambda: zstandard.ZstdDecompressor().decompressobj()
+    elif codec == "lz4":
+        lz4_frame = _require("lz4")
+        make = lambda: lz4_frame.LZ4FrameDecompressor()
+    else:
+        make = lambda: zlib.decompressobj(31)
+
+    obj = make()
+    for chunk in chunks:
+        while chunk:
+            data = obj.decompress(chunk)
+            if data:
+                yield data
+            if obj.eof:
+                chunk = obj.unused_data
+                obj = make()
+            else:
+                chunk = b""
+
+
+def read_chunks(f, chunk_size=1024 * 1024):
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def compress_file(file_path, codec="gzip", level=None, threads=1):
+    """Compress a local file next to itself, remove the original and return the new path"""
+    codec, level = resolve_codec(codec, level)
+    compressed_path = file_path.with_suffix(file_path.suffix + extension(codec))
+    with metrics.stage("compress", codec=codec) as stage:
+        with open(file_path, "rb") as f_in, open(compressed_path, "wb") as f_out:
+            for data in compress_chunks(read_chunks(f_in), codec, level, threads):
+                f_out.write(data)
+        stage.bytes_in, stage.bytes_out = os.path.getsize(file_path), os.path.getsize(compressed_path)
+    os.remove(file_path)
+    return compressed_path
+
+
+def open_compressed(file_path, codec="gzip", level=None):
+    """Open a file for writing through the given codec"""
+    codec, level = resolve_codec(codec, level)
+    if codec == "zstd":
+        zstandard = _require("zstd")
+        return zstandard.ZstdCompressor(level=level).stream_writer(open(file_path, "wb"), closefd=True)
+    if codec == "lz4":
+        lz4_frame = _require("lz4")
+        return lz4_frame.open(file_path, "wb", compression_level=level)
+    return gzip.open(file_path, "wb", compresslevel=level)
@@ -0,0 +1,191 @@
+import threading
+import time
+from contextlib import contextmanager
+from utils.logger import logger
+
+DEFAULT_POOL_SIZE = 4
+CAPABILITY_CACHE_TTL = 300
+
+_pools = {}
+_pools_lock = threading.Lock()
+_capabilities = {}
+_capabilities_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """A small blocking pool of driver connections; broken connections are dropped, not reused"""
+
+    def __init__(self, connect, is_alive, max_size=DEFAULT_POOL_SIZE):
+        self.connect = connect
+        self.is_alive = is_alive
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        self.slots.acquire()
+        conn = None
+        try:
+            with self.lock:
+                while self.idle and conn is None:
+                    candidate = self.idle.pop()
+                    if self.is_alive(candidate):
+                        conn = candidate
+                    else:
+                        _close(candidate)
+            if conn is None:
+                conn = self.connect()
+            try:
+                yield conn
+                conn.rollback()
+            except Exception:
+                _close(conn)
+                conn = None
+                raise
+            with self.lock:
+                self.idle.append(conn)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                _close(conn)
+            self.idle = []
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def server_id(config, db):
+    conf = config[db]
+    return f"{db}://{conf['user']}@{conf['host']}:{conf['port']}/{conf['database']}"
+
+
+def _mysql_pool(conf):
+    import mysql.connector
+
+    def connect():
+        return mysql.connector.connect(
+            host=conf["host"],
+            port=int(conf["port"]),
+            user=conf["user"],
+            password=conf["password"],
+            database=conf["database"],
+            autocommit=True,
+            connection_timeout=10
+        )
+    return ConnectionPool(connect, lambda c: c.is_connected(), conf.get("pool_size", DEFAULT_POOL_SIZE))
+
+
+def _postgres_pool(conf):
+    import psycopg2
+
+    def connect():
+        conn = psycopg2.connect(
+            host=conf["host"],
+            port=int(conf["port"]),
+            user=conf["user"],
+            password=conf.get("password"),
+            dbname=conf["database"],
+            connect_timeout=10
+        )
+        conn.autocommit = True
+        return conn
+    return ConnectionPool(connect, lambda c: not c.closed, conf.get("pool_size", DEFAULT_POOL_SIZE))
+
+
+def get_pool(config, db):
+    """Shared connection pool for the configured mysql or postgres server"""
+    key = server_id(config, db)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            try:
+                factory = {"mysql": _mysql_pool, "postgres": _postgres_pool}[db]
+            except KeyError:
+                raise Exception(f"Unsupported database: {db}")
+            try:
+                pool = _pools[key] = factory(config[db])
+            except ImportError as e:
+                raise Exception(f"The {db} driver is not installed: {e}")
+    return pool
+
+
+def connection(config, db):
+    return get_pool(config, db).connection()
+
+
+def query(config, db, sql, params=None):
+    """Run a query on a pooled connection and return all rows"""
+    with connection(config, db) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+
+def _probe_mysql(config):
+    rows = query(config, "mysql",
+                 "SHOW GLOBAL VARIABLES WHERE Variable_name IN ('log_bin', 'binlog_format', 'version', 'gtid_mode')")
+    variables = {name: value for name, value in rows}
+    return {
+        "log_bin": str(variables.get("log_bin", "OFF")).upper() in ("ON", "1"),
+        "binlog_format": variables.get("binlog_format"),
+        "gtid_mode": variables.get("gtid_mode"),
+        "version": variables.get("version"),
+    }
+
+
+def _probe_postgres(config):
+    rows = query(config, "postgres",
+                 "SELECT name, setting FROM pg_settings WHERE name IN ('wal_level', 'archive_mode', 'server_version')")
+    settings = dict(rows)
+    return {
+        "wal_level": settings.get("wal_level"),
+        "archive_mode": settings.get("archive_mode"),
+        "version": settings.get("server_version"),
+    }
+
+
+def server_capabilities(config, db, refresh=False):
+    """
+    Backup-relevant server settings (log_bin, wal_level, archive_mode, version, ...),
+    cached per server for `capability_cache_ttl` seconds.
+    """
+    key = server_id(config, db)
+    ttl = config[db].get("capability_cache_ttl", CAPABILITY_CACHE_TTL)
+    now = time.monotonic()
+    with _capabilities_lock:
+        cached = _capabilities.get(key)
+        if cached and not refresh and now - cached[0] < ttl:
+            return cached[1]
+
+    probe = _probe_mysql if db == "mysql" else _probe_postgres
+    capabilities = probe(config)
+    logger.debug(f"{db} capabilities: {capabilities}")
+    with _capabilities_lock:
+        _capabilities[key] = (now, capabilities)
+    return capabilities
+
+
+def invalidate_capabilities(config=None, db=None):
+    with _capabilities_lock:
+        if config is None:
+            _capabilities.clear()
+        else:
+            _capabilities.pop(server_id(config, db), None)
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -1,50 +1,172 @@
+import http.client
+import json
+import os
+import socket
 import subprocess
 import shutil
+import tempfile
+import threading
+import time
 from utils.logger import logger
+from utils.throttle import throttled
 
 
 def command_exists(cmd):
     return shutil.which(cmd) is not None
 
 
-def find_running_container(keyword):
+DEFAULT_DOCKER_SOCKET = "/var/run/docker.sock"
+CONTAINER_CACHE_TTL = 30
+# An unreachable Docker daemon is asked again after this long, not after a full TTL
+DOCKER_RETRY_INTERVAL = 2
+
+_cache_lock = threading.Lock()
+_container_cache = {"at": 0.0, "containers": None, "failed_at": None}
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP over a Unix domain socket (Docker Engine API, scheduler control socket)"""
+
+    def __init__(self, socket_path, timeout=5):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def docker_socket_path():
+    docker_host = os.getenv("DOCKER_HOST", "")
+    if docker_host.startswith("unix://"):
+        return docker_host[len("unix://"):]
+    return DEFAULT_DOCKER_SOCKET
+
+
+def _docker_api_get(path):
+    conn = UnixHTTPConnection(docker_socket_path())
     try:
-        result = subprocess.run(
-            ["docker", "ps", "--format", "{{.Names}} {{.Image}}"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        for line in result.stdout.strip().splitlines():
-            name, image = line.split(maxsplit=1)
-            if keyword.lower() in image.lower():
-                return name
+        conn.request("GET", path)
+        response = conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise Exception(f"Docker API {path} returned {response.status}: {body[:200]!r}")
+        return json.loads(body)
+    finally:
+        conn.close()
+
+
+def list_running_containers(ttl=CONTAINER_CACHE_TTL):
+    """Running containers from the Docker Engine API, cached for `ttl` seconds; None if Docker is unreachable"""
+    with _cache_lock:
+        now = time.monotonic()
+        if _container_cache["containers"] is not None and now - _container_cache["at"] < ttl:
+            return _container_cache["containers"]
+        failed_at = _container_cache["failed_at"]
+        if failed_at is not None and now - failed_at < min(ttl, DOCKER_RETRY_INTERVAL):
+            return None
+    try:
+        containers = [{
+            "name": c["Names"][0].lstrip("/") if c.get("Names") else c["Id"][:12],
+            "image": c.get("Image", ""),
+            "labels": c.get("Labels") or {},
+        } for c in _docker_api_get("/containers/json")]
     except Exception as e:
-        logger.warning(f"Could not check Docker containers: {e}")
+        logger.debug(f"Could not query Docker Engine API: {e}")
+        with _cache_lock:
+            _container_cache.update(containers=None, failed_at=time.monotonic())
+        return None
+    with _cache_lock:
+        _container_cache.update(containers=containers, at=time.monotonic(), failed_at=None)
+    return containers
+
+
+def invalidate_container_cache():
+    with _cache_lock:
+        _container_cache.update(containers=None, failed_at=None)
+
+
+def _image_matches(image, keyword):
+    # "docker.io/library/mysql:8.0" -> "mysql"; also accepts e.g. "mysql/mysql-server"
+    repository = image.split("@", 1)[0].rsplit("/", 1)[-1].split(":", 1)[0].lower()
+    return repository == keyword or repository.startswith(keyword + "-")
+
+
+def find_running_container(keyword, config=None):
+    """
+    Name of the running container to exec the client tools in, or None to run them locally.
+
+    config[keyword] may pin it with `container: <name>` or `container_label: key=value`;
+    otherwise the first container whose image repository is `keyword` is used.
+    """
+    keyword = keyword.lower()
+    db_conf = (config or {}).get(keyword) or {}
+    explicit = db_conf.get("container")
+    label = db_conf.get("container_label")
+
+    containers = list_running_containers(db_conf.get("container_cache_ttl", CONTAINER_CACHE_TTL))
+    if explicit:
+        if containers is not None and explicit not in {c["name"] for c in containers}:
+            logger.warning(f"Configured container {explicit} is not running")
+        return explicit
+    if not containers:
+        return None
+
+    if label:
+        key, _, value = label.partition("=")
+        for c in containers:
+            if key in c["labels"] and (not value or c["labels"][key] == value):
+                return c["name"]
+        return None
+
+    for c in containers:
+        if _image_matches(c["image"], keyword):
+            return c["name"]
     return None
 
 
-def run_command_with_fallback(cmd, file_path, fallback_container=None):
+def run_command_with_fallback(cmd, file_path, env=None, fallback_container=None, bucket=None):
     """Try to run command directly; if fails, retry via Docker exec"""
+    if bucket is not None:
+        return _run_throttled(cmd, file_path, env, fallback_container, bucket)
 
     try:
         if fallback_container:
             docker_cmd = ["docker", "exec", fallback_container] + cmd
             with open(file_path, "w") as f:
-                result = subprocess.run(docker_cmd, stdout=f, stderr=subprocess.PIPE, text=True)
+                result = subprocess.run(docker_cmd, stdout=f, stderr=subprocess.PIPE, text=True, env=env)
         else:
             with open(file_path, "w") as f:
-                result = subprocess.run(cmd, stdout=f, stderr=subprocess.PIPE, text=True)
+                result = subprocess.run(cmd, stdout=f, stderr=subprocess.PIPE, text=True, env=env)
     except Exception as e:
         logger.error(f"Error running command: {e}")
+        invalidate_container_cache()
         return False
 
     if result.returncode == 0:
         return True
 
     logger.error(f"Command failed: {result.stderr}")
+    if fallback_container:
+        # The container may have been replaced; resolve it again next time
+        invalidate_container_cache()
     return False
 
+def _run_throttled(cmd, file_path, env, fallback_container, bucket):
+    # The output passes through here so reading it can be paced; the command blocks on the full pipe meanwhile
+    try:
+        proc = start_command_with_fallback(cmd, env=env, fallback_container=fallback_container)
+        with open(file_path, "wb") as f:
+            for chunk in throttled(iter_command_output(proc), bucket):
+                f.write(chunk)
+    except Exception as e:
+        logger.error(f"Error running command: {e}")
+        invalidate_container_cache()
+        return False
+    return True
+
 def run_command_with_fallback_without_file(cmd, fallback_container=None):
     try:
         if fallback_container:
@@ -54,10 +176,82 @@ def run_command_with_fallback_without_file(cmd, fallback_container=None):
             result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
     except Exception as e:
         logger.error(f"Error running command: {e}")
+        invalidate_container_cache()
         return None
 
     if result.returncode == 0:
         return result.stdout
 
     logger.error(f"Command failed: {result.stderr}")
+    if fallback_container:
+        invalidate_container_cache()
     return None
+
+def start_command_with_fallback(cmd, env=None, fallback_container=None):
+    """Start command with stdout piped for streaming, via Docker exec when a container is given"""
+    if fallback_container:
+        cmd = ["docker", "exec", fallback_container] + cmd
+    # stderr goes to an anonymous temp file so a chatty command can never block on a full pipe
+    stderr_file = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file, env=env)
+    proc.stderr_file = stderr_file
+    return proc
+
+def start_input_command_with_fallback(cmd, env=None, fallback_container=None):
+    """Start command with stdin piped for streaming input, via `docker exec -i` when a container is given"""
+    if fallback_container:
+        cmd = ["docker", "exec", "-i", fallback_container] + cmd
+    stderr_file = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr_file, env=env)
+    proc.stderr_file = stderr_file
+    return proc
+
+def feed_command(proc, chunks):
+    """Write byte chunks to a started command's stdin and raise if it exits non-zero"""
+    try:
+        try:
+            for chunk in chunks:
+                proc.stdin.write(chunk)
+            proc.stdin.close()
+        except BrokenPipeError:
+            # The command exited early; its status and stderr say why
+            pass
+        returncode = proc.wait()
+        proc.stderr_file.seek(0)
+        stderr = proc.stderr_file.read().decode(errors="replace")
+        if returncode != 0:
+            logger.error(f"Command failed: {stderr}")
+            invalidate_container_cache()
+            raise Exception(f"Command exited with status {returncode}")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if not proc.stdin.closed:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        proc.stderr_file.close()
+
+def iter_command_output(proc, chunk_size=1024 * 1024):
+    """Yield stdout chunks of a started command and raise if it exits non-zero"""
+    try:
+        while True:
+            chunk = proc.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        returncode = proc.wait()
+        proc.stderr_file.seek(0)
+        stderr = proc.stderr_file.read().decode(errors="replace")
+        if returncode != 0:
+            logger.error(f"Command failed: {stderr}")
+            invalidate_container_cache()
+            raise Exception(f"Command exited with status {returncode}")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        proc.stderr_file.close()
@@ -1,18 +1,166 @@
-from email.mime.text import MIMEText
+"""
+Backup notification emails, sent by one worker thread over a reused SMTP session.
+
+Events for a recipient are held for `email.digest_window` seconds and then sent as a
+single message, and no recipient gets more than `email.max_per_hour` messages; events
+held back by that limit join the next digest. Whatever is pending is sent when the
+process exits.
+"""
+import atexit
+import threading
+import time
+from collections import deque
+from datetime import datetime
 from utils.logger import logger
-from utils.logger import disable_console_logging
+
+DEFAULT_DIGEST_WINDOW = 60
+DEFAULT_MAX_PER_HOUR = 20
+# An open SMTP session is closed after this long without mail
+SESSION_IDLE = 60
+RATE_PERIOD = 3600
+FLUSH_TIMEOUT = 30
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def _smtp_id(config):
+    email = config["email"]
+    return email["smtp_server"], email["smtp_port"], email.get("username")
+
+
+def _format(events):
+    """Subject and body for one or more events of a recipient"""
+    lines = []
+    for event in events:
+        status = "completed and uploaded successfully" if event["success"] else "completed with errors"
+        lines.append(f"[{event['time']}] {event['count']} backup(s) {status} for database: {event['db']}")
+        if event["files"]:
+            lines.append("Uploaded Files:")
+            lines.extend(f"  {f}" for f in event["files"])
+        if event["errors"]:
+            lines.append("Errors:")
+            lines.extend(f"  {e}" for e in event["errors"])
+        lines.append("")
+    failed = sum(1 for e in events if not e["success"])
+    if len(events) == 1:
+        subject = "Backup Uploaded Successfully" if not failed else "Backup Completed With Errors"
+    else:
+        subject = f"Backup digest: {len(events)} runs" + (f", {failed} with errors" if failed else "")
+    return subject, "\n".join(lines)
+
 
 class EmailNotifier:
-    def notify_in_background(config, email_address, uploaded_files, db, count):
+    """Queue of notification events drained by a single worker; see the module docstring"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.pending = {}   # recipient -> {"config", "events", "due"}
+        self.sent = {}      # recipient -> deque of send times within the rate period
+        self.senders = {}   # smtp server -> EmailSender
+        self.flushing = False
+        self.sending = 0
+        self.worker = None
+
+    def notify(self, config, email_address, uploaded_files, db, count, success=True, errors=None):
+        """Queue a notification; returns at once, the worker sends it"""
+        if not (config or {}).get("email"):
+            logger.warning(f"No email settings configured, not notifying {email_address}")
+            return
+        event = {"db": db, "count": count, "success": success, "files": [str(f) for f in uploaded_files],
+                 "errors": list(errors or []), "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        with self.wakeup:
+            entry = self.pending.get(email_address)
+            if entry is None:
+                window = float(config["email"].get("digest_window", DEFAULT_DIGEST_WINDOW))
+                entry = self.pending[email_address] = {"config": config, "events": [], "due": time.monotonic() + window}
+            entry["events"].append(event)
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._work, name="notifier", daemon=True)
+                self.worker.start()
+            self.wakeup.notify()
+
+    def _allowed_at(self, recipient, config, now):
+        limit = int(config["email"].get("max_per_hour", DEFAULT_MAX_PER_HOUR))
+        sent = self.sent.setdefault(recipient, deque())
+        while sent and sent[0] <= now - RATE_PERIOD:
+            sent.popleft()
+        return now if len(sent) < limit else sent[0] + RATE_PERIOD
+
+    def _take_due(self, now):
+        """Digests ready to send, and when the next one will be"""
+        due, next_due = [], None
+        for recipient, entry in list(self.pending.items()):
+            ready = now if self.flushing else max(entry["due"], self._allowed_at(recipient, entry["config"], now))
+            if ready <= now:
+                due.append((recipient, self.pending.pop(recipient)))
+            elif next_due is None or ready < next_due:
+                next_due = ready
+        return due, next_due
+
+    def _work(self):
+        while True:
+            with self.wakeup:
+                due, next_due = self._take_due(time.monotonic())
+                if not due:
+                    if not self.pending and not self.senders:
+                        self.worker = None
+                        self.wakeup.notify_all()
+                        return
+                    idle = next_due is None
+                    timeout = SESSION_IDLE if idle else next_due - time.monotonic()
+                    self.wakeup.wait(timeout)
+                    if idle and not self.pending:
+                        self._close_senders()
+                    continue
+                self.sending = len(due)
+            for recipient, entry in due:
+                self._send(recipient, entry)
+            with self.wakeup:
+                self.sending = 0
+                self.wakeup.notify_all()
+
+    def _send(self, recipient, entry):
         from notification.email_sender import EmailSender
-        disable_console_logging()
-
-        logger.info(f"Sending notification email to {email_address} for {db} backups")
-        sender = EmailSender(config)
-        files_list = '\n'.join(uploaded_files)
-        subject = "Backup Uploaded Successfully"
-        body = (
-            f"{count} backup(s) completed and uploaded successfully for database: {db}\n\n"
-            f"Uploaded Files:\n{files_list}"
-        )
-        sender.send_notification(subject=subject, body=body, to_email=email_address)
+
+        config = entry["config"]
+        subject, body = _format(entry["events"])
+        sender = self.senders.get(_smtp_id(config))
+        if sender is None:
+            sender = self.senders[_smtp_id(config)] = EmailSender(config)
+        try:
+            sender.send_notification(subject=subject, body=body, to_email=recipient)
+            # Only delivered messages count against the rate limit
+            with self.lock:
+                self.sent.setdefault(recipient, deque()).append(time.monotonic())
+            logger.info(f"Sent notification to {recipient} ({len(entry['events'])} event(s))")
+        except Exception as e:
+            logger.error(f"Could not send notification to {recipient}, {len(entry['events'])} event(s) lost: {e}")
+
+    def _close_senders(self):
+        for sender in self.senders.values():
+            sender.close()
+        self.senders = {}
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Send everything pending now, ignoring the digest window and rate limit, and wait for it"""
+        deadline = time.monotonic() + timeout
+        with self.wakeup:
+            self.flushing = True
+            self.wakeup.notify_all()
+            while (self.pending or self.sending) and self.worker is not None and time.monotonic() < deadline:
+                self.wakeup.wait(deadline - time.monotonic())
+            self.flushing = False
+            if self.pending:
+                logger.warning(f"Notifications for {', '.join(self.pending)} were not sent before shutdown")
+
+
+def get_notifier():
+    """The process-wide notifier; pending notifications are flushed when the process exits"""
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None:
+            _notifier = EmailNotifier()
+            atexit.register(_notifier.flush)
+    return _notifier
@@ -0,0 +1,196 @@
+"""
+Client-side encryption of backups: chunked AES-256-GCM under a random key per backup.
+
+An encrypted object is a header followed by records. The header holds the plaintext
+chunk size, a nonce prefix and the backup's data key wrapped with the configured master
+key; each record is one chunk of plaintext sealed with the data key, nonce prefix plus
+chunk number as nonce. The last record is sealed as such, so a truncated object fails
+to decrypt instead of restoring short. Records have a fixed size, so any chunk can be
+fetched with a ranged GET and decrypted on its own.
+"""
+import base64
+import os
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils import metrics
+from utils.compression import ENCRYPTED_EXTENSION, compress_chunks, fixed_blocks, read_chunks, resolve_codec, extension
+
+
+MAGIC = b"DBBKENC1"
+NONCE_SIZE = 12
+NONCE_PREFIX_SIZE = 8
+KEY_SIZE = 32
+TAG_SIZE = 16
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+HEADER = struct.Struct(f">8sI{NONCE_PREFIX_SIZE}s{NONCE_SIZE + KEY_SIZE + TAG_SIZE}s")
+LAST, NOT_LAST = b"\x01", b"\x00"
+
+
+def _aesgcm():
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        return AESGCM
+    except ImportError:
+        raise Exception("Encryption needs the 'cryptography' package installed")
+
+
+def _settings(config):
+    return config.get("encryption") or {}
+
+
+def enabled(config):
+    """Whether new backups are encrypted"""
+    return bool(_settings(config).get("enabled"))
+
+
+def master_key(config):
+    """
+    The 32-byte master key, base64 encoded in `encryption.key` or in the file named by
+    `encryption.key_file` (e.g. made with `head -c 32 /dev/urandom | base64`).
+    """
+    settings = _settings(config)
+    encoded = settings.get("key")
+    if not encoded and settings.get("key_file"):
+        with open(settings["key_file"]) as f:
+            encoded = f.read().strip()
+    if not encoded:
+        raise Exception("No encryption key configured (encryption.key or encryption.key_file)")
+    try:
+        key = base64.b64decode(encoded, validate=True)
+    except ValueError:
+        raise Exception("The encryption key is not valid base64")
+    if len(key) != KEY_SIZE:
+        raise Exception(f"The encryption key must be {KEY_SIZE} bytes, got {len(key)}")
+    return key
+
+
+def get_chunk_size(config):
+    return max(int(_settings(config).get("chunk_size_kb", DEFAULT_CHUNK_SIZE // 1024)), 1) * 1024
+
+
+def get_threads(config):
+    return max(int(_settings(config).get("threads", 1)), 1)
+
+
+def is_encrypted(name):
+    return str(name).endswith(ENCRYPTED_EXTENSION)
+
+
+def _nonce(prefix, index):
+    return prefix + struct.pack(">I", index)
+
+
+def encrypt_chunks(chunks, key, chunk_size=DEFAULT_CHUNK_SIZE, threads=1):
+    """
+    Encrypt an iterable of byte chunks on the fly.
+
+    Records are sealed on `threads` worker threads (AES-GCM releases the GIL), so
+    encryption overlaps with producing the input and uploading the output; a couple of
+    records per thread are kept in flight to bound memory.
+    """
+    AESGCM = _aesgcm()
+    data_key = AESGCM.generate_key(bit_length=KEY_SIZE * 8)
+    wrap_nonce = os.urandom(NONCE_SIZE)
+    wrapped = wrap_nonce + AESGCM(key).encrypt(wrap_nonce, data_key, MAGIC)
+    prefix = os.urandom(NONCE_PREFIX_SIZE)
+    cipher = AESGCM(data_key)
+    yield HEADER.pack(MAGIC, chunk_size, prefix, wrapped)
+
+    def seal(index, block, last):
+        return cipher.encrypt(_nonce(prefix, index), block, LAST if last else NOT_LAST)
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        # One block is held back: only the end of the input tells which one is the last
+        index, held = 0, None
+        for block in fixed_blocks(chunks, chunk_size):
+            if held is not None:
+                pending.append(pool.submit(seal, index, held, False))
+                index += 1
+            held = block
+            if len(pending) >= threads * 2:
+                yield pending.popleft().result()
+        pending.append(pool.submit(seal, index, held or b"", True))
+        while pending:
+            yield pending.popleft().result()
+
+
+class Decryptor:
+    """Opens the records of one encrypted object, in any order"""
+
+    def __init__(self, header, key):
+        if len(header) < HEADER.size:
+            raise Exception("Encrypted backup is truncated")
+        magic, self.chunk_size, self.prefix, wrapped = HEADER.unpack(header[:HEADER.size])
+        if magic != MAGIC:
+            raise Exception("Not an encrypted backup")
+        AESGCM = _aesgcm()
+        try:
+            data_key = AESGCM(key).decrypt(wrapped[:NONCE_SIZE], wrapped[NONCE_SIZE:], MAGIC)
+        except Exception:
+            raise Exception("Cannot decrypt backup: wrong encryption key")
+        self.cipher = AESGCM(data_key)
+        self.record_size = self.chunk_size + TAG_SIZE
+
+    def record_count(self, object_size):
+        return -(-(object_size - HEADER.size) // self.record_size)
+
+    def plaintext_size(self, object_size):
+        body = object_size - HEADER.size
+        count = self.record_count(object_size)
+        if count < 1 or body - (count - 1) * self.record_size < TAG_SIZE:
+            raise Exception("Encrypted backup is truncated")
+        return body - count * TAG_SIZE
+
+    def record_offset(self, index):
+        """Byte offset of record `index` in the object"""
+        return HEADER.size + index * self.record_size
+
+    def decrypt(self, index, record, last):
+        try:
+            return self.cipher.decrypt(_nonce(self.prefix, index), record, LAST if last else NOT_LAST)
+        except Exception:
+            raise Exception(f"Encrypted backup is corrupted or truncated at chunk {index}")
+
+
+def decrypt_chunks(chunks, key):
+    """Decrypt an encrypted object read front to back as an iterable of byte chunks"""
+    buffer = bytearray()
+    decryptor = None
+    index = 0
+    for chunk in chunks:
+        buffer += chunk
+        if decryptor is None:
+            if len(buffer) < HEADER.size:
+                continue
+            decryptor = Decryptor(bytes(buffer[:HEADER.size]), key)
+            del buffer[:HEADER.size]
+        # A full record is only known not to be the last once more data follows it
+        while len(buffer) > decryptor.record_size:
+            yield decryptor.decrypt(index, bytes(buffer[:decryptor.record_size]), False)
+            del buffer[:decryptor.record_size]
+            index += 1
+    if decryptor is None:
+        raise Exception("Encrypted backup is truncated")
+    yield decryptor.decrypt(index, bytes(buffer), True)
+
+
+def encrypt_file(file_path, config, codec=None, level=None, threads=1):
+    """
+    Encrypt a local file next to itself, compressing it with `codec` in the same pass when
+    one is given; removes the original and returns the new path.
+    """
+    key = master_key(config)
+    suffix = extension(resolve_codec(codec, level)[0]) if codec else ""
+    encrypted_path = file_path.with_suffix(file_path.suffix + suffix + ENCRYPTED_EXTENSION)
+    with metrics.stage("encrypt", codec=codec) as stage:
+        with open(file_path, "rb") as f_in, open(encrypted_path, "wb") as f_out:
+            chunks = read_chunks(f_in)
+            if codec:
+                chunks = compress_chunks(chunks, codec, level, threads)
+            for data in encrypt_chunks(chunks, key, get_chunk_size(config), get_threads(config)):
+                f_out.write(data)
+        stage.bytes_in, stage.bytes_out = os.path.getsize(file_path), os.path.getsize(encrypted_path)
+    os.remove(file_path)
+    return encrypted_path
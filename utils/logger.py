@@ -1,5 +1,4 @@
 import logging
-from logging.handlers import RotatingFileHandler
 import os
 
 LOG_DIR = "logs"
@@ -8,12 +7,37 @@ LOG_FILE = os.path.join(LOG_DIR, "backup.log")
 if not os.path.exists(LOG_DIR):
     os.makedirs(LOG_DIR)
 
+class LazyRotatingFileHandler(logging.Handler):
+    """
+    RotatingFileHandler that is set up on the first record: logging.handlers pulls in
+    socket and pickle, which CLI commands that never log should not pay for at startup.
+    """
+
+    def __init__(self, filename, **kwargs):
+        super().__init__()
+        # Resolved now, like RotatingFileHandler does, in case the working directory changes
+        self.filename = os.path.abspath(filename)
+        self.kwargs = kwargs
+        self.handler = None
+
+    def emit(self, record):
+        if self.handler is None:
+            from logging.handlers import RotatingFileHandler
+            self.handler = RotatingFileHandler(self.filename, **self.kwargs)
+            self.handler.setFormatter(self.formatter)
+        self.handler.emit(record)
+
+    def close(self):
+        if self.handler is not None:
+            self.handler.close()
+        super().close()
+
 # Create logger object
 logger = logging.getLogger("dbbackup")
 logger.setLevel(logging.INFO)
 
 # Rotating File Handler (unchanged)
-file_handler = RotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3)
+file_handler = LazyRotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3)
 file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 file_handler.setFormatter(file_formatter)
 logger.addHandler(file_handler)
@@ -0,0 +1,259 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from utils.logger import logger
+
+DEFAULT_TEXTFILE = os.path.join("metrics", "dbbackup.prom")
+DEFAULT_HISTORY = 20
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400)
+MB = 1024 * 1024
+
+_local = threading.local()
+_file_lock = threading.Lock()
+
+
+def _child_cpu_seconds():
+    # Only covers children that have exited, and is process wide: with several runs at
+    # once each one sees the others' finished children too
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Stage:
+    """One timed stage of a backup; set bytes_in/bytes_out/retries while it runs"""
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.bytes_in = None
+        self.bytes_out = None
+        self.retries = 0
+        self.throttled_seconds = 0.0
+        self.seconds = 0.0
+        self.child_cpu_seconds = 0.0
+        self.success = False
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add_retries(self, response):
+        """Count the retries botocore needed for a response; safe to call from worker threads"""
+        retries = response.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        with self._lock:
+            self.retries += retries
+
+    def add_throttled(self, seconds):
+        """Count time spent waiting on a rate limit (utils/throttle.py); safe to call from worker threads"""
+        with self._lock:
+            self.throttled_seconds += seconds
+
+    def as_event(self):
+        # Throughput is measured on what a stage consumed, or produced when it has no input
+        size = self.bytes_in if self.bytes_in is not None else self.bytes_out
+        event = {
+            "event": "backup_stage",
+            "stage": self.name,
+            "seconds": round(self.seconds, 3),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "mb_per_s": round(size / MB / self.seconds, 2) if size and self.seconds else None,
+            "compression_ratio": round(self.bytes_in / self.bytes_out, 3) if self.bytes_in and self.bytes_out else None,
+            "retries": self.retries,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+            "child_cpu_seconds": round(self.child_cpu_seconds, 3),
+            "success": self.success,
+        }
+        event.update(self.labels)
+        return event
+
+
+class Run:
+    def __init__(self, target, db):
+        self.target = target
+        self.db = db
+        self.stages = []
+        self.current = None     # innermost stage running right now, for progress reports
+        self.started = time.time()
+
+
+@contextmanager
+def stage(name, **labels):
+    """Time a stage, log it as a JSON event and add it to the current run, if any"""
+    current = Stage(name, labels)
+    cpu = _child_cpu_seconds()
+    outer = getattr(_local, "stage", None)
+    run = getattr(_local, "run", None)
+    _local.stage = current
+    if run is not None:
+        run.current = current
+    try:
+        yield current
+        current.success = True
+    finally:
+        _local.stage = outer
+        current.seconds = time.monotonic() - current.started
+        current.child_cpu_seconds = _child_cpu_seconds() - cpu
+        event = current.as_event()
+        if run is not None:
+            run.current = outer
+            event.setdefault("target", run.target)
+            run.stages.append(event)
+        logger.info(json.dumps(event))
+
+
+def current_stage():
+    """The innermost stage running on this thread, or None"""
+    return getattr(_local, "stage", None)
+
+
+def counted(chunks, counter, attr):
+    """Pass byte chunks through, adding their length to counter.<attr>"""
+    setattr(counter, attr, getattr(counter, attr) or 0)
+    for chunk in chunks:
+        setattr(counter, attr, getattr(counter, attr) + len(chunk))
+        yield chunk
+
+
+def start_run(target, db):
+    """Start collecting the stages of one backup run on this thread"""
+    run = Run(target, db)
+    run.previous = getattr(_local, "run", None)
+    _local.run = run
+    return run
+
+
+def finish_run(config, run, success):
+    """Log a run summary and fold it into the per-target history and the Prometheus textfile"""
+    _local.run = run.previous
+    stages = {}
+    for event in run.stages:
+        total = stages.setdefault(event["stage"], {"seconds": 0.0, "bytes_in": 0, "bytes_out": 0, "retries": 0,
+                                                   "throttled_seconds": 0.0, "child_cpu_seconds": 0.0})
+        total["seconds"] += event["seconds"]
+        total["bytes_in"] += event["bytes_in"] or 0
+        total["bytes_out"] += event["bytes_out"] or 0
+        total["retries"] += event["retries"]
+        total["throttled_seconds"] += event.get("throttled_seconds", 0.0)
+        total["child_cpu_seconds"] += event["child_cpu_seconds"]
+    summary = {
+        "event": "backup_run",
+        "target": run.target,
+        "db": run.db,
+        "started": run.started,
+        "seconds": round(time.time() - run.started, 3),
+        "success": success,
+        "stages": stages,
+    }
+    logger.info(json.dumps(summary))
+    try:
+        _record(config or {}, summary)
+    except Exception as e:
+        logger.warning(f"Could not write backup metrics: {e}")
+    return summary
+
+
+def _settings(config):
+    settings = config.get("metrics") or {}
+    textfile = settings.get("textfile", DEFAULT_TEXTFILE)
+    return textfile, os.path.splitext(textfile)[0] + ".history.json", int(settings.get("history", DEFAULT_HISTORY))
+
+
+def _write_atomic(path, text):
+    # node_exporter may read the file at any moment, so never let it see a partial write
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _record(config, summary):
+    textfile, history_file, keep = _settings(config)
+    if not textfile:
+        return
+    with _file_lock:
+        history = {}
+        if os.path.exists(history_file):
+            with open(history_file) as f:
+                history = json.load(f)
+        runs = history.setdefault(summary["target"], [])
+        runs.append(summary)
+        del runs[:-keep]
+        _write_atomic(history_file, json.dumps(history))
+        _write_atomic(textfile, render(history))
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _histogram(lines, name, labels, values):
+    for bound in DURATION_BUCKETS:
+        lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {sum(1 for v in values if v <= bound)}")
+    lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {len(values)}")
+    lines.append(f"{name}_sum{_labels(**labels)} {sum(values):.3f}")
+    lines.append(f"{name}_count{_labels(**labels)} {len(values)}")
+
+
+def render(history):
+    """Prometheus text format: histograms over the kept runs, gauges for the latest one"""
+    families = {
+        "dbbackup_run_duration_seconds": ("histogram", "Wall time of the most recent backup runs"),
+        "dbbackup_stage_duration_seconds": ("histogram", "Wall time of each stage over the most recent runs"),
+        "dbbackup_last_run_success": ("gauge", "1 if the latest run succeeded"),
+        "dbbackup_last_run_timestamp_seconds": ("gauge", "Start time of the latest run"),
+        "dbbackup_stage_bytes": ("gauge", "Bytes a stage produced in the latest run"),
+        "dbbackup_stage_throughput_bytes_per_second": ("gauge", "Stage throughput in the latest run"),
+        "dbbackup_stage_compression_ratio": ("gauge", "Input bytes over output bytes in the latest run"),
+        "dbbackup_stage_retries": ("gauge", "S3 request retries during a stage in the latest run"),
+        "dbbackup_stage_child_cpu_seconds": ("gauge", "CPU time of child processes during a stage in the latest run"),
+        "dbbackup_stage_throttled_seconds": ("gauge", "Time a stage waited on rate limits in the latest run"),
+    }
+    samples = {name: [] for name in families}
+
+    for target, runs in sorted(history.items()):
+        if not runs:
+            continue
+        db = runs[-1]["db"]
+        base = {"target": target, "db": db}
+        _histogram(samples["dbbackup_run_duration_seconds"], "dbbackup_run_duration_seconds", base,
+                   [r["seconds"] for r in runs])
+        for stage_name in sorted({s for r in runs for s in r["stages"]}):
+            _histogram(samples["dbbackup_stage_duration_seconds"], "dbbackup_stage_duration_seconds",
+                       dict(base, stage=stage_name), [r["stages"][stage_name]["seconds"] for r in runs
+                                                      if stage_name in r["stages"]])
+
+        latest = runs[-1]
+        samples["dbbackup_last_run_success"].append(f"dbbackup_last_run_success{_labels(**base)} "
+                                                    f"{int(latest['success'])}")
+        samples["dbbackup_last_run_timestamp_seconds"].append(
+            f"dbbackup_last_run_timestamp_seconds{_labels(**base)} {latest['started']:.0f}")
+        for stage_name, totals in sorted(latest["stages"].items()):
+            labels = _labels(**base, stage=stage_name)
+            produced = totals["bytes_out"] or totals["bytes_in"]
+            samples["dbbackup_stage_bytes"].append(f"dbbackup_stage_bytes{labels} {produced}")
+            if totals["seconds"]:
+                size = totals["bytes_in"] or totals["bytes_out"]
+                samples["dbbackup_stage_throughput_bytes_per_second"].append(
+                    f"dbbackup_stage_throughput_bytes_per_second{labels} {size / totals['seconds']:.1f}")
+            if totals["bytes_in"] and totals["bytes_out"]:
+                samples["dbbackup_stage_compression_ratio"].append(
+                    f"dbbackup_stage_compression_ratio{labels} {totals['bytes_in'] / totals['bytes_out']:.3f}")
+            samples["dbbackup_stage_retries"].append(f"dbbackup_stage_retries{labels} {totals['retries']}")
+            samples["dbbackup_stage_child_cpu_seconds"].append(
+                f"dbbackup_stage_child_cpu_seconds{labels} {totals['child_cpu_seconds']:.3f}")
+            samples["dbbackup_stage_throttled_seconds"].append(
+                f"dbbackup_stage_throttled_seconds{labels} {totals.get('throttled_seconds', 0.0):.3f}")
+
+    lines = []
+    for name, (kind, help_text) in families.items():
+        if not samples[name]:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples[name])
+    return "\n".join(lines) + "\n"
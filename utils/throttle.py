@@ -0,0 +1,198 @@
+"""
+Rate limits that keep backups from hurting the production server and network.
+
+Configured under `throttle`:
+
+    throttle:
+      dump_mb_per_s: 40       # cap on what is read from the dump process, per database server
+      upload_mb_per_s: 80     # cap on what is sent to S3, shared by every upload of the process
+      nice: 10                # CPU priority of the dump process
+      ionice_class: 2         # I/O scheduling class of the dump process (1 realtime, 2 best-effort, 3 idle)
+      ionice_level: 7
+      adaptive:               # lower the dump cap while the server is busy
+        enabled: true
+        low_load: 8           # at or below, the full cap applies
+        high_load: 32         # at or above, only min_fraction of it
+        min_fraction: 0.1
+        interval: 5           # seconds between load checks
+
+Load is `Threads_running` on MySQL and the active client connections in
+`pg_stat_activity` on PostgreSQL. Reading the dump slower makes the dump process
+block on its pipe, which in turn slows down the queries it runs on the server.
+"""
+import threading
+import time
+from utils.logger import logger
+from utils import metrics
+
+MB = 1024 * 1024
+DEFAULT_LOW_LOAD = 8
+DEFAULT_HIGH_LOAD = 32
+DEFAULT_MIN_FRACTION = 0.1
+DEFAULT_INTERVAL = 5
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def _settings(config):
+    return config.get("throttle") or {}
+
+
+class TokenBucket:
+    """
+    A byte rate limit shared by threads. A caller may take more than is left and then
+    sleeps off the debt, so large parts are paced as well as small chunks.
+    """
+
+    def __init__(self, rate, burst=None, load=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.load = load
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def current_rate(self):
+        return self.rate * (self.load.factor() if self.load else 1.0)
+
+    def consume(self, size):
+        """Take `size` bytes, blocking until the rate allows them; returns the seconds waited"""
+        rate = self.current_rate()
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= size
+            wait = -self.tokens / rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+def server_load(config, db):
+    """Queries running on the server right now, not counting this check"""
+    from utils import db_pool
+
+    if db == "mysql":
+        rows = db_pool.query(config, "mysql", "SHOW GLOBAL STATUS LIKE 'Threads_running'")
+        # The status query itself is one of the running threads
+        return max(int(rows[0][1]) - 1, 0)
+    rows = db_pool.query(config, "postgres",
+                         "SELECT count(*) FROM pg_stat_activity WHERE state = 'active' "
+                         "AND backend_type = 'client backend' AND pid <> pg_backend_pid() "
+                         "AND application_name <> 'pg_dump'")
+    return int(rows[0][0])
+
+
+class LoadMonitor:
+    """Scales a rate down linearly between low_load and high_load; checked at most every `interval` seconds"""
+
+    def __init__(self, config, db, settings):
+        self.config = config
+        self.db = db
+        self.low = float(settings.get("low_load", DEFAULT_LOW_LOAD))
+        self.high = max(float(settings.get("high_load", DEFAULT_HIGH_LOAD)), self.low + 1)
+        self.min_fraction = min(max(float(settings.get("min_fraction", DEFAULT_MIN_FRACTION)), 0.01), 1.0)
+        self.interval = float(settings.get("interval", DEFAULT_INTERVAL))
+        self.checked = None
+        self._factor = 1.0
+        self._lock = threading.Lock()
+
+    def factor(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.checked is not None and now - self.checked < self.interval:
+                return self._factor
+            self.checked = now
+            try:
+                load = server_load(self.config, self.db)
+            except Exception as e:
+                # Keep the last known factor; the check is retried after the interval
+                logger.warning(f"Could not read {self.db} server load: {e}")
+                return self._factor
+            position = min(max((load - self.low) / (self.high - self.low), 0.0), 1.0)
+            factor = round(1.0 - position * (1.0 - self.min_fraction), 2)
+            if factor != self._factor:
+                logger.info(f"{self.db} load is {load}, dump throttled to {factor:.0%} of its cap")
+            self._factor = factor
+            return factor
+
+
+def _shared_bucket(key, create):
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = create()
+    return bucket
+
+
+def dump_bucket(config, db):
+    """Rate limit on reading dumps from one database server, or None when uncapped"""
+    from utils.db_pool import server_id
+
+    settings = _settings(config)
+    adaptive = settings.get("adaptive") or {}
+    if not settings.get("dump_mb_per_s"):
+        if adaptive.get("enabled"):
+            logger.warning("Adaptive throttling scales throttle.dump_mb_per_s, which is not set")
+        return None
+    rate = float(settings["dump_mb_per_s"]) * MB
+
+    def create():
+        load = LoadMonitor(config, db, adaptive) if adaptive.get("enabled") else None
+        return TokenBucket(rate, load=load)
+    return _shared_bucket(("dump", server_id(config, db), rate, bool(adaptive.get("enabled"))), create)
+
+
+def upload_bucket(config):
+    """Rate limit on everything this process sends to S3, or None when uncapped"""
+    settings = _settings(config)
+    if not settings.get("upload_mb_per_s"):
+        return None
+    rate = float(settings["upload_mb_per_s"]) * MB
+    return _shared_bucket(("upload", rate), lambda: TokenBucket(rate))
+
+
+def throttled(chunks, bucket, stage=None):
+    """
+    Pass byte chunks through at the bucket's rate, adding the time spent waiting to `stage`
+    (by default whichever metrics stage is running on the consuming thread).
+    """
+    if bucket is None:
+        yield from chunks
+        return
+    try:
+        for chunk in chunks:
+            waited = bucket.consume(len(chunk))
+            if waited:
+                target = stage or metrics.current_stage()
+                if target is not None:
+                    target.add_throttled(waited)
+            yield chunk
+    finally:
+        # Closing this generator must also close the source, e.g. to reap a dump process
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+
+
+def prioritized(cmd, config):
+    """
+    Run a dump command under the configured nice and ionice settings. The wrappers are
+    resolved where the command runs, so one missing from e.g. a container image is skipped.
+    """
+    settings = _settings(config)
+    wrappers = []
+    if settings.get("ionice_class") is not None:
+        ionice = ["ionice", "-c", str(int(settings["ionice_class"]))]
+        if settings.get("ionice_level") is not None and int(settings["ionice_class"]) in (1, 2):
+            ionice += ["-n", str(int(settings["ionice_level"]))]
+        wrappers.append(ionice)
+    if settings.get("nice") is not None:
+        wrappers.append(["nice", "-n", str(int(settings["nice"]))])
+    if not wrappers:
+        return cmd
+    script = "".join(f'if command -v {w[0]} >/dev/null 2>&1; then set -- {" ".join(w)} "$@"; fi; '
+                     for w in wrappers) + 'exec "$@"'
+    return ["sh", "-c", script, "sh"] + list(cmd)